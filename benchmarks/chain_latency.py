@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.chain_latency
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Offline latency benchmark of the RAG chain: the LLM, embeddings and vector store are replaced by the
+    deterministic fakes (fixed time to first token, token rate and embedding latency), so the measured time
+    not spent in the fakes is the overhead of the chain itself (prompt assembly, history, packing, callbacks).
+
+    Measures time to first token, total latency and time per stage (question rewrite, retrieval, generation)
+    of `chain.stream` and `stream_with_debug` across chat history lengths and top-k.
+
+        python benchmarks/chain_latency.py [--repeat 20] [--output results.json] [--baseline previous.json]
+
+    With `--baseline`, the medians are compared with the previous results and the script fails
+    if any of them is slower by more than the tolerance.
+
+    :copyright: © 2024 by Jiri
+"""
+import argparse
+import itertools
+import json
+import logging
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any
+from uuid import UUID
+
+from fakes import FakeChatModel, FakeEmbeddings, make_store
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables import RunnableConfig
+
+from docbot.chains import RagChainHelper, with_memory
+from docbot.config import get_config
+from docbot.constants import LOGGER_NAME, PROMPT_WELCOME
+from docbot.memory import TokenBufferMemory
+
+MODES = ("stream", "stream_with_debug")
+METRICS = ("ttft", "total", "rewrite", "retrieval", "generation", "overhead")
+QUESTION = "How do I store the results of an Actor run in a dataset?"
+
+# compared with the baseline, a difference below the floor (in seconds) is noise
+REGRESSION_FLOOR = 0.002
+
+
+class StageTimer(BaseCallbackHandler):
+    """Measure time spent in the retriever and in the LLM calls (in the order they finished)."""
+
+    def __init__(self):
+        self.retrieval = 0.0
+        self.llm: list[float] = []
+        self._start: dict[UUID, float] = {}
+
+    def on_retriever_start(self, serialized: dict, query: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start[run_id] = time.perf_counter()
+
+    def on_retriever_end(self, documents: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self.retrieval += time.perf_counter() - self._start.pop(run_id)
+
+    def on_chat_model_start(self, serialized: dict, messages: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self.llm.append(time.perf_counter() - self._start.pop(run_id))
+
+
+def create_helper(args: argparse.Namespace, store, top_k: int) -> RagChainHelper:
+    llm = FakeChatModel(ttft=args.ttft, tokens_per_second=args.tokens_per_second, answer_tokens=args.answer_tokens)
+    return RagChainHelper(llm.model_name, 0, 16_000, store, retriever_top_k=top_k, llm=llm)
+
+
+def create_memory(rag: RagChainHelper, history: int) -> TokenBufferMemory:
+    memory = rag.create_memory()
+    memory.chat_memory.add_ai_message(PROMPT_WELCOME)
+    for i in range(history):
+        answer = " ".join(rag.llm._tokens([memory.buffer[-1]]))
+        memory.save_context({"question": f"Question {i} about Actors and datasets?"}, {"answer": answer})
+    return memory
+
+
+def run_once(rag: RagChainHelper, memory: TokenBufferMemory, mode: str) -> dict[str, float]:
+    timer = StageTimer()
+    config = RunnableConfig(callbacks=[timer])
+    ttft = None
+    start = time.perf_counter()
+    if mode == "stream":
+        for c in rag.chain.stream({"question": QUESTION}, with_memory(config, memory)):
+            if ttft is None and c.get("answer"):
+                ttft = time.perf_counter() - start
+    else:
+        for _ in rag.stream_with_debug({"question": QUESTION}, [], memory, config):
+            if ttft is None:
+                ttft = time.perf_counter() - start
+    total = time.perf_counter() - start
+
+    rewrite = timer.llm[0] if len(timer.llm) > 1 else 0.0
+    generation = timer.llm[-1]
+    return {
+        "ttft": ttft,
+        "total": total,
+        "rewrite": rewrite,
+        "retrieval": timer.retrieval,
+        "generation": generation,
+        "overhead": total - rewrite - timer.retrieval - generation,
+    }
+
+
+def summarize(runs: list[dict[str, float]]) -> dict[str, dict[str, float]]:
+    result = {}
+    for metric in METRICS:
+        values = sorted(r[metric] for r in runs)
+        p95 = statistics.quantiles(values, n=20, method="inclusive")[-1] if len(values) > 1 else values[0]
+        result[metric] = {"p50": statistics.median(values), "p95": p95}
+    return result
+
+
+def compare(results: list[dict], baseline: dict, tolerance: float) -> list[str]:
+    """Return the regressions of the medians compared with the baseline."""
+    previous = {(r["mode"], r["history"], r["top_k"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        if (b := previous.get((r["mode"], r["history"], r["top_k"]))) is None:
+            continue
+        for metric in ("ttft", "total", "overhead"):
+            new, old = r["stats"][metric]["p50"], b["stats"][metric]["p50"]
+            if new > old * (1 + tolerance) + REGRESSION_FLOOR:
+                regressions.append(
+                    f"{r['mode']} history={r['history']} top_k={r['top_k']} {metric}: {old:.4f}s -> {new:.4f}s"
+                )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", type=int, nargs="+", default=[0, 2, 8], help="Chat history lengths (turns)")
+    parser.add_argument("--top-k", type=int, nargs="+", default=[1, 5, 10], help="Numbers of retrieved documents")
+    parser.add_argument("--mode", choices=MODES, nargs="+", default=list(MODES))
+    parser.add_argument("--repeat", type=int, default=20, help="Measured runs per configuration")
+    parser.add_argument("--warmup", type=int, default=2, help="Unmeasured runs per configuration")
+    parser.add_argument("--ttft", type=float, default=0.05, help="Fake LLM time to first token [s]")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Fake LLM token rate")
+    parser.add_argument("--answer-tokens", type=int, default=40, help="Fake LLM answer length")
+    parser.add_argument("--embedding-latency", type=float, default=0.01, help="Fake embeddings latency [s]")
+    parser.add_argument("--documents", type=int, default=1000, help="Number of documents in the fake store")
+    parser.add_argument("--output", type=Path, help="Save results as JSON")
+    parser.add_argument("--baseline", type=Path, help="Compare with results saved by --output")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative slowdown against baseline")
+    args = parser.parse_args()
+
+    # the chain logs at debug level, keep the console clean (after the logging is set up by the config)
+    get_config()
+    logging.getLogger(LOGGER_NAME).setLevel(logging.ERROR)
+
+    params = {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "tolerance")}
+    store = make_store(FakeEmbeddings(latency=args.embedding_latency), n_docs=args.documents)
+
+    results = []
+    header = f"{'mode':<18}{'history':>8}{'top_k':>6}" + "".join(f"{m + ' p50/p95 [ms]':>26}" for m in METRICS)
+    print(header)
+    helpers = {top_k: create_helper(args, store, top_k) for top_k in args.top_k}
+    for mode, history, top_k in itertools.product(args.mode, args.history, args.top_k):
+        rag = helpers[top_k]
+        memory = create_memory(rag, history)
+        runs = [run_once(rag, memory, mode) for _ in range(args.warmup + args.repeat)][args.warmup :]
+        stats = summarize(runs)
+        results.append({"mode": mode, "history": history, "top_k": top_k, "stats": stats})
+        cells = "".join(f"{s['p50'] * 1000:>17.2f} / {s['p95'] * 1000:>6.2f}" for s in stats.values())
+        print(f"{mode:<18}{history:>8}{top_k:>6}{cells}")
+
+    if args.output:
+        args.output.write_text(json.dumps({"params": params, "results": results}, indent=2))
+
+    if not args.baseline:
+        return 0
+    baseline = json.loads(args.baseline.read_text())
+    if baseline["params"] != params:
+        print("Warning: the baseline was measured with different parameters", file=sys.stderr)
+    if regressions := compare(results, baseline, args.tolerance):
+        print("Regressions:\n  " + "\n  ".join(regressions), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.fakes
+    ~~~~~~~~~~~~~~~~
+
+    Deterministic stand-ins for OpenAI and Pinecone: a chat model and embeddings with configurable latency
+    and token rate, and an in-memory vector store with a synthetic corpus. Nothing is sent over the network,
+    the same parameters always produce the same outputs.
+
+    :copyright: © 2024 by Jiri
+"""
+import asyncio
+import hashlib
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterator
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from docbot.localstore import LocalVectorStore
+
+WORDS = (
+    "actor", "storage", "dataset", "proxy", "crawler", "schedule", "webhook", "run", "build", "memory",
+    "timeout", "request", "queue", "browser", "input", "output", "error", "platform", "console", "api",
+)  # fmt: skip
+
+
+def seed(text: str) -> int:
+    return int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model streaming `answer_tokens` words, the first after `ttft` seconds, then `tokens_per_second`."""
+
+    model_name: str = "fake-chat"
+    ttft: float = 0.05
+    tokens_per_second: float = 200.0
+    answer_tokens: int = 40
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def _tokens(self, messages: list[BaseMessage]) -> list[str]:
+        rng = np.random.default_rng(seed(str(messages[-1].content)))
+        return [f"{WORDS[i]} " for i in rng.integers(len(WORDS), size=self.answer_tokens)]
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        tokens = self._tokens(messages)
+        time.sleep(self.ttft + (len(tokens) - 1) / self.tokens_per_second)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        for i, token in enumerate(self._tokens(messages)):
+            time.sleep(self.ttft if i == 0 else 1 / self.tokens_per_second)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            run_manager and run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        for i, token in enumerate(self._tokens(messages)):
+            await asyncio.sleep(self.ttft if i == 0 else 1 / self.tokens_per_second)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            run_manager and await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+class FakeEmbeddings(Embeddings):
+    """Unit vectors derived from the hash of the text, every call takes `latency` seconds."""
+
+    def __init__(self, size: int = 256, latency: float = 0.0):
+        self.size = size
+        self.latency = latency
+
+    def vector(self, text: str) -> list[float]:
+        v = np.random.default_rng(seed(text)).standard_normal(self.size)
+        return (v / np.linalg.norm(v)).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency)
+        return [self.vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        time.sleep(self.latency)
+        return self.vector(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        await asyncio.sleep(self.latency)
+        return [self.vector(t) for t in texts]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        await asyncio.sleep(self.latency)
+        return self.vector(text)
+
+
+def make_store(embeddings: FakeEmbeddings, n_docs: int = 1000, doc_words: int = 300) -> LocalVectorStore:
+    """In-memory vector store (never saved) with a synthetic corpus of `n_docs` documents."""
+    rng = np.random.default_rng(0)
+    texts = [" ".join(WORDS[i] for i in rng.integers(len(WORDS), size=doc_words)) for _ in range(n_docs)]
+    metadatas = [{"title": f"Page {i}", "url": f"https://docs.apify.com/page-{i}"} for i in range(n_docs)]
+    store = LocalVectorStore(Path("/nonexistent/docbot-benchmark"), embeddings)
+    vectors = np.asarray([embeddings.vector(t) for t in texts], dtype=np.float32)
+    store.add_vectors(vectors, texts, metadatas, [str(i) for i in range(n_docs)], save=False)
+    return store
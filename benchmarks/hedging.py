@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.hedging
+    ~~~~~~~~~~~~~~~~~~
+
+    Tail latency of the LLM with hedged requests (`docbot.resilience`): the fake chat model answers most
+    requests quickly, a small share of them waits `--slow-ttft` seconds for the first token (an overloaded
+    upstream replica). Reports p50, p95 and p99 of the time to first token and the share of duplicate requests
+    for every hedge percentile (0 = no hedging).
+
+        python benchmarks/hedging.py [--requests 400] [--concurrency 8] [--slow-rate 0.03] [--percentiles 0 90 95]
+
+    :copyright: © 2024 by Jiri
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import sys
+import time
+from collections import Counter
+from typing import Any, AsyncIterator
+
+import numpy as np
+from fakes import FakeChatModel
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk
+
+from docbot.config import get_config
+from docbot.constants import LOGGER_NAME
+from docbot.metrics import Window
+from docbot.resilience import ResilientChatModel
+
+CALLS = itertools.count()
+STARTED: Counter[str] = Counter()  # requests sent to the upstream by model
+
+
+class SlowTailChatModel(FakeChatModel):
+    """Fake chat model, `slow_rate` of the requests (deterministic by the call number) wait `slow_ttft` seconds."""
+
+    slow_rate: float = 0.03
+    slow_ttft: float = 2.0
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        STARTED[self.model_name] += 1
+        if np.random.default_rng(next(CALLS)).random() < self.slow_rate:
+            await asyncio.sleep(self.slow_ttft)
+        async for chunk in super()._astream(messages, stop, run_manager, **kwargs):
+            yield chunk
+
+
+async def run(llm: ResilientChatModel, requests: int, concurrency: int) -> Window:
+    """Return first-token latencies of the requests."""
+    ttft, semaphore = Window(requests), asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            async for _ in llm.astream(f"question {i}"):
+                ttft.observe(time.perf_counter() - start)
+                break
+
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return ttft
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--ttft", type=float, default=0.05, help="Time to first token of the fast requests")
+    parser.add_argument("--slow-rate", type=float, default=0.03, help="Share of the slow requests")
+    parser.add_argument("--slow-ttft", type=float, default=2.0, help="Time to first token of the slow requests")
+    parser.add_argument("--percentiles", type=float, nargs="+", default=[0, 90, 95])
+    args = parser.parse_args()
+
+    get_config()  # sets up the logger
+    logging.getLogger(LOGGER_NAME).setLevel(logging.WARNING)
+    print(f"{'hedge at':>9}{'p50 [s]':>10}{'p95 [s]':>10}{'p99 [s]':>10}{'duplicates':>12}")
+    for percentile in args.percentiles:
+        model_name = f"fake-chat-p{percentile:g}"
+        primary = SlowTailChatModel(
+            model_name=model_name,
+            ttft=args.ttft,
+            answer_tokens=1,
+            slow_rate=args.slow_rate,
+            slow_ttft=args.slow_ttft,
+        )
+        llm = ResilientChatModel(primary=primary, hedge_percentile=percentile)
+        # warm up the latency window of the model, then measure
+        asyncio.run(run(llm, args.requests // 2, args.concurrency))
+        ttft = asyncio.run(run(llm, args.requests, args.concurrency))
+        duplicates = STARTED[model_name] / (args.requests + args.requests // 2) - 1
+        q = ttft.quantiles()
+        print(
+            f"{'-' if not percentile else f'p{percentile:g}':>9}{q[0.5]:>10.3f}{q[0.95]:>10.3f}{q[0.99]:>10.3f}"
+            f"{duplicates:>12.1%}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.import_time
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Guard cold-start time: import docbot modules in fresh interpreters, report the import time and fail
+    if it exceeds the budget or if a heavy dependency (network clients, pandas, streamlit) is imported eagerly.
+
+        python benchmarks/import_time.py [--repeat 5]
+
+    :copyright: © 2024 by Jiri
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# heavy dependencies, imported only when they are actually used
+HEAVY_MODULES = ("langchain", "langchain_openai", "langchain_pinecone", "openai", "pinecone", "pandas", "streamlit")
+
+# module -> budget in seconds (langchain_core is imported by the constants, the rest must stay lazy)
+BUDGETS = {
+    "docbot.config": 1.5,
+    "docbot.vectorstore": 1.5,
+    "docbot.chains": 2.0,
+    "docbot.server": 2.0,
+}
+
+PROBE = """
+import json, sys, time
+t = time.perf_counter()
+import {module}
+print(json.dumps({{"time": time.perf_counter() - t, "modules": sorted(m for m in sys.modules if "." not in m)}}))
+"""
+
+
+def measure(module: str) -> dict:
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module)], capture_output=True, text=True, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Number of fresh interpreters per module")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':<24}{'median [s]':>12}{'budget [s]':>12}  eager imports")
+    for module, budget in BUDGETS.items():
+        runs = [measure(module) for _ in range(args.repeat)]
+        median = statistics.median(r["time"] for r in runs)
+        eager = sorted(set(HEAVY_MODULES) & set(runs[0]["modules"]))
+        failed |= median > budget or bool(eager)
+        print(f"{module:<24}{median:>12.3f}{budget:>12.3f}  {', '.join(eager) or '-'}")
+    return int(failed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.load_test
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Load test: N concurrent multi-turn chat sessions, every session asks `--turns` questions one by one with
+    an exponential think time in between (the sessions start spread over the first think time).
+
+    By default, the sessions run in this process against the RAG chain of the app (`get_rag`, one shared
+    `RagChainHelper`, a chat memory per session) with the OpenAI and Pinecone clients pointed to the local
+    stand-ins (`benchmarks/standins.py`), so no API is paid for. With `--server`, the sessions are sent to
+    a running API server (`docbot.server`, the same chain and memory as the Streamlit app).
+
+    For every number of sessions, reports throughput (turns/s), time to first token and turn latency
+    (p50, p95, p99), failed turns and memory per session - the growth of the resident memory of the process
+    holding the sessions (this one, or `--server-pid`). The memory limit of the container (cgroup, or
+    `--memory-limit` in MiB) divided by the memory per session is the number of sessions the container holds.
+
+        python benchmarks/standins.py --ttft 0.5:0.4 &
+        python benchmarks/load_test.py --sessions 10 50 100 [--turns 4] [--think 2] [--output results.json]
+        python benchmarks/load_test.py --server http://localhost:8000 --server-pid 1234 --sessions 50
+
+    The freed memory is reused rather than returned to the system, so run the numbers of sessions
+    in ascending order (the default) or one per run.
+
+    :copyright: © 2024 by Jiri
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import numpy as np
+
+from docbot.constants import LLM_MODEL_DEFAULT, LOGGER_NAME
+from docbot.evaluate import Conversation, read_conversations
+from docbot.metrics import Window
+
+CONVERSATIONS = [
+    Conversation("actor", ["What is an Actor?", "How do I run it from the API?", "Where are its results stored?"]),
+    Conversation("dataset", ["How do I export a dataset to CSV?", "Can I filter the fields?", "Is there a limit?"]),
+    Conversation("proxy", ["How do I use residential proxies?", "How much do they cost?", "Can I pick a country?"]),
+    Conversation("schedule", ["How do I schedule an Actor run?", "How do I get notified when it fails?"]),
+]
+KIB, MIB = 1024, 1024 * 1024
+
+
+def rss_bytes(pid: int | str = "self") -> int:
+    """Resident set size of the process (Linux)."""
+    with open(f"/proc/{pid}/status") as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+
+
+def container_memory_limit() -> int | None:
+    """Memory limit of the cgroup (v2 or v1) in bytes, None if unlimited or unknown."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            value = Path(path).read_text().strip()
+        except OSError:
+            continue
+        # cgroup v1 reports no limit as a huge number
+        return int(value) if value.isdigit() and int(value) < 2**60 else None
+    return None
+
+
+def use_standins(url: str) -> None:
+    """Point the OpenAI and Pinecone clients to the stand-ins, must be called before the config is parsed."""
+    os.environ.update(
+        OPENAI_BASE_URL=f"{url}/v1",
+        OPENAI_API_KEY="sk-standin",
+        PINECONE_CONTROLLER_HOST=url,
+        PINECONE_API_KEY="standin",
+        PINECONE_INDEX_NAME=os.environ.get("PINECONE_INDEX_NAME") or "docbot",
+        DOCBOT_VECTOR_STORE="pinecone",
+        # the embedding cache and index version of the real data are not touched
+        DOCBOT_DATA_DIR=tempfile.mkdtemp(prefix="docbot-load-"),
+    )
+
+
+@dataclass
+class Turn:
+    ttft: float | None
+    latency: float
+    error: bool
+
+
+class InProcessTarget:
+    """Sessions of the RAG chain in this process, the chat memories are held until `reset`."""
+
+    def __init__(self):
+        from docbot.chains import get_rag
+
+        m = LLM_MODEL_DEFAULT
+        self.rag = get_rag(m.model_name, 0, m.context_window_tokens)
+        self.memories = {}
+
+    def rss(self) -> int:
+        return rss_bytes()
+
+    async def turn(self, session_id: str, question: str) -> Turn:
+        if (memory := self.memories.get(session_id)) is None:
+            memory = self.memories[session_id] = self.rag.create_memory()
+        start, ttft, answer, inputs = time.perf_counter(), None, [], {"question": question}
+        try:
+            async for s in self.rag.astream_with_debug(inputs, [], memory):
+                ttft = ttft if ttft is not None else time.perf_counter() - start
+                answer.append(s.content)
+            memory.save_context(inputs, {"answer": "".join(answer)})
+        except Exception as e:
+            logging.getLogger(LOGGER_NAME).warning("Turn failed: %r", e)
+            return Turn(ttft, time.perf_counter() - start, True)
+        return Turn(ttft, time.perf_counter() - start, False)
+
+    async def reset(self) -> None:
+        self.memories.clear()
+
+    async def close(self) -> None:
+        pass
+
+
+class ServerTarget:
+    """Sessions of a running API server (`docbot.server`), deleted by `reset`."""
+
+    def __init__(self, url: str, pid: int | None, max_connections: int):
+        import httpx
+
+        self.url = url.rstrip("/")
+        self.pid = pid
+        self.session_ids: set[str] = set()
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.client = httpx.AsyncClient(limits=limits, timeout=None)
+
+    def rss(self) -> int | None:
+        return rss_bytes(self.pid) if self.pid else None
+
+    async def turn(self, session_id: str, question: str) -> Turn:
+        self.session_ids.add(session_id)
+        start, ttft, error = time.perf_counter(), None, True
+        try:
+            request = {"session_id": session_id, "question": question}
+            async with self.client.stream("POST", f"{self.url}/chat", json=request) as response:
+                async for line in response.aiter_lines():
+                    if line == "event: token":
+                        ttft = ttft if ttft is not None else time.perf_counter() - start
+                    elif line == "event: done":
+                        error = False
+        except Exception as e:
+            logging.getLogger(LOGGER_NAME).warning("Turn failed: %r", e)
+        return Turn(ttft, time.perf_counter() - start, error)
+
+    async def reset(self) -> None:
+        await asyncio.gather(*(self.client.delete(f"{self.url}/sessions/{s}") for s in self.session_ids))
+        self.session_ids.clear()
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+@dataclass
+class LevelResult:
+    sessions: int
+    turns: int
+    errors: int
+    duration: float
+    throughput: float
+    ttft: dict[float, float]
+    latency: dict[float, float]
+    memory_per_session: float | None  # bytes
+    capacity: int | None  # sessions held by the memory limit
+
+    def row(self) -> str:
+        def q(window: dict[float, float], quantile: float) -> str:
+            return f"{window[quantile]:.3f}" if window else "-"
+
+        memory = f"{self.memory_per_session / KIB:.1f}" if self.memory_per_session is not None else "-"
+        return (
+            f"{self.sessions:>9}{self.turns:>7}{self.errors:>7}{self.throughput:>9.2f}"
+            f"{q(self.ttft, 0.5):>9}{q(self.ttft, 0.95):>9}{q(self.ttft, 0.99):>9}{q(self.latency, 0.95):>10}"
+            f"{memory:>12}{self.capacity if self.capacity is not None else '-':>10}"
+        )
+
+
+HEADER = (
+    f"{'sessions':>9}{'turns':>7}{'errors':>7}{'turns/s':>9}{'ttft p50':>9}{'p95':>9}{'p99':>9}{'total p95':>10}"
+    f"{'KiB/session':>12}{'capacity':>10}"
+)
+
+
+async def run_level(
+    target: InProcessTarget | ServerTarget,
+    conversations: list[Conversation],
+    sessions: int,
+    turns: int,
+    think: float,
+    unique: bool,
+    memory_limit: int | None,
+) -> LevelResult:
+    """Run the sessions concurrently, measure the memory while all of them are still held."""
+    gc.collect()
+    rss_before = target.rss()
+    ttft, latency, errors = Window(sessions * turns), Window(sessions * turns), 0
+
+    async def session(n: int) -> None:
+        nonlocal errors
+        rng = np.random.default_rng(n)
+        conversation = conversations[n % len(conversations)]
+        await asyncio.sleep(rng.uniform(0, think))
+        for i in range(turns):
+            question = conversation.questions[i % len(conversation.questions)]
+            # unique questions are not answered from the caches or coalesced with the other sessions
+            turn = await target.turn(f"load-{n}", f"{question} ({n})" if unique else question)
+            errors += turn.error
+            latency.observe(turn.latency)
+            turn.ttft is not None and ttft.observe(turn.ttft)
+            if i < turns - 1:
+                await asyncio.sleep(rng.exponential(think))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session(n) for n in range(sessions)))
+    duration = time.perf_counter() - start
+
+    gc.collect()
+    rss_after = target.rss()
+    per_session = max(rss_after - rss_before, 0) / sessions if rss_before is not None else None
+    capacity = None
+    if per_session and memory_limit:
+        capacity = int((memory_limit - rss_before) / per_session)
+    await target.reset()
+    return LevelResult(
+        sessions=sessions,
+        turns=sessions * turns,
+        errors=errors,
+        duration=duration,
+        throughput=sessions * turns / duration,
+        ttft=ttft.quantiles(),
+        latency=latency.quantiles(),
+        memory_per_session=per_session,
+        capacity=capacity,
+    )
+
+
+async def run(args: argparse.Namespace, conversations: list[Conversation], memory_limit: int | None) -> list[dict]:
+    if args.server:
+        target = ServerTarget(args.server, args.server_pid, max(args.sessions))
+    else:
+        target = InProcessTarget()
+    # the clients, tokenizers and chains are created by the first turn, not counted to the sessions
+    await target.turn("warm-up", conversations[0].questions[0])
+    await target.reset()
+
+    print(HEADER)
+    results = []
+    try:
+        for sessions in args.sessions:
+            result = await run_level(target, conversations, sessions, args.turns, args.think, args.unique, memory_limit)
+            print(result.row())
+            results.append(asdict(result))
+    finally:
+        await target.close()
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, nargs="+", default=[10, 50, 100], help="Concurrent sessions")
+    parser.add_argument("--turns", type=int, default=4, help="Questions asked by every session")
+    parser.add_argument("--think", type=float, default=2.0, help="Mean time between the turns of a session")
+    parser.add_argument("--questions", type=Path, help="Conversations (JSON lines, as for docbot.evaluate)")
+    parser.add_argument("--unique", action="store_true", help="Make questions unique to every session")
+    parser.add_argument("--standins", default="http://127.0.0.1:8100", help="URL of benchmarks/standins.py")
+    parser.add_argument("--server", help="URL of a running API server instead of the chain in this process")
+    parser.add_argument("--server-pid", type=int, help="Process of the API server, for the memory per session")
+    parser.add_argument("--memory-limit", type=float, help="Memory of the container in MiB (default: cgroup limit)")
+    parser.add_argument("--output", type=Path, help="Save the results as JSON")
+    args = parser.parse_args()
+
+    if not args.server:
+        use_standins(args.standins.rstrip("/"))
+
+    from docbot.config import get_config
+
+    get_config()  # sets up the logger
+    logging.getLogger(LOGGER_NAME).setLevel(logging.WARNING)
+    conversations = list(read_conversations(args.questions)) if args.questions else CONVERSATIONS
+    memory_limit = int(args.memory_limit * MIB) if args.memory_limit else container_memory_limit()
+    results = asyncio.run(run(args, conversations, memory_limit))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.quantization
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Memory, latency and recall@k of the quantized local vector store (int8 and binary first-pass scan
+    rescored with the full-precision vectors) compared with the exact float32 search.
+
+    By default the vectors are synthetic (clustered, 1536 dims as `text-embedding-3-small`), with `--index`
+    the local vector store at the path is used (the quantized vectors are saved into it). Queries are stored
+    vectors with added noise, the ground truth is the exact search.
+
+        python benchmarks/quantization.py [--vectors 100000] [--index .docbot/index] [--k 5 10]
+
+    :copyright: © 2024 by Jiri
+"""
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from fakes import FakeEmbeddings
+
+from docbot.localstore import LocalVectorStore
+
+METHODS = ("none", "int8", "binary")
+
+
+def synthetic_vectors(n: int, dims: int, clusters: int = 200, seed: int = 0) -> np.ndarray:
+    """Vectors grouped around random topics, closer to the real embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dims)).astype(np.float32)
+    vectors = centers[rng.integers(clusters, size=n)] + 0.8 * rng.standard_normal((n, dims)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def queries(store: LocalVectorStore, n: int, noise: float = 0.05, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(store), size=min(n, len(store)), replace=False))
+    q = np.asarray(store.vectors[rows]) + noise * rng.standard_normal((len(rows), store.vectors.shape[1]))
+    return q.astype(np.float32)
+
+
+def search(store: LocalVectorStore, q: np.ndarray, k: int) -> tuple[list[str], float]:
+    start = time.perf_counter()
+    result = store.similarity_search_by_vector_with_score(q.tolist(), k)
+    return [d.page_content for d, _ in result], time.perf_counter() - start
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", type=Path, help="Local vector store (default: synthetic vectors)")
+    parser.add_argument("--vectors", type=int, default=100_000, help="Number of synthetic vectors")
+    parser.add_argument("--dims", type=int, default=1536, help="Dimension of synthetic vectors")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, nargs="+", default=[5, 10])
+    parser.add_argument("--oversampling", type=int, help="Rescored candidates per k (default: by the method)")
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    if (path := args.index) is None:
+        path = Path(tmp.name)
+        vectors = synthetic_vectors(args.vectors, args.dims)
+        texts = [f"doc {i}" for i in range(len(vectors))]
+        LocalVectorStore(path, FakeEmbeddings()).add_vectors(vectors, texts, [{} for _ in texts], texts)
+
+    embeddings = FakeEmbeddings()
+    exact = LocalVectorStore(path, embeddings)
+    qs = queries(exact, args.queries)
+    print(f"{len(exact)} vectors, {exact.vectors.shape[1]} dims, {len(qs)} queries")
+    print(f"{'method':<8}{'k':>4}{'first pass [MB]':>17}{'saved':>8}{'build [s]':>11}{'p50 [ms]':>10}{'recall@k':>10}")
+
+    truth = {k: [search(exact, q, k)[0] for q in qs] for k in args.k}
+    for method in METHODS:
+        start = time.perf_counter()
+        store = exact if method == "none" else LocalVectorStore(path, embeddings, method, args.oversampling)
+        build = time.perf_counter() - start
+        size = store.vectors.nbytes if method == "none" else store.quantized.nbytes
+        for k in args.k:
+            results = [search(store, q, k) for q in qs]
+            recall = statistics.mean(len(set(r) & set(t)) / k for (r, _), t in zip(results, truth[k]))
+            latency = statistics.median(t for _, t in results)
+            saved = 1 - size / exact.vectors.nbytes
+            print(
+                f"{method:<8}{k:>4}{size / 2**20:>17.1f}{saved:>8.0%}{build if method != 'none' else 0:>11.2f}"
+                f"{latency * 1000:>10.2f}{recall:>10.3f}"
+            )
+    tmp.cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
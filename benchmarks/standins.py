@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.standins
+    ~~~~~~~~~~~~~~~~~~~
+
+    Local HTTP stand-ins of the OpenAI and Pinecone APIs for load tests: the real clients (openai, pinecone,
+    langchain) are pointed to this server by `OPENAI_BASE_URL` and `PINECONE_CONTROLLER_HOST`, so the whole
+    network path (connection pools, retries, streaming) is exercised without any cost or rate limit.
+
+    - `POST /v1/chat/completions` streams `--answer-tokens` words (server-sent events) after the time to first
+      token, then `--tokens-per-second`,
+    - `POST /v1/embeddings` returns deterministic unit vectors (float or base64 encoded),
+    - `GET /indexes/{name}` describes the index, the data plane host is this server,
+    - `POST /query` searches a synthetic corpus of `--documents` pages.
+
+    Latencies are log-normal, given as `median` or `median:sigma` in seconds (sigma of the log, 0 = constant).
+    `--error-rate` of the requests fail with `--error-status` before the first byte.
+
+        python benchmarks/standins.py [--port 8100] [--ttft 0.5:0.4] [--tokens-per-second 80] [--error-rate 0.01]
+
+    :copyright: © 2024 by Jiri
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+import numpy as np
+from fakes import WORDS, FakeEmbeddings, make_store, seed
+
+from docbot.localstore import LocalVectorStore
+
+EMBEDDING_DIMENSIONS = 1536  # text-embedding-ada-002, text-embedding-3-small
+
+
+@dataclass(frozen=True)
+class Latency:
+    """Log-normal latency with the median (seconds) and sigma of the log."""
+
+    median: float
+    sigma: float = 0.0
+
+    @classmethod
+    def parse(cls, value: str) -> "Latency":
+        median, _, sigma = value.partition(":")
+        return cls(float(median), float(sigma or 0))
+
+    def sample(self, rng: np.random.Generator) -> float:
+        return self.median * math.exp(self.sigma * rng.standard_normal()) if self.sigma else self.median
+
+
+@dataclass
+class StandInConfig:
+    ttft: Latency = Latency(0.5, 0.4)
+    tokens_per_second: float = 80.0
+    answer_tokens: int = 60
+    embedding_latency: Latency = Latency(0.08, 0.3)
+    query_latency: Latency = Latency(0.04, 0.3)
+    error_rate: float = 0.0
+    error_status: int = 500
+    documents: int = 2000
+    dimensions: int = EMBEDDING_DIMENSIONS
+    seed: int = 0
+
+
+@dataclass
+class Stats:
+    requests: dict[str, int] = field(default_factory=dict)
+    errors: dict[str, int] = field(default_factory=dict)
+
+    def count(self, route: str, error: bool) -> None:
+        self.requests[route] = self.requests.get(route, 0) + 1
+        if error:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+
+class StandIns:
+    """ASGI application serving the stand-in endpoints."""
+
+    def __init__(self, config: StandInConfig):
+        self.config = config
+        self.rng = np.random.default_rng(config.seed)
+        self.embeddings = FakeEmbeddings(size=config.dimensions)
+        self.stats = Stats()
+        self._store: LocalVectorStore | None = None
+
+    @property
+    def store(self) -> LocalVectorStore:
+        if self._store is None:
+            self._store = make_store(self.embeddings, self.config.documents)
+        return self._store
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        method, path = scope["method"], scope["path"].rstrip("/")
+        if method == "GET" and path == "/stats":
+            return await self.json(send, {"requests": self.stats.requests, "errors": self.stats.errors})
+        if method == "GET" and path.startswith("/indexes/"):
+            host = dict(scope["headers"]).get(b"host", b"127.0.0.1").decode()
+            return await self.json(send, self.describe_index(path.removeprefix("/indexes/"), f"http://{host}"))
+
+        routes = {
+            "/v1/chat/completions": (self.chat, None),
+            "/v1/embeddings": (self.embed, self.config.embedding_latency),
+            "/query": (self.query, self.config.query_latency),
+        }
+        if method != "POST" or path not in routes:
+            return await self.json(send, {"error": {"message": f"Not found: {method} {path}"}}, 404)
+
+        handler, latency = routes[path]
+        request = await self.read_json(receive)
+        failed = self.rng.random() < self.config.error_rate
+        self.stats.count(path, failed)
+        if latency is not None:
+            await asyncio.sleep(latency.sample(self.rng))
+        if failed:
+            error = {"message": "Stand-in failure", "type": "server_error", "code": None, "param": None}
+            return await self.json(send, {"error": error}, self.config.error_status)
+        await handler(request, send)
+
+    @staticmethod
+    async def lifespan(receive: Callable, send: Callable) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def read_json(receive: Callable) -> dict:
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                return json.loads(body or b"{}")
+
+    @staticmethod
+    async def json(send: Callable, data: dict, status: int = 200) -> None:
+        body = json.dumps(data).encode()
+        headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    def tokens(self, messages: list[dict]) -> list[str]:
+        rng = np.random.default_rng(seed(json.dumps(messages[-1:])))
+        return [f"{WORDS[i]} " for i in rng.integers(len(WORDS), size=self.config.answer_tokens)]
+
+    async def chat(self, request: dict, send: Callable) -> None:
+        tokens = self.tokens(request.get("messages", []))
+        response_id, created, model = f"chatcmpl-{seed(str(time.time_ns()))}", int(time.time()), request.get("model")
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in request.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens)}
+        usage["total_tokens"] = prompt_tokens + len(tokens)
+        await asyncio.sleep(self.config.ttft.sample(self.rng))
+        if not request.get("stream"):
+            await asyncio.sleep((len(tokens) - 1) / self.config.tokens_per_second)
+            message = {"role": "assistant", "content": "".join(tokens)}
+            choice = {"index": 0, "message": message, "finish_reason": "stop", "logprobs": None}
+            data = {"id": response_id, "object": "chat.completion", "created": created, "model": model}
+            return await self.json(send, {**data, "choices": [choice], "usage": usage})
+
+        def chunk(delta: dict, finish_reason: str | None = None) -> bytes:
+            choice = {"index": 0, "delta": delta, "finish_reason": finish_reason, "logprobs": None}
+            data = {"id": response_id, "object": "chat.completion.chunk", "created": created, "model": model}
+            return f"data: {json.dumps({**data, 'choices': [choice]})}\n\n".encode()
+
+        headers = [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send(
+            {"type": "http.response.body", "body": chunk({"role": "assistant", "content": ""}), "more_body": True}
+        )
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(1 / self.config.tokens_per_second)
+            await send({"type": "http.response.body", "body": chunk({"content": token}), "more_body": True})
+        await send({"type": "http.response.body", "body": chunk({}, "stop") + b"data: [DONE]\n\n"})
+
+    async def embed(self, request: dict, send: Callable) -> None:
+        inputs = request["input"]
+        # a string, a list of strings, token ids or lists of token ids (langchain sends the tokenized texts)
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        data = []
+        for i, text in enumerate(inputs):
+            vector = self.embeddings.vector(text if isinstance(text, str) else json.dumps(text))
+            if request.get("encoding_format") == "base64":
+                vector = base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode()
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        tokens = sum(len(t.split()) if isinstance(t, str) else len(t) for t in inputs)
+        usage = {"prompt_tokens": tokens, "total_tokens": tokens}
+        await self.json(send, {"object": "list", "data": data, "model": request.get("model"), "usage": usage})
+
+    async def query(self, request: dict, send: Callable) -> None:
+        embedding = request.get("vector") or request["queries"][0]["values"]
+        top_k = int(request.get("topK", 10))
+        docs, scores, vectors = await asyncio.to_thread(
+            self.store.similarity_search_with_vectors, embedding, top_k, request.get("filter") or None
+        )
+        include_values, include_metadata = request.get("includeValues"), request.get("includeMetadata")
+        matches = [
+            {
+                "id": doc.metadata.get("url", str(i)),
+                "score": float(score),
+                "values": vector.tolist() if include_values else [],
+                **({"metadata": {**doc.metadata, "text": doc.page_content}} if include_metadata else {}),
+            }
+            for i, (doc, score, vector) in enumerate(zip(docs, scores, vectors))
+        ]
+        namespace = request.get("namespace", "")
+        await self.json(send, {"matches": matches, "namespace": namespace, "usage": {"readUnits": 5}})
+
+    def describe_index(self, name: str, host: str) -> dict:
+        return {
+            "name": name,
+            "dimension": self.config.dimensions,
+            "metric": "cosine",
+            "host": host,
+            "spec": {"serverless": {"cloud": "aws", "region": "us-east-1"}},
+            "status": {"ready": True, "state": "Ready"},
+            "deletion_protection": "disabled",
+        }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--ttft", type=Latency.parse, default=StandInConfig.ttft, help="Time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=StandInConfig.tokens_per_second)
+    parser.add_argument("--answer-tokens", type=int, default=StandInConfig.answer_tokens)
+    parser.add_argument("--embedding-latency", type=Latency.parse, default=StandInConfig.embedding_latency)
+    parser.add_argument("--query-latency", type=Latency.parse, default=StandInConfig.query_latency)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of the failed requests")
+    parser.add_argument("--error-status", type=int, default=500, help="Status of the failed requests, e.g. 429")
+    parser.add_argument("--documents", type=int, default=StandInConfig.documents, help="Size of the corpus")
+    parser.add_argument("--dimensions", type=int, default=EMBEDDING_DIMENSIONS)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    app = StandIns(
+        StandInConfig(
+            ttft=args.ttft,
+            tokens_per_second=args.tokens_per_second,
+            answer_tokens=args.answer_tokens,
+            embedding_latency=args.embedding_latency,
+            query_latency=args.query_latency,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            documents=args.documents,
+            dimensions=args.dimensions,
+        )
+    )
+    app.store  # the corpus is embedded before the first request
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.bm25
+    ~~~~~~~~~~~
+
+    Lexical (BM25) search and hybrid (BM25 + vector) retrieval with reciprocal rank fusion.
+
+    The inverted index is stored in CSR format: postings of term `t` are `doc_ids[offsets[t]:offsets[t + 1]]`
+    with term frequencies `tfs[offsets[t]:offsets[t + 1]]`. The arrays are memory-mapped on load.
+    Every save writes a new generation directory and then replaces the `CURRENT` pointer file, so a load
+    never mixes files of two generations. The app loads the index again when the index version changes
+    (see `docbot.vectorstore.get_bm25_index`).
+
+    Build the index from the local vector store (see `docbot.localstore`), `python -m docbot.ingest`
+    rebuilds an existing index after ingesting into the local store:
+
+        python -m docbot.bm25
+
+    :copyright: © 2024 by Jiri
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Iterable
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from docbot.constants import BM25_B, BM25_K1, LOGGER_NAME, RETRIEVER_TOP_K, RRF_K
+from docbot.filters import MetadataIndex
+from docbot.localstore import LocalVectorStore, top_k
+
+logger = logging.getLogger(LOGGER_NAME)
+
+ARRAYS = ("offsets", "doc_ids", "tfs", "doc_len")
+VOCABULARY_FILE = "vocabulary.json"
+DOCUMENTS_FILE = "documents.jsonl"
+CURRENT_FILE = "CURRENT"  # name of the generation directory with the current index
+GENERATION_PREFIX = "generation-"
+
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class BM25Index:
+    """Inverted index with BM25 scoring."""
+
+    def __init__(
+        self,
+        vocabulary: dict[str, int],
+        offsets: np.ndarray,
+        doc_ids: np.ndarray,
+        tfs: np.ndarray,
+        doc_len: np.ndarray,
+        documents: list[Document],
+        k1: float = BM25_K1,
+        b: float = BM25_B,
+    ):
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.documents = documents
+        self.k1 = k1
+
+        n = len(doc_len)
+        df = np.diff(offsets)
+        self.idf = np.log(1 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avg_len = doc_len.mean() if n else 1.0
+        self.norm = (k1 * (1 - b + b * doc_len / avg_len)).astype(np.float32)
+        self._metadata_index: MetadataIndex | None = None
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    @classmethod
+    def build(cls, documents: Iterable[Document], **kwargs) -> "BM25Index":
+        vocabulary: dict[str, int] = {}
+        postings: list[list[tuple[int, int]]] = []
+        docs, doc_len = [], []
+        for i, doc in enumerate(documents):
+            tokens = tokenize(doc.page_content)
+            for term, tf in Counter(tokens).items():
+                if (t := vocabulary.setdefault(term, len(vocabulary))) == len(postings):
+                    postings.append([])
+                postings[t].append((i, tf))
+            docs.append(doc)
+            doc_len.append(len(tokens))
+
+        offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(p) for p in postings])
+        flat = [p for term_postings in postings for p in term_postings]
+        doc_ids = np.fromiter((d for d, _ in flat), dtype=np.int32, count=len(flat))
+        tfs = np.fromiter((tf for _, tf in flat), dtype=np.float32, count=len(flat))
+        logger.info("BM25 index built: %s documents, %s terms, %s postings", len(docs), len(vocabulary), len(flat))
+        return cls(vocabulary, offsets, doc_ids, tfs, np.asarray(doc_len, dtype=np.int32), docs, **kwargs)
+
+    def save(self, path: Path | str) -> None:
+        """Write the index as a new generation, a crash or a concurrent load sees the previous one complete.
+
+        The previous generation is kept for loads in progress, older generations are removed.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        previous = current_dir(path)
+        generation = f"{GENERATION_PREFIX}{time.time_ns()}"
+        tmp = path / f"{generation}.tmp"
+        tmp.mkdir()
+        for name in ARRAYS:
+            with open(tmp / f"{name}.npy", "wb") as f:
+                np.save(f, getattr(self, name))
+        (tmp / VOCABULARY_FILE).write_text(json.dumps(self.vocabulary, ensure_ascii=False), encoding="utf-8")
+        with open(tmp / DOCUMENTS_FILE, "w", encoding="utf-8") as f:
+            for d in self.documents:
+                f.write(json.dumps({"text": d.page_content, "metadata": d.metadata}, ensure_ascii=False) + "\n")
+        os.replace(tmp, path / generation)
+        (path / f"{CURRENT_FILE}.tmp").write_text(generation, encoding="utf-8")
+        os.replace(path / f"{CURRENT_FILE}.tmp", path / CURRENT_FILE)
+
+        for old in path.glob(f"{GENERATION_PREFIX}*"):
+            if old.is_dir() and old.name != generation and old != previous and old.suffix != ".tmp":
+                shutil.rmtree(old, ignore_errors=True)
+        if previous == path:  # files of the layout without generations
+            for name in [f"{name}.npy" for name in ARRAYS] + [VOCABULARY_FILE, DOCUMENTS_FILE]:
+                (path / name).unlink(missing_ok=True)
+
+    @classmethod
+    def load(cls, path: Path | str, **kwargs) -> "BM25Index":
+        path = current_dir(Path(path))
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in ARRAYS}
+        vocabulary = json.loads((path / VOCABULARY_FILE).read_text(encoding="utf-8"))
+        with open(path / DOCUMENTS_FILE, encoding="utf-8") as f:
+            documents = [Document(page_content=d["text"], metadata=d["metadata"]) for d in map(json.loads, f)]
+        if len(arrays["offsets"]) != len(vocabulary) + 1 or len(arrays["doc_len"]) != len(documents):
+            raise ValueError(f"BM25 index in {path} is inconsistent, rebuild it by `python -m docbot.bm25`")
+        logger.info("BM25 index loaded: %s documents, %s terms", len(documents), len(vocabulary))
+        return cls(vocabulary, documents=documents, **arrays, **kwargs)
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        for term in set(tokenize(query)):
+            if (t := self.vocabulary.get(term)) is None:
+                continue
+            start, end = self.offsets[t], self.offsets[t + 1]
+            docs, tf = self.doc_ids[start:end], self.tfs[start:end]
+            scores[docs] += self.idf[t] * tf * (self.k1 + 1) / (tf + self.norm[docs])
+        return scores
+
+    @property
+    def metadata_index(self) -> MetadataIndex:
+        if self._metadata_index is None:
+            self._metadata_index = MetadataIndex([d.metadata for d in self.documents])
+        return self._metadata_index
+
+    def search(self, query: str, k: int = RETRIEVER_TOP_K, filter: dict | None = None) -> list[tuple[Document, float]]:
+        """Return the k best matching documents, the filter is in the vector store syntax (`docbot.filters`)."""
+        scores = self.scores(query)
+        if filter:
+            scores[~self.metadata_index.mask(filter)] = 0
+        return [(self.documents[i], float(scores[i])) for i in top_k(scores, k) if scores[i] > 0]
+
+
+def current_dir(path: Path) -> Path:
+    """Return directory with the current generation of the index (`path` itself for an index without generations)."""
+    current = path / CURRENT_FILE
+    return path / current.read_text(encoding="utf-8").strip() if current.exists() else path
+
+
+def rebuild_index(store: LocalVectorStore, path: Path | str) -> BM25Index:
+    """Build the index from the documents of the local vector store and save it."""
+    index = BM25Index.build(Document(page_content=t, metadata=m) for t, m in zip(store.texts, store.metadatas))
+    index.save(path)
+    return index
+
+
+class BM25Retriever(BaseRetriever):
+    """Retriever using the BM25 index, or a function returning the current index (reloaded after a rebuild)."""
+
+    index: BM25Index | Callable[[], BM25Index]
+    k: int = RETRIEVER_TOP_K
+    filter: dict | None = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def get_index(self) -> BM25Index:
+        if (index := self.index if isinstance(self.index, BM25Index) else self.index()) is None:
+            raise ValueError("BM25 index not found, run `python -m docbot.bm25`")
+        return index
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        return [d for d, _ in self.get_index().search(query, self.k, self.filter)]
+
+
+class HybridRetriever(BaseRetriever):
+    """Combine results of several retrievers (e.g. BM25 and vector search) using reciprocal rank fusion.
+
+    Score of a document is sum over retrievers of `weight / (rrf_k + rank)`.
+    """
+
+    retrievers: list[BaseRetriever]
+    weights: list[float] | None = None
+    k: int = RETRIEVER_TOP_K
+    rrf_k: int = RRF_K
+
+    def fuse(self, results: list[list[Document]]) -> list[tuple[Document, float]]:
+        weights = self.weights or [1.0] * len(results)
+        docs: dict[str, Document] = {}
+        scores: Counter[str] = Counter()
+        for w, result in zip(weights, results):
+            for rank, doc in enumerate(result, start=1):
+                docs.setdefault(doc.page_content, doc)
+                scores[doc.page_content] += w / (self.rrf_k + rank)
+        return [(docs[key], score) for key, score in scores.most_common(self.k)]
+
+    def search_with_scores(self, query: str) -> list[tuple[Document, float]]:
+        return self.fuse([r.invoke(query) for r in self.retrievers])
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        results = [r.invoke(query, config={"callbacks": run_manager.get_child()}) for r in self.retrievers]
+        return [d for d, _ in self.fuse(results)]
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        results = await asyncio.gather(
+            *(r.ainvoke(query, config={"callbacks": run_manager.get_child()}) for r in self.retrievers)
+        )
+        return [d for d, _ in self.fuse(list(results))]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from docbot.cache import bump_index_version
+    from docbot.config import get_config
+    from docbot.constants import BM25_INDEX_DIR, LOCAL_INDEX_DIR
+    from docbot.vectorstore import get_embeddings
+
+    DATA_DIR = get_config().DATA_DIR
+    parser = argparse.ArgumentParser(description="Build BM25 index from the local vector store")
+    parser.add_argument("--source", type=Path, default=DATA_DIR / LOCAL_INDEX_DIR, help="Local vector store")
+    parser.add_argument("--out", type=Path, default=DATA_DIR / BM25_INDEX_DIR, help="Output directory")
+    args = parser.parse_args()
+
+    rebuild_index(LocalVectorStore(args.source, get_embeddings()), args.out)
+    bump_index_version()
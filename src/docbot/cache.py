@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.cache
+    ~~~~~~~~~~~~
+
+    Caches for the RAG chain and the index version used to invalidate them.
+
+    The index version is shared by the caches and re-read only when the modification time of its file changes,
+    checked at most every `INDEX_VERSION_CHECK_INTERVAL` seconds, so a lookup does not touch the disk.
+
+    :copyright: © 2024 by Jiri
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import cache
+from pathlib import Path
+from typing import Any, Callable, Hashable
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+from docbot.config import get_config
+from docbot.constants import (
+    INDEX_VERSION_CHECK_INTERVAL,
+    INDEX_VERSION_FILE,
+    LOGGER_NAME,
+    RETRIEVAL_CACHE_MAX_ITEMS,
+    RETRIEVAL_CACHE_TTL,
+    SEMANTIC_CACHE_MAX_ITEMS,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_TTL,
+)
+from docbot.embeddings import normalize_text
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+def read_index_version(path: Path | None = None) -> str:
+    """Return token identifying the current content of the index (empty string if the index was never ingested)."""
+    path = path or get_config().DATA_DIR / INDEX_VERSION_FILE
+    try:
+        return path.read_text().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def bump_index_version(path: Path | None = None) -> str:
+    """Generate a new index version token. Call it whenever the index is (re-)ingested."""
+    path = path or get_config().DATA_DIR / INDEX_VERSION_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    version = uuid.uuid4().hex
+    path.write_text(version)
+    logger.info("Index version bumped to %s", version)
+    if path == get_index_version().path:
+        get_index_version().refresh()
+    return version
+
+
+class IndexVersion:
+    """Index version read from the file, re-read only if its modification time (or size) changed.
+
+    The file is checked at most every `check_interval` seconds, `refresh` checks it immediately.
+    """
+
+    def __init__(self, path: Path | None = None, check_interval: float = INDEX_VERSION_CHECK_INTERVAL):
+        self.path = path or get_config().DATA_DIR / INDEX_VERSION_FILE
+        self.check_interval = check_interval
+        self._value = ""
+        self._stat: tuple[int, int] | None = None
+        self._checked = -float("inf")
+        self._lock = threading.Lock()
+
+    def get(self) -> str:
+        if time.monotonic() - self._checked >= self.check_interval:
+            self.refresh()
+        return self._value
+
+    def refresh(self) -> str:
+        with self._lock:
+            self._checked = time.monotonic()
+            try:
+                stat = self.path.stat()
+                key = stat.st_mtime_ns, stat.st_size
+            except FileNotFoundError:
+                key = None
+            if key != self._stat:
+                self._stat, self._value = key, read_index_version(self.path)
+        return self._value
+
+
+@cache
+def get_index_version() -> IndexVersion:
+    """Index version shared by all caches of the process."""
+    return IndexVersion()
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    docs: list[Document]
+    namespace: str = ""
+    created: float = field(default_factory=time.monotonic)
+
+
+class SemanticCache:
+    """Answer cache keyed on the embedding of the standalone question.
+
+    A lookup returns the stored answer of the most similar question if the cosine similarity is above the threshold.
+    Entries expire after `ttl` seconds, the oldest entries are evicted once `max_items` is reached and the whole cache
+    is dropped when the index version changes.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        ttl: float = SEMANTIC_CACHE_TTL,
+        max_items: int = SEMANTIC_CACHE_MAX_ITEMS,
+        index_version: IndexVersion | None = None,
+    ):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_items = max_items
+        self.index_version = index_version or get_index_version()
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: list[CachedAnswer] = []
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self._index_version = self.index_version.get()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _embed(self, text: str) -> np.ndarray:
+        v = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+        return v / (np.linalg.norm(v) or 1.0)
+
+    def _check_index_version(self) -> None:
+        if (version := self.index_version.get()) != self._index_version:
+            logger.info("Index version changed, clearing semantic cache")
+            self._index_version = version
+            self._set([])
+
+    def _set(self, entries: list[CachedAnswer], vectors: np.ndarray | None = None) -> None:
+        self._entries = entries
+        self._vectors = vectors if vectors is not None else np.empty((0, 0), dtype=np.float32)
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        keep = [i for i, e in enumerate(self._entries) if now - e.created < self.ttl]
+        if len(keep) != len(self._entries):
+            self._set([self._entries[i] for i in keep], self._vectors[keep])
+
+    def lookup(self, question: str, namespace: str = "") -> CachedAnswer | None:
+        q = self._embed(question)
+        with self._lock:
+            self._check_index_version()
+            self._expire()
+            if self._entries:
+                scores = self._vectors @ q
+                scores[[e.namespace != namespace for e in self._entries]] = -np.inf
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.hits += 1
+                    logger.debug(
+                        "Semantic cache hit (%.3f): %s -> %s", scores[best], question, self._entries[best].question
+                    )
+                    return self._entries[best]
+            self.misses += 1
+        return None
+
+    def put(self, question: str, answer: str, docs: list[Document], namespace: str = "") -> None:
+        q = self._embed(question)
+        with self._lock:
+            self._check_index_version()
+            self._expire()
+            entries = self._entries + [CachedAnswer(question, answer, docs, namespace)]
+            vectors = np.vstack([self._vectors, q]) if self._entries else q[np.newaxis, :]
+            self._set(entries[-self.max_items :], vectors[-self.max_items :])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._set([])
+
+
+@cache
+def get_answer_cache() -> SemanticCache | None:
+    """Answer cache shared by all sessions (None if disabled by `DOCBOT_SEMANTIC_CACHE`)."""
+    from docbot.vectorstore import get_embeddings
+
+    return SemanticCache(get_embeddings()) if get_config().SEMANTIC_CACHE else None
+
+
+class RetrievalCache:
+    """LRU cache of retrieval results keyed by the normalized query, k, search type and filters.
+
+    A hit skips both the query embedding and the vector store round-trip. Entries expire after `ttl` seconds,
+    the least recently used entries are evicted once `max_items` is reached and the whole cache is dropped
+    when the index version changes.
+    """
+
+    def __init__(
+        self,
+        ttl: float = RETRIEVAL_CACHE_TTL,
+        max_items: int = RETRIEVAL_CACHE_MAX_ITEMS,
+        index_version: IndexVersion | None = None,
+    ):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.index_version = index_version or get_index_version()
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._index_version = self.index_version.get()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(query: str, k: int, search: str, filters: dict | None = None) -> tuple:
+        return normalize_text(query), k, search, json.dumps(filters or {}, sort_keys=True, default=str)
+
+    def _check_index_version(self) -> None:
+        if (version := self.index_version.get()) != self._index_version:
+            logger.info("Index version changed, clearing retrieval cache")
+            self._index_version = version
+            self._entries.clear()
+
+    def get(self, key: Hashable) -> Any | None:
+        with self._lock:
+            self._check_index_version()
+            if (entry := self._entries.get(key)) is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
+            self.misses += 1
+        return None
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._check_index_version()
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """Return the cached value, compute and store it on a miss."""
+        if (value := self.get(key)) is None:
+            self.put(key, value := compute())
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class CachedRetriever(BaseRetriever):
+    """Retriever wrapper returning the cached documents for repeated queries.
+
+    The inner retriever is called only on a miss (as a child run, so a callback can tell hits from misses).
+    Set `search`, `k` and `filters` as configured in the inner retriever, they are part of the cache key.
+    """
+
+    retriever: BaseRetriever
+    cache: RetrievalCache
+    search: str = ""
+    k: int = 0
+    filters: dict | None = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _key(self, query: str) -> tuple:
+        return self.cache.key(query, self.k, self.search, self.filters)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        if (docs := self.cache.get(key := self._key(query))) is None:
+            docs = tuple(self.retriever.invoke(query, config={"callbacks": run_manager.get_child()}))
+            self.cache.put(key, docs)
+        return list(docs)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        if (docs := self.cache.get(key := self._key(query))) is None:
+            docs = tuple(await self.retriever.ainvoke(query, config={"callbacks": run_manager.get_child()}))
+            self.cache.put(key, docs)
+        return list(docs)
+
+
+@cache
+def get_retrieval_cache() -> RetrievalCache | None:
+    """Retrieval cache shared by all sessions (None if disabled by `DOCBOT_RETRIEVAL_CACHE`)."""
+    return RetrievalCache() if get_config().RETRIEVAL_CACHE else None
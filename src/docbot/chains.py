@@ -5,38 +5,114 @@
 
     LLM chains and utilities.
 
+    The chains are stateless and shared by all chat sessions (see `get_rag`), the chat memory and the search filter
+    of the session are passed in the config of each call (see `with_memory` and `with_search_filter`).
+
     :copyright: © 2024 by Jiri
 """
+import asyncio
+import json
+import logging
+import re
+import time
+from functools import lru_cache, partial
 from operator import itemgetter
-from typing import Generator
+from typing import TYPE_CHECKING, AsyncGenerator, Callable, Generator, Iterator
 
 from dotenv import load_dotenv
-from langchain.memory import ConversationTokenBufferMemory
 from langchain_core.documents import Document
-from langchain_core.messages import get_buffer_string
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage, get_buffer_string
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import PromptTemplate, format_document
-from langchain_core.runnables import Runnable, RunnableLambda, RunnablePassthrough
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import (
+    Runnable,
+    RunnableBranch,
+    RunnableConfig,
+    RunnableLambda,
+    RunnableParallel,
+    RunnablePassthrough,
+)
 from langchain_core.vectorstores import VectorStore
-from langchain_openai import ChatOpenAI
 
+from docbot.clients import create_chat_model
+from docbot.coalesce import SingleFlight
+from docbot.compression import ContextCompressor
 from docbot.constants import (
     CHAT_HISTORY_MAX_TOKENS,
     CONTEXT_BUFFER_METADATA,
     CONTEXT_MAX_TOKENS,
     DEFAULT_DOCUMENT_PROMPT,
     LLM_MODEL_DEFAULT,
-    OPENAI_TIMEOUT,
+    LOGGER_NAME,
     PROMPT_STANDALONE_QUESTION,
+    RAG_CACHE_MAX_ITEMS,
     RAG_PROMPT_ACTOR_ISSUES,
+    RAG_PROMPT_ACTOR_ISSUES_HISTORY,
     RETRIEVER_SEARCH_TYPE,
     RETRIEVER_TOP_K,
 )
+from docbot.context import ContextPacker, get_token_counter
+from docbot.embeddings import normalize_text
+from docbot.filters import SearchFilter
+from docbot.memory import SummaryBufferMemory, TokenBufferMemory
+from docbot.metrics import TurnMetrics, add_handler, get_metrics
+from docbot.rewrite import REWRITE_RULES, RewriteRule, has_usable_history, is_same_question
+from docbot.selection import selection_report, split_selection
+
+if TYPE_CHECKING:
+    from docbot.cache import CachedAnswer, SemanticCache
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# chain outputs saved into the debug context
+DEBUG_KEYS = ("standalone_question", "question_path", "speculative", "compression", "packing", "selection")
+
+
+def with_memory(config: RunnableConfig | None, memory: TokenBufferMemory | None) -> RunnableConfig:
+    """Return copy of the config with the chat memory of the session (without memory, the chat history is empty)."""
+    config = config or {}
+    return {**config, "configurable": {**config.get("configurable", {}), "memory": memory}}
+
+
+def get_memory(config: RunnableConfig) -> TokenBufferMemory | None:
+    return config.get("configurable", {}).get("memory")
+
+
+def with_search_filter(config: RunnableConfig | None, search_filter: SearchFilter | None) -> RunnableConfig:
+    """Return copy of the config with the search filter of the call (without filter, all documents are searched)."""
+    config = config or {}
+    return {**config, "configurable": {**config.get("configurable", {}), "search_filter": search_filter}}
+
+
+def get_search_filter(config: RunnableConfig | None) -> SearchFilter:
+    return (config or {}).get("configurable", {}).get("search_filter") or SearchFilter()
+
+
+def with_timing(runnable: Runnable) -> Runnable:
+    """Wrap runnable to return its output together with the elapsed time: {"output": ..., "time": seconds}."""
+
+    def invoke(x, config: RunnableConfig) -> dict:
+        t = time.perf_counter()
+        return {"output": runnable.invoke(x, config), "time": time.perf_counter() - t}
+
+    async def ainvoke(x, config: RunnableConfig) -> dict:
+        t = time.perf_counter()
+        return {"output": await runnable.ainvoke(x, config), "time": time.perf_counter() - t}
+
+    return RunnableLambda(invoke, afunc=ainvoke)
 
 
 class RagChainHelper:
 
-    """RAG chain with memory."""
+    """RAG chain with per-session memory.
+
+    The helper holds only stateless parts (LLM, retriever, chains), one instance can serve many sessions.
+    Create memory of a session by `create_memory` and pass it to `stream_with_debug` or by `with_memory`.
+    The search filter is passed the same way (`with_search_filter`), the filtered retriever of the call
+    is created by `retriever_factory` from the store filter.
+    """
 
     def __init__(
         self,
@@ -45,28 +121,44 @@ class RagChainHelper:
         max_token_limit: int,
         db: VectorStore,
         retriever_top_k: int = RETRIEVER_TOP_K,
+        answer_cache: "SemanticCache | None" = None,
+        rewrite_rule: RewriteRule = has_usable_history,
+        speculative_retrieval: bool = False,
+        retriever: BaseRetriever | None = None,
+        context_max_tokens: int = CONTEXT_MAX_TOKENS,
+        history_max_tokens: int = CHAT_HISTORY_MAX_TOKENS,
+        summarize_history: bool = False,
+        llm: BaseChatModel | None = None,
+        retriever_factory: Callable[[dict | None], BaseRetriever] | None = None,
+        coalesce: bool = False,
+        compressor: ContextCompressor | None = None,
     ):
         self.model_name = model_name
         self.temperature = temperature
         self.max_token_limit = max_token_limit
 
-        self.llm = ChatOpenAI(
-            streaming=True,
-            model_name=model_name,
-            temperature=temperature,
-            request_timeout=OPENAI_TIMEOUT,
-        )
-
-        self.memory = ConversationTokenBufferMemory(
-            llm=self.llm,
-            return_messages=True,
-            output_key="answer",
-            input_key="question",
-            max_token_limit=max_token_limit,
-        )
+        self.llm = llm or create_chat_model(model_name, temperature)
+        self.token_counter = get_token_counter(self.llm)
+        self.context_packer = ContextPacker(self.token_counter, context_max_tokens)
+        self.compressor = compressor
+        self.history_max_tokens = history_max_tokens
+        self.summarize_history = summarize_history
 
-        self.retriever = db.as_retriever(search_type=RETRIEVER_SEARCH_TYPE, search_kwargs={"k": retriever_top_k})
+        self.retriever_top_k = retriever_top_k
+        if retriever_factory is None and retriever is None:
+            retriever_factory = partial(self.store_retriever, db, retriever_top_k)
+        self.retriever_factory = retriever_factory
+        self.retriever = retriever or retriever_factory(None)  # without a filter
+        self.retrieve = RunnableLambda(self._retrieve, afunc=self._aretrieve)
+        self.answer_cache = answer_cache
+        self.single_flight = SingleFlight() if coalesce else None
+        self.rewrite_rule = rewrite_rule
+        self.speculative_retrieval = speculative_retrieval
+        self.answer_prompt = RAG_PROMPT_ACTOR_ISSUES_HISTORY if summarize_history else RAG_PROMPT_ACTOR_ISSUES
+        self.question_chain = self.create_question_chain()
+        self.answer_chain = self.create_answer_chain()
         self.chain = self.create_chain()
+        self._max_query_tokens: int | None = None
 
     @staticmethod
     def format_docs(
@@ -81,8 +173,22 @@ class RagChainHelper:
         doc_strings = [format_document(doc, document_prompt) for doc in docs]
         return document_separator.join(doc_strings)
 
+    @staticmethod
+    def store_retriever(db: VectorStore, k: int, store_filter: dict | None) -> BaseRetriever:
+        search_kwargs = {"k": k, "filter": store_filter} if store_filter else {"k": k}
+        return db.as_retriever(search_type=RETRIEVER_SEARCH_TYPE, search_kwargs=search_kwargs)
+
+    def create_memory(self) -> TokenBufferMemory:
+        """Return new chat memory for a session.
+
+        With the summary, the older turns are not dropped but compacted into a summary (in the background).
+        """
+        if self.summarize_history:
+            return SummaryBufferMemory(self.token_counter.count, self.llm, self.history_max_tokens)
+        return TokenBufferMemory(self.token_counter.count, self.history_max_tokens)
+
     def get_prompt_tokens(self) -> int:
-        return self.llm.get_num_tokens(self.chain.get_prompts().__str__())
+        return self.token_counter(self.chain.get_prompts().__str__())
 
     def get_max_query_tokens(self) -> int:
         """Calculates the maximum number of tokens for the user's query within LLM's context window.
@@ -91,81 +197,432 @@ class RagChainHelper:
         user's query, chat history, and external context (Page content (chunk) Page titles and URL).
         To accommodate potential oversizing due to metadata, a buffer of N tokens is subtracted
         from the total available space. This ensures the overall input does not exceed the LLM's context window limit.
+        It is computed on the first call only, the helper does not change.
         """
-        return (
-            self.max_token_limit
-            - CONTEXT_MAX_TOKENS
-            - CHAT_HISTORY_MAX_TOKENS
-            - self.get_prompt_tokens()
-            - CONTEXT_BUFFER_METADATA
-        )
+        if self._max_query_tokens is None:
+            self._max_query_tokens = (
+                self.max_token_limit
+                - self.context_packer.max_tokens
+                - self.create_memory().max_tokens
+                - self.get_prompt_tokens()
+                - CONTEXT_BUFFER_METADATA
+            )
+        return self._max_query_tokens
 
     def create_chain(self) -> Runnable:
         """Setup and return RAG chain with memory.
 
+        The chain is composed of the question chain (rewrite the user's query) and the answer chain (retrieval and
+        generation).
         Source: Langchain doc: https://python.langchain.com/docs/expression_language/cookbook/retrieval
         """
+        return self.question_chain | self.answer_chain
 
-        # This adds a "memory" key to the input object
-        loaded_memory = RunnablePassthrough.assign(
-            chat_history=RunnableLambda(self.memory.load_memory_variables) | itemgetter("history"),
-        )
+    def loaded_memory(self) -> Runnable:
+        """Return runnable that adds a "chat_history" key to the input object (from the memory in the config)."""
+        return RunnablePassthrough.assign(chat_history=self.load_history).with_config(run_name="load_memory")
+
+    @staticmethod
+    def load_history(x: dict, config: RunnableConfig) -> list[BaseMessage]:
+        if (memory := get_memory(config)) is None:
+            return []
+        return memory.load_memory_variables(x)[memory.memory_key]
+
+    @staticmethod
+    def history_string(x: dict, config: RunnableConfig) -> str:
+        """Return chat history rendered for the prompt, cached by the memory if the history comes from it."""
+        if (memory := get_memory(config)) is not None and x["chat_history"] is memory.buffer:
+            return memory.buffer_as_str
+        return get_buffer_string(x["chat_history"])
 
-        standalone_question = {
+    def create_question_chain(self) -> Runnable:
+        """Return chain that rephrases the user's question into the standalone question using chat history."""
+
+        # the chat history is passed to the answer chain, the memory is loaded once per turn
+        rewrite = {
             "standalone_question": {
                 "question": lambda x: x["question"],
-                "chat_history": lambda x: get_buffer_string(x["chat_history"]),
+                "chat_history": self.history_string,
             }
             | PROMPT_STANDALONE_QUESTION
             | self.llm
             | StrOutputParser(),
+            "question_path": lambda x: "llm",
+            "chat_history": itemgetter("chat_history"),
         }
 
+        # fast path, the question is used as it is (e.g. first question in the conversation)
+        passthrough = {
+            "standalone_question": itemgetter("question"),
+            "question_path": lambda x: "passthrough",
+            "chat_history": itemgetter("chat_history"),
+        }
+
+        standalone_question = RunnableBranch(
+            (
+                lambda x: self.rewrite_rule(x["question"], x["chat_history"]),
+                RunnableParallel(rewrite).with_config(run_name="rewrite"),
+            ),
+            passthrough,
+        )
+
+        if self.speculative_retrieval:
+            # retrieve documents for the user's question while the question is being rewritten
+            standalone_question = RunnableParallel(
+                question=itemgetter("question"),
+                rewritten=with_timing(standalone_question),
+                retrieved=with_timing(
+                    (itemgetter("question") | self.retrieve).with_config(run_name="speculative_retrieval")
+                ),
+            ) | RunnableLambda(
+                lambda x: {
+                    **x["rewritten"]["output"],
+                    "speculative": {
+                        "question": x["question"],
+                        "docs": x["retrieved"]["output"],
+                        "rewrite_time": x["rewritten"]["time"],
+                        "retrieval_time": x["retrieved"]["time"],
+                    },
+                }
+            )
+        return self.loaded_memory() | standalone_question
+
+    def create_answer_chain(self) -> Runnable:
+        """Return chain that retrieves documents for the standalone question and generates the answer."""
+
         retrieved_documents = {
-            "docs": itemgetter("standalone_question") | self.retriever,
+            "docs": itemgetter("standalone_question") | self.retrieve,
             "question": lambda x: x["standalone_question"],
+            "question_path": lambda x: x.get("question_path"),
+            "chat_history": itemgetter("chat_history"),
         }
+        if self.speculative_retrieval:
+            retrieved_documents = RunnableLambda(self._speculative_retrieve, afunc=self._aspeculative_retrieve)
+
+        # keep only the sentences relevant to the question
+        compressed = RunnablePassthrough.assign(
+            compression=lambda x: self.compressor.compress(x["question"], split_selection(x["docs"])[0])
+        ).with_config(run_name="compression")
+
+        # pack the documents into the context token budget
+        packed = RunnablePassthrough.assign(
+            packed=lambda x: self.context_packer.pack(self.context_docs(x))
+        ).with_config(run_name="packing")
 
         # construct the inputs for the final prompt
         final_inputs = {
-            "context": lambda x: self.format_docs(x["docs"]),
+            "context": lambda x: x["packed"].text,
             "question": itemgetter("question"),
-            "chat_history": lambda x: get_buffer_string(x["chat_history"]),
+            "chat_history": self.history_string,
         }
 
         answer = {
-            "answer": final_inputs | RAG_PROMPT_ACTOR_ISSUES | self.llm,
-            "docs": itemgetter("docs"),
+            "answer": (final_inputs | self.answer_prompt | self.llm).with_config(run_name="generation"),
+            "docs": lambda x: x["packed"].docs,
+            "packing": lambda x: x["packed"].as_dict(),
+            "selection": lambda x: selection_report(x["docs"]),
+            "compression": lambda x: x["compression"].as_dict() if "compression" in x else None,
             "standalone_question": itemgetter("question"),
+            "question_path": itemgetter("question_path"),
         }
-        # Put it all together
-        return loaded_memory | standalone_question | retrieved_documents | loaded_memory | answer
+        if self.speculative_retrieval:
+            answer["speculative"] = itemgetter("speculative")
+        if self.compressor is not None:
+            return retrieved_documents | compressed | packed | answer
+        return retrieved_documents | packed | answer
 
-    def stream_with_debug(self, q: str | dict, ctx: list) -> Generator:
-        """Call chain and return generator for streaming purposes.
+    def retriever_for(self, config: RunnableConfig | None) -> BaseRetriever:
+        """Return retriever applying the search filter of the call."""
+        if not (store_filter := get_search_filter(config).to_store_filter()):
+            return self.retriever
+        if self.retriever_factory is None:
+            raise ValueError("The retriever of the RAG chain does not support search filters")
+        return self.retriever_factory(store_filter)
 
-        The ctx is only for debugging purposes. It saves docs and standalone question for debugging.
+    def _retrieve(self, query: str, config: RunnableConfig) -> list[Document]:
+        return self.retriever_for(config).invoke(query, config)
+
+    async def _aretrieve(self, query: str, config: RunnableConfig) -> list[Document]:
+        return await self.retriever_for(config).ainvoke(query, config)
+
+    @staticmethod
+    def context_docs(x: dict) -> list[Document]:
+        """Return documents for the context: compressed or kept by the adaptive retrieval (all of other retrievers)."""
+        return x["compression"].docs if "compression" in x else split_selection(x["docs"])[0]
+
+    def _speculative_retrieve(self, x: dict, config: RunnableConfig) -> dict:
+        """Reuse documents retrieved for the user's question, retrieve again only if the rewrite changed it."""
+        if reused := is_same_question(x["speculative"]["question"], x["standalone_question"]):
+            return self._speculative_result(x, x["speculative"]["docs"], 0.0)
+        t = time.perf_counter()
+        docs = self.retriever_for(config).invoke(x["standalone_question"], config)
+        return self._speculative_result(x, docs, time.perf_counter() - t, reused)
+
+    async def _aspeculative_retrieve(self, x: dict, config: RunnableConfig) -> dict:
+        if reused := is_same_question(x["speculative"]["question"], x["standalone_question"]):
+            return self._speculative_result(x, x["speculative"]["docs"], 0.0)
+        t = time.perf_counter()
+        docs = await self.retriever_for(config).ainvoke(x["standalone_question"], config)
+        return self._speculative_result(x, docs, time.perf_counter() - t, reused)
+
+    @staticmethod
+    def _speculative_result(x: dict, docs: list[Document], retrieval_time: float, reused: bool = True) -> dict:
+        spec = x["speculative"]
+        return {
+            "docs": docs,
+            "question": x["standalone_question"],
+            "question_path": x.get("question_path"),
+            "chat_history": x["chat_history"],
+            "speculative": {
+                "reused": reused,
+                "rewrite_time": spec["rewrite_time"],
+                "speculative_retrieval_time": spec["retrieval_time"],
+                "retrieval_time": retrieval_time,
+                # retrieval latency hidden behind the rewrite
+                "hidden_time": min(spec["rewrite_time"], spec["retrieval_time"]) if reused else 0.0,
+            },
+        }
+
+    def cache_namespace(self, config: RunnableConfig | None = None) -> str:
+        """Answers are cached separately for each model, temperature, retriever, number of documents, compression
+        and filter (of the call)."""
+        retriever = getattr(self.retriever, "retriever", self.retriever)  # unwrap the cached retriever
+        namespace = f"{self.model_name}:{self.temperature}:{type(retriever).__name__}:{self.retriever_top_k}"
+        if self.compressor is not None:
+            namespace += f":{type(self.compressor.scorer).__name__}"
+        if search_filter := get_search_filter(config):
+            namespace += ":" + json.dumps(search_filter.as_dict(), sort_keys=True)
+        return namespace
+
+    def coalescing_key(self, inputs: dict, config: RunnableConfig) -> tuple:
+        """Identical answers: the same normalized standalone question, retrieval parameters and answer prompt.
+
+        The chat history is a part of the key only if the answer prompt includes it.
         """
-        for c in self.chain.stream(q):
-            ctx.extend(c.get("docs")) if c.get("docs") else None
-            ctx.append(c) if c.get("standalone_question") else None
-            if s := c.get("answer"):
+        key = self.cache_namespace(config), normalize_text(inputs["standalone_question"]), self.answer_prompt.template
+        if "chat_history" in self.answer_prompt.input_variables:
+            return *key, self.history_string(inputs, config)
+        return key
+
+    def stream_with_debug(
+        self,
+        q: str | dict,
+        ctx: list,
+        memory: TokenBufferMemory | None = None,
+        config: RunnableConfig | None = None,
+        search_filter: SearchFilter | None = None,
+    ) -> Generator:
+        """Call chain with the chat memory of the session and return generator for streaming purposes.
+
+        The ctx is only for debugging purposes. It saves docs, standalone question and metrics of the turn.
+        If the answer cache is enabled, the answer for a similar standalone question is replayed from the cache.
+        With `coalesce`, concurrent identical turns (see `coalescing_key`) share one retrieval and generation.
+        """
+        turn = TurnMetrics(self.token_counter)
+        if search_filter is not None:
+            config = with_search_filter(config, search_filter)
+        try:
+            for s in self._stream(q, ctx, add_handler(with_memory(config, memory), turn), turn):
+                turn.first_token()
                 yield s
+        except Exception:
+            turn.error = True
+            raise
+        finally:
+            self._record(turn, ctx)
+
+    def _stream(self, q: str | dict, ctx: list, config: RunnableConfig, turn: TurnMetrics) -> Iterator[AIMessageChunk]:
+        if self.answer_cache is None and self.single_flight is None:
+            for c in self.chain.stream(q, config):
+                if s := self._debug(c, ctx):
+                    yield s
+            return
+
+        inputs = self.question_chain.invoke(q, config)
+        if self.answer_cache is not None:
+            t = time.perf_counter()
+            cached = self.answer_cache.lookup(inputs["standalone_question"], self.cache_namespace(config))
+            turn.add_span("answer_cache", t)
+            turn.cache["answer"] = cached is not None
+            if cached:
+                yield from self._replay(cached, inputs, ctx)
+                return
+
+        chunks, leader = self.answer_chain.stream(inputs, config), True
+        if self.single_flight is not None:
+            key = self.coalescing_key(inputs, config)
+            chunks, joined = self.single_flight.stream(key, lambda: self.answer_chain.stream(inputs, config))
+            turn.cache["coalesced"], leader = joined, not joined
+
+        start, answer, t = len(ctx), [], time.perf_counter()
+        for c in chunks:
+            if s := self._debug(c, ctx):
+                answer.append(s.content)
+                yield s
+        if not leader:
+            # retrieval, packing and generation ran in the shared execution, reported by the leader only
+            turn.add_span("coalesced", t)
+        if leader and self.answer_cache is not None:
+            self._cache_answer(inputs, "".join(answer), ctx[start:], self.cache_namespace(config))
+
+    async def astream_with_debug(
+        self,
+        q: str | dict,
+        ctx: list,
+        memory: TokenBufferMemory | None = None,
+        config: RunnableConfig | None = None,
+        search_filter: SearchFilter | None = None,
+    ) -> AsyncGenerator:
+        """Async version of `stream_with_debug`."""
+        turn = TurnMetrics(self.token_counter)
+        if search_filter is not None:
+            config = with_search_filter(config, search_filter)
+        try:
+            async for s in self._astream(q, ctx, add_handler(with_memory(config, memory), turn), turn):
+                turn.first_token()
+                yield s
+        except Exception:
+            turn.error = True
+            raise
+        finally:
+            self._record(turn, ctx)
+
+    async def _astream(
+        self, q: str | dict, ctx: list, config: RunnableConfig, turn: TurnMetrics
+    ) -> AsyncGenerator[AIMessageChunk, None]:
+        if self.answer_cache is None and self.single_flight is None:
+            async for c in self.chain.astream(q, config):
+                if s := self._debug(c, ctx):
+                    yield s
+            return
+
+        inputs = await self.question_chain.ainvoke(q, config)
+        if self.answer_cache is not None:
+            t, lookup = time.perf_counter(), self.answer_cache.lookup
+            cached = await asyncio.to_thread(lookup, inputs["standalone_question"], self.cache_namespace(config))
+            turn.add_span("answer_cache", t)
+            turn.cache["answer"] = cached is not None
+            if cached:
+                for s in self._replay(cached, inputs, ctx):
+                    yield s
+                return
+
+        chunks, leader = self.answer_chain.astream(inputs, config), True
+        if self.single_flight is not None:
+            key = self.coalescing_key(inputs, config)
+            chunks, joined = self.single_flight.astream(key, lambda: self.answer_chain.astream(inputs, config))
+            turn.cache["coalesced"], leader = joined, not joined
+
+        start, answer, t = len(ctx), [], time.perf_counter()
+        async for c in chunks:
+            if s := self._debug(c, ctx):
+                answer.append(s.content)
+                yield s
+        if not leader:
+            # retrieval, packing and generation ran in the shared execution, reported by the leader only
+            turn.add_span("coalesced", t)
+        if leader and self.answer_cache is not None:
+            namespace = self.cache_namespace(config)
+            await asyncio.to_thread(self._cache_answer, inputs, "".join(answer), ctx[start:], namespace)
+
+    @staticmethod
+    def _record(turn: TurnMetrics, ctx: list) -> None:
+        """Save metrics of the turn into ctx and into the process-wide metrics."""
+        if spec := next((c["speculative"] for c in ctx if isinstance(c, dict) and c.get("speculative")), None):
+            turn.cache["speculative_retrieval"] = spec["reused"]
+        turn.finish()
+        ctx.append({"metrics": turn.as_dict()})
+        get_metrics().record(turn)
+
+    @staticmethod
+    def _debug(c: dict, ctx: list) -> AIMessageChunk | None:
+        """Save docs and debug info from the chunk into ctx and return the answer (if the chunk contains it)."""
+        ctx.extend(c.get("docs")) if c.get("docs") else None
+        ctx.append(c) if any(c.get(k) for k in DEBUG_KEYS) else None
+        logger.debug("Standalone question path: %s", c["question_path"]) if c.get("question_path") else None
+        return c.get("answer")
+
+    @staticmethod
+    def _replay(cached: "CachedAnswer", inputs: dict, ctx: list) -> Iterator[AIMessageChunk]:
+        ctx.extend(cached.docs)
+        ctx.append({**{k: inputs.get(k) for k in ("standalone_question", "question_path")}, "cache_hit": True})
+        return (AIMessageChunk(content=token) for token in re.findall(r"\s*\S+", cached.answer))
+
+    def _cache_answer(self, inputs: dict, answer: str, ctx: list, namespace: str) -> None:
+        if docs := [d for d in ctx if isinstance(d, Document)]:
+            self.answer_cache.put(inputs["standalone_question"], answer, docs, namespace)
+
+
+@lru_cache(maxsize=RAG_CACHE_MAX_ITEMS)
+def get_rag(
+    model_name: str,
+    temperature: float,
+    max_token_limit: int,
+    retriever_top_k: int = RETRIEVER_TOP_K,
+    search: str = "",
+    answer_cache: bool = True,
+    coalesce: bool = True,
+) -> RagChainHelper:
+    """Return process-wide RAG helper configured by the settings, shared by all sessions.
+
+    The most recently used helpers are kept (`RAG_CACHE_MAX_ITEMS`), the search filter is not part of the key,
+    it is passed with every call (`with_search_filter`).
+
+    The search type defaults to `DOCBOT_SEARCH`, the question is rewritten as decided by the `DOCBOT_REWRITE` rule,
+    the answer cache is used if enabled by `DOCBOT_SEMANTIC_CACHE`, the retrieval results are cached unless disabled
+    by `DOCBOT_RETRIEVAL_CACHE`, concurrent identical turns are coalesced unless disabled by `DOCBOT_COALESCE`,
+    the context is compressed if enabled by `DOCBOT_COMPRESSION`.
+    The LLM requests are hedged and fall back to `DOCBOT_FALLBACK_MODEL` (see `docbot.resilience`).
+    """
+    from docbot.cache import CachedRetriever, get_answer_cache, get_retrieval_cache
+    from docbot.compression import get_compressor
+    from docbot.resilience import create_resilient_chat_model
+    from docbot.config import get_config
+    from docbot.vectorstore import get_db, get_retriever
+
+    config = get_config()
+    search = search or config.SEARCH
+    retrieval_cache = get_retrieval_cache()
+
+    def create_retriever(store_filter: dict | None) -> BaseRetriever:
+        retriever = get_retriever(search, retriever_top_k, store_filter)
+        if retrieval_cache is None:
+            return retriever
+        return CachedRetriever(
+            retriever=retriever, cache=retrieval_cache, search=search, k=retriever_top_k, filters=store_filter
+        )
+
+    logger.info("Creating RAG chain: %s, temperature %s, top_k %s", model_name, temperature, retriever_top_k)
+    return RagChainHelper(
+        model_name,
+        temperature,
+        max_token_limit,
+        get_db(),
+        retriever_top_k=retriever_top_k,
+        answer_cache=get_answer_cache() if answer_cache else None,
+        rewrite_rule=REWRITE_RULES[config.REWRITE],
+        speculative_retrieval=config.SPECULATIVE_RETRIEVAL,
+        summarize_history=config.MEMORY == "summary",
+        retriever_factory=create_retriever,
+        coalesce=coalesce and config.COALESCE,
+        compressor=get_compressor(),
+        llm=create_resilient_chat_model(model_name, temperature),
+    )
 
 
 if __name__ == "__main__":
     from langchain.globals import set_debug
-    from docbot.vectorstore import db_vcs
 
     set_debug(True)
     load_dotenv()
 
     m = LLM_MODEL_DEFAULT
-    rag = RagChainHelper(model_name=m.model_name, temperature=0, max_token_limit=m.context_window_tokens, db=db_vcs)
+    rag = get_rag(m.model_name, 0, m.context_window_tokens)
+    memory = rag.create_memory()
     inputs = {"question": "What is an Actor?"}
-    result = rag.chain.invoke(inputs)
+    result = rag.chain.invoke(inputs, with_memory(None, memory))
     print(result["answer"])
-    rag.memory.save_context(inputs, {"answer": result["answer"].content})
+    memory.save_context(inputs, {"answer": result["answer"].content})
     inputs = {"question": "How can I use it?"}
-    result = rag.chain.invoke(inputs)
+    result = rag.chain.invoke(inputs, with_memory(None, memory))
     print(result["answer"])
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.clients
+    ~~~~~~~~~~~~~~
+
+    Process-wide API clients. They are created lazily on the first use and shared, so that all chat models
+    and embeddings reuse one pool of HTTP connections.
+
+    The pooled connections of an async client are bound to an event loop, so there is one async client
+    per running loop (`get_openai_async_client`). The chat models and embeddings hold a `LoopLocal` proxy
+    resolved on every call, they work in any loop, e.g. when `asyncio.run` is called repeatedly.
+
+    `RateLimiter` keeps bulk jobs (ingestion) under the API rate limits.
+
+    :copyright: © 2024 by Jiri
+"""
+import asyncio
+import time
+import weakref
+from functools import cache
+from typing import TYPE_CHECKING, Any, Callable
+
+from docbot.config import get_config
+from docbot.constants import OPENAI_MAX_CONNECTIONS, OPENAI_TIMEOUT
+
+if TYPE_CHECKING:
+    import openai
+    from langchain_openai import ChatOpenAI
+
+
+@cache
+def get_openai_client() -> "openai.OpenAI":
+    import httpx
+    import openai
+
+    limits = httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS)
+    return openai.OpenAI(api_key=get_config().openai_api_key, http_client=httpx.Client(limits=limits))
+
+
+# async clients of the running loops by timeout (None = the default), dropped together with the loop
+_async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_openai_async_client(timeout: float | None = None) -> "openai.AsyncOpenAI":
+    """Async client of the running event loop, the clients with a timeout share its pool of connections."""
+    import httpx
+    import openai
+
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if (client := clients.get(timeout)) is None:
+        if (base := clients.get(None)) is None:
+            limits = httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS
+            )
+            http_client = httpx.AsyncClient(limits=limits)
+            base = clients[None] = openai.AsyncOpenAI(api_key=get_config().openai_api_key, http_client=http_client)
+        client = clients[timeout] = base if timeout is None else base.with_options(timeout=timeout)
+    return client
+
+
+async def close_openai_async_client() -> None:
+    """Close the async client of the running loop (e.g. on the shutdown of the ASGI app)."""
+    if clients := _async_clients.pop(asyncio.get_running_loop(), None):
+        await clients[None].close()
+
+
+class LoopLocal:
+    """Proxy of an attribute of the async client of the running loop, e.g. `chat.completions`."""
+
+    def __init__(self, resolve: Callable[[], Any]):
+        self._resolve = resolve
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._resolve(), name)
+
+
+def create_chat_model(model_name: str, temperature: float, timeout: float = OPENAI_TIMEOUT) -> "ChatOpenAI":
+    """Create streaming chat model using the shared OpenAI clients."""
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(
+        streaming=True,
+        model_name=model_name,
+        temperature=temperature,
+        request_timeout=timeout,
+        openai_api_key=get_config().openai_api_key,
+        client=get_openai_client().with_options(timeout=timeout).chat.completions,
+        async_client=LoopLocal(lambda: get_openai_async_client(timeout).chat.completions),
+    )
+
+
+class RateLimiter:
+    """Token bucket allowing at most `rate` units (requests or tokens) per `period` seconds.
+
+    Larger requests than `rate` are capped to `rate`, so that they wait for the full bucket instead of forever.
+    """
+
+    def __init__(self, rate: float, period: float = 60.0):
+        self.rate = rate
+        self.period = period
+        self._available = float(rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1) -> None:
+        amount = min(amount, self.rate)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._available = min(self.rate, self._available + (now - self._updated) * self.rate / self.period)
+                self._updated = now
+                if self._available >= amount:
+                    self._available -= amount
+                    return
+                await asyncio.sleep((amount - self._available) * self.period / self.rate)
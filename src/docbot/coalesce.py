@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.coalesce
+    ~~~~~~~~~~~~~~~
+
+    Single-flight execution of identical concurrent requests.
+
+    The first request of a key starts the upstream stream (in a worker thread with the context of the request,
+    or as a task of the running event loop), the requests with the same key arriving before it finishes join it
+    instead of starting their own. The produced chunks are kept by the flight, every subscriber (the first one
+    included) reads all of them from the start at its own pace, so the side outputs (e.g. retrieved documents)
+    reach every subscriber and a slow or disconnected client does not hold back the others. The flight is
+    forgotten once the upstream finishes.
+
+    A sync request does not join a flight driven by the event loop running in its own thread, waiting for it
+    would block the loop, it runs its own execution instead.
+
+    :copyright: © 2024 by Jiri
+"""
+import asyncio
+import contextvars
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from typing import AsyncIterator, Callable, Generic, Hashable, Iterator, TypeVar
+
+from docbot.constants import COALESCE_WORKERS, LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+T = TypeVar("T")
+
+
+@cache
+def get_flight_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=COALESCE_WORKERS, thread_name_prefix="docbot-flight")
+
+
+def running_loop() -> asyncio.AbstractEventLoop | None:
+    """Return the event loop running in this thread, None if there is none."""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class Flight(Generic[T]):
+    """One shared execution: chunks produced so far, the subscribers are notified about the new ones.
+
+    `loop` is the event loop driving the execution (None if it runs in a worker thread).
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop | None = None):
+        self.loop = loop
+        self.chunks: list[T] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.subscribers = 1
+        self.task: asyncio.Task | None = None
+        self._cond = threading.Condition()
+        self._waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    def publish(self, chunk: T) -> None:
+        with self._cond:
+            self.chunks.append(chunk)
+            self._notify()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        with self._cond:
+            self.done, self.error = True, error
+            self._notify()
+
+    def _notify(self) -> None:
+        self._cond.notify_all()
+        for loop, event in self._waiters:
+            loop.call_soon_threadsafe(event.set)
+        self._waiters.clear()
+
+    def _read(self, start: int) -> tuple[list[T], bool]:
+        chunks, done = self.chunks[start:], self.done
+        if done and self.error is not None and not chunks:
+            raise self.error
+        return chunks, done
+
+    def __iter__(self) -> Iterator[T]:
+        i = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self.chunks) > i or self.done)
+                chunks, done = self._read(i)
+            i += len(chunks)
+            yield from chunks
+            if done and not chunks:
+                return
+
+    async def __aiter__(self) -> AsyncIterator[T]:
+        i = 0
+        while True:
+            event = asyncio.Event()
+            with self._cond:
+                chunks, done = self._read(i)
+                if not chunks and not done:
+                    self._waiters.append((asyncio.get_running_loop(), event))
+            if not chunks and not done:
+                await event.wait()
+                continue
+            i += len(chunks)
+            for c in chunks:
+                yield c
+            if done and not chunks:
+                return
+
+
+class SingleFlight:
+    """Share one upstream execution among the concurrent requests with the same key.
+
+    `stats` counts the executions and the coalesced requests (which joined an execution in flight).
+    """
+
+    def __init__(self):
+        self.stats = Counter()
+        self._flights: dict[Hashable, Flight] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def _join(
+        self, key: Hashable, loop: asyncio.AbstractEventLoop | None = None, blocking: bool = False
+    ) -> tuple[Flight | None, bool]:
+        """Return the flight of the key and whether it was joined, a new flight is driven by the loop (if given).
+
+        A blocking subscriber does not join the flight of the loop (its thread would wait for itself), None
+        is returned instead.
+        """
+        with self._lock:
+            if (flight := self._flights.get(key)) is not None:
+                if blocking and loop is not None and flight.loop is loop:
+                    self.stats["executions"] += 1
+                    return None, False
+                flight.subscribers += 1
+                self.stats["coalesced"] += 1
+                return flight, True
+            flight = self._flights[key] = Flight(None if blocking else loop)
+            self.stats["executions"] += 1
+            return flight, False
+
+    def _finish(self, key: Hashable, flight: Flight, error: BaseException | None = None) -> None:
+        with self._lock:
+            self._flights.pop(key, None)
+        flight.finish(error)
+        flight.subscribers > 1 and logger.debug("Coalesced execution finished: %s subscribers", flight.subscribers)
+
+    def stream(self, key: Hashable, source: Callable[[], Iterator[T]]) -> tuple[Iterator[T], bool]:
+        """Return chunks of the execution of the key and whether it was joined (False if started by this call).
+
+        The execution runs in a worker thread (`get_flight_executor`) with a copy of the context of this call.
+        """
+        flight, joined = self._join(key, running_loop(), blocking=True)
+        if flight is None:
+            return source(), False
+        if not joined:
+            get_flight_executor().submit(contextvars.copy_context().run, self._run, key, flight, source)
+        return iter(flight), joined
+
+    def astream(self, key: Hashable, source: Callable[[], AsyncIterator[T]]) -> tuple[AsyncIterator[T], bool]:
+        """Async version of `stream`, the execution runs as a task of the running event loop."""
+        flight, joined = self._join(key, asyncio.get_running_loop())
+        if not joined:
+            flight.task = asyncio.create_task(self._arun(key, flight, source))
+        return aiter(flight), joined
+
+    def _run(self, key: Hashable, flight: Flight, source: Callable[[], Iterator]) -> None:
+        try:
+            for chunk in source():
+                flight.publish(chunk)
+        except Exception as e:
+            self._finish(key, flight, e)
+        except BaseException as e:  # cancelled, the subscribers must not wait forever
+            self._finish(key, flight, e)
+            raise
+        else:
+            self._finish(key, flight)
+
+    async def _arun(self, key: Hashable, flight: Flight, source: Callable[[], AsyncIterator]) -> None:
+        try:
+            async for chunk in source():
+                flight.publish(chunk)
+        except Exception as e:
+            self._finish(key, flight, e)
+        except BaseException as e:  # cancelled, the subscribers must not wait forever
+            self._finish(key, flight, e)
+            raise
+        else:
+            self._finish(key, flight)
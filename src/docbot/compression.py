@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.compression
+    ~~~~~~~~~~~~~~~~~~
+
+    Extractive compression of the retrieved documents before they are packed into the context.
+
+    Documents are split into sentences, the sentences of all documents are scored against the standalone question
+    in one batch - by the cosine similarity of the (cached) embeddings or by BM25 computed over the sentences.
+    The best sentences of every document are kept in their original order, the metadata (title, url) are kept,
+    so the citations still work. Enabled by `DOCBOT_COMPRESSION` (embeddings or lexical).
+
+    :copyright: © 2024 by Jiri
+"""
+import logging
+import math
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass
+from functools import cache
+from typing import Protocol
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from docbot.bm25 import tokenize
+from docbot.config import get_config
+from docbot.constants import (
+    BM25_B,
+    BM25_K1,
+    COMPRESSION_KEEP_RATIO,
+    COMPRESSION_MIN_SENTENCE_CHARS,
+    COMPRESSION_MIN_SENTENCES,
+    LOGGER_NAME,
+)
+from docbot.localstore import normalize
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# sentence end followed by whitespace, or an empty line (paragraphs, list items and code blocks of markdown)
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+GAP = " ... "
+
+
+def split_sentences(text: str, min_chars: int = COMPRESSION_MIN_SENTENCE_CHARS) -> list[str]:
+    """Split text into sentences, fragments shorter than `min_chars` are joined to the preceding sentence."""
+    sentences: list[str] = []
+    for s in SENTENCE_BOUNDARY.split(text):
+        if not (s := s.strip()):
+            continue
+        if sentences and (len(s) < min_chars or len(sentences[-1]) < min_chars):
+            sentences[-1] += " " + s
+        else:
+            sentences.append(s)
+    return sentences
+
+
+class SentenceScorer(Protocol):
+    def __call__(self, question: str, sentences: list[str]) -> np.ndarray:
+        """Return relevance of every sentence to the question, higher is better."""
+
+
+class EmbeddingScorer:
+    """Cosine similarity of the question and sentence embeddings (one batch request, cached by `CachedEmbeddings`)."""
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+
+    def __call__(self, question: str, sentences: list[str]) -> np.ndarray:
+        q = normalize(np.asarray(self.embeddings.embed_query(question), dtype=np.float32))
+        return normalize(np.asarray(self.embeddings.embed_documents(sentences), dtype=np.float32)) @ q
+
+
+class LexicalScorer:
+    """BM25 of the question terms, the sentences are the documents (no network calls)."""
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+
+    def __call__(self, question: str, sentences: list[str]) -> np.ndarray:
+        terms = set(tokenize(question))
+        counts = [Counter(t for t in tokenize(s) if t in terms) for s in sentences]
+        lengths = np.array([max(len(tokenize(s)), 1) for s in sentences], dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * lengths / lengths.mean())
+        scores = np.zeros(len(sentences), dtype=np.float32)
+        for term in terms:
+            tf = np.array([c[term] for c in counts], dtype=np.float32)
+            if df := np.count_nonzero(tf):
+                idf = math.log(1 + (len(sentences) - df + 0.5) / (df + 0.5))
+                scores += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+
+@dataclass
+class CompressedContext:
+    docs: list[Document]
+    sentences: int
+    kept_sentences: int
+    chars: int
+    kept_chars: int
+    time: float
+
+    @property
+    def ratio(self) -> float:
+        """Compressed size relative to the original (characters)."""
+        return self.kept_chars / self.chars if self.chars else 1.0
+
+    def as_dict(self) -> dict:
+        return {
+            "ratio": round(self.ratio, 3),
+            "sentences": self.sentences,
+            "kept_sentences": self.kept_sentences,
+            "chars": self.chars,
+            "kept_chars": self.kept_chars,
+            "time": self.time,
+        }
+
+
+class ContextCompressor:
+    """Keep the sentences of every document most relevant to the question.
+
+    A document keeps `keep_ratio` of its sentences, at least `min_sentences`, the shorter documents are unchanged.
+    Dropped runs of sentences are marked by an ellipsis.
+    """
+
+    def __init__(
+        self,
+        scorer: SentenceScorer,
+        keep_ratio: float = COMPRESSION_KEEP_RATIO,
+        min_sentences: int = COMPRESSION_MIN_SENTENCES,
+    ):
+        self.scorer = scorer
+        self.keep_ratio = keep_ratio
+        self.min_sentences = min_sentences
+
+    def compress(self, question: str, docs: list[Document]) -> CompressedContext:
+        t = time.perf_counter()
+        split = [split_sentences(d.page_content) for d in docs]
+        compressible = [len(s) > self.min_sentences for s in split]
+        # only sentences of the documents to be compressed are scored, all of them in one batch
+        scored = [s for doc_sentences, c in zip(split, compressible) if c for s in doc_sentences]
+        scores = iter(self.scorer(question, scored) if scored else [])
+
+        compressed, kept_sentences = [], 0
+        for doc, doc_sentences, c in zip(docs, split, compressible):
+            if not c:
+                compressed.append(doc)
+                kept_sentences += len(doc_sentences)
+                continue
+            doc_scores = np.fromiter((next(scores) for _ in doc_sentences), dtype=np.float32, count=len(doc_sentences))
+            n = max(self.min_sentences, math.ceil(self.keep_ratio * len(doc_sentences)))
+            keep = np.sort(np.argsort(-doc_scores, kind="stable")[:n])
+            parts = [doc_sentences[keep[0]]]
+            parts.extend((GAP if j > i + 1 else " ") + doc_sentences[j] for i, j in zip(keep, keep[1:]))
+            compressed.append(Document(page_content="".join(parts), metadata={**doc.metadata, "compressed": True}))
+            kept_sentences += len(keep)
+
+        result = CompressedContext(
+            docs=compressed,
+            sentences=sum(map(len, split)),
+            kept_sentences=kept_sentences,
+            chars=sum(len(d.page_content) for d in docs),
+            kept_chars=sum(len(d.page_content) for d in compressed),
+            time=time.perf_counter() - t,
+        )
+        logger.debug("Context compressed: %s", result.as_dict())
+        return result
+
+
+@cache
+def get_compressor() -> ContextCompressor | None:
+    """Context compressor shared by all sessions (None if disabled by `DOCBOT_COMPRESSION`)."""
+    method = get_config().COMPRESSION
+    if method == "embeddings":
+        from docbot.vectorstore import get_embeddings
+
+        return ContextCompressor(EmbeddingScorer(get_embeddings()))
+    return ContextCompressor(LexicalScorer()) if method == "lexical" else None
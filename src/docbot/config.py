@@ -11,7 +11,9 @@
 
 import logging
 import sys
+from functools import cache
 from pathlib import Path
+from typing import Literal
 
 from dotenv import load_dotenv
 from pydantic import Field, SecretStr
@@ -47,9 +49,26 @@ class Config(BaseSettings):
 
     DEPLOYMENT: str = Field("local", validation_alias="DEPLOYMENT")
     LOG_LEVEL: str = Field("DEBUG", validation_alias="DOCBOT_LOG_LEVEL")
+    DATA_DIR: Path = Field(Path(".docbot"), validation_alias="DOCBOT_DATA_DIR")
+    SEMANTIC_CACHE: bool = Field(False, validation_alias="DOCBOT_SEMANTIC_CACHE")
+    RETRIEVAL_CACHE: bool = Field(True, validation_alias="DOCBOT_RETRIEVAL_CACHE")
+    COALESCE: bool = Field(True, validation_alias="DOCBOT_COALESCE")
+    SPECULATIVE_RETRIEVAL: bool = Field(False, validation_alias="DOCBOT_SPECULATIVE_RETRIEVAL")
+    REWRITE: Literal["history", "follow_up", "always"] = Field("history", validation_alias="DOCBOT_REWRITE")
+    MEMORY: Literal["buffer", "summary"] = Field("buffer", validation_alias="DOCBOT_MEMORY")
+    METRICS_FILE: Path | None = Field(None, validation_alias="DOCBOT_METRICS_FILE")
 
     OPENAI_API_KEY: SecretStr | None = None
 
+    VECTOR_STORE: Literal["pinecone", "local"] = Field("pinecone", validation_alias="DOCBOT_VECTOR_STORE")
+    VECTOR_QUANTIZATION: Literal["none", "int8", "binary"] = Field(
+        "none", validation_alias="DOCBOT_VECTOR_QUANTIZATION"
+    )
+    SEARCH: Literal["vector", "bm25", "hybrid", "adaptive"] = Field("vector", validation_alias="DOCBOT_SEARCH")
+    COMPRESSION: Literal["none", "embeddings", "lexical"] = Field("none", validation_alias="DOCBOT_COMPRESSION")
+    FALLBACK_MODEL: str | None = Field(None, validation_alias="DOCBOT_FALLBACK_MODEL")
+    HEDGE_PERCENTILE: float = Field(95, validation_alias="DOCBOT_HEDGE_PERCENTILE")
+
     PINECONE_INDEX_NAME: str | None = None
     PINECONE_API_KEY: SecretStr | None = None
 
@@ -59,19 +78,38 @@ class Config(BaseSettings):
         extra="allow",
     )
 
+    @property
+    def openai_api_key(self) -> str | None:
+        return self.OPENAI_API_KEY and self.OPENAI_API_KEY.get_secret_value()
+
+    @property
+    def pinecone_api_key(self) -> str | None:
+        return self.PINECONE_API_KEY and self.PINECONE_API_KEY.get_secret_value()
+
+
+@cache
+def setup_logging() -> logging.Logger:
+    """Setup the docbot logger (only once per process)."""
+    return setup(LOGGER_NAME)
+
+
+@cache
+def get_config() -> Config:
+    """Parse settings on the first call, set up logging at the same time."""
+    setup_logging()
+    return Config()
+
 
 def load_dotenv_validate():
     """Load and validate config."""
     load_dotenv()
-    Config()
-
-
-setup(LOGGER_NAME)
-_config = Config()
+    get_config.cache_clear()
+    get_config()
 
-DEPLOYMENT = _config.DEPLOYMENT
-LOG_LEVEL = _config.LOG_LEVEL
-OPENAI_API_KEY = _config.OPENAI_API_KEY and _config.OPENAI_API_KEY.get_secret_value()
 
-PINECONE_INDEX_NAME = _config.PINECONE_INDEX_NAME
-PINECONE_API_KEY = _config.PINECONE_API_KEY and _config.PINECONE_API_KEY.get_secret_value()
+def __getattr__(name: str):
+    """Settings are parsed lazily on the first access, e.g. `from docbot.config import DATA_DIR`."""
+    if name in Config.model_fields:
+        value = getattr(get_config(), name)
+        return value.get_secret_value() if isinstance(value, SecretStr) else value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -17,26 +17,102 @@ VECTOR_STORE_DB_NAME = "apify-doc-platform"
 EMBEDDING_MODEL = "text-embedding-3-small"
 CHUNK_SIZE = 500  # chunk_size in tokens, using max value (determined by sentence transformer model)
 CHUNK_OVERLAP = 100  # chunk overlap in tokens
+EMBEDDING_CACHE_FILE = "embeddings.sqlite"  # stored in Config.DATA_DIR
+EMBEDDING_CACHE_MEMORY_SIZE = 1024  # number of vectors kept in memory
+EMBEDDING_CACHE_DISK_SIZE = 200_000  # number of vectors kept on disk
+EMBEDDING_CACHE_TOUCH_BATCH = 256  # disk hits whose access time is updated at once (LRU order of the disk tier)
+INDEX_VERSION_FILE = "index_version"  # stored in Config.DATA_DIR, changed on every ingestion
+INDEX_VERSION_CHECK_INTERVAL = 1.0  # seconds, the caches check the index version file at most this often
+LOCAL_INDEX_DIR = "index"  # local vector store, stored in Config.DATA_DIR
+LOCAL_INDEX_SCAN_ROWS = 2048  # rows of the quantized vectors scored at once (bounds the temporary memory)
+# candidates (per k) of the quantized first-pass scan rescored with the full-precision vectors
+QUANTIZATION_OVERSAMPLING = {"int8": 4, "binary": 20}
+BM25_INDEX_DIR = "bm25"  # lexical index, stored in Config.DATA_DIR
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60  # reciprocal rank fusion constant, score = 1 / (RRF_K + rank)
+SEARCH_TYPES = ("vector", "bm25", "hybrid", "adaptive")
+# adaptive search (docbot.selection): up to top_k of the candidates, cut at the relevance threshold or score gap
+ADAPTIVE_FETCH_K = 20  # candidates fetched with the scores and vectors
+ADAPTIVE_MIN_K = 1  # the best candidates kept even below the threshold
+ADAPTIVE_SCORE_THRESHOLD = 0.3  # minimal cosine similarity of a chunk and the question
+ADAPTIVE_ELBOW_GAP = 0.05  # cut the candidates at the largest score drop if it is at least this large
+ADAPTIVE_MMR_LAMBDA = 0.7  # maximal marginal relevance: 1 = relevance only, 0 = diversity only
+ADAPTIVE_DUPLICATE_SIMILARITY = 0.95  # cosine similarity of near-duplicate chunks, only the first one is kept
+# extractive compression of the context (docbot.compression)
+COMPRESSION_KEEP_RATIO = 0.4  # share of the sentences of a document kept in the context
+COMPRESSION_MIN_SENTENCES = 3  # sentences kept at least, documents with fewer sentences are not compressed
+COMPRESSION_MIN_SENTENCE_CHARS = 20  # shorter fragments (headings, list markers) are joined to the preceding sentence
+SOURCE_TYPES = ("docs", "issues")  # source types offered by the UI filters, set by `python -m docbot.ingest`
+URL_PREFIX_MAX_DEPTH = 4  # path segments of the URL prefixes stored for the URL filter
+RETRIEVAL_CACHE_MAX_ITEMS = 2048  # cached retrieval results (query, k, search type and filters)
+RETRIEVAL_CACHE_TTL = 60 * 60  # seconds, results are also dropped when the index version changes
+
+# INGESTION
+INGEST_BATCH_SIZE = 100  # chunks per embedding request
+INGEST_CONCURRENCY = 8  # concurrent embedding requests
+INGEST_TOKENS_PER_MINUTE = 1_000_000  # embedding rate limit
+INGEST_CHECKPOINT_INTERVAL = 30  # seconds between checkpoints
+INGEST_CHECKPOINT_DIR = "ingest"  # stored in Config.DATA_DIR
+INGEST_MANIFEST_FILE = "manifest-{store}.sqlite"  # content hashes of ingested chunks, per vector store type
+INGEST_LOCAL_SAVE_BATCHES = 50  # batches added to the local store between the snapshots written to disk
+PINECONE_UPSERT_MAX_VECTORS = 1000  # vectors per upsert request (Pinecone limit)
+PINECONE_UPSERT_MAX_BYTES = 2 * 1024 * 1024  # size of an upsert request (Pinecone limit)
+
+# EVALUATION (docbot.evaluate)
+EVAL_CONCURRENCY = 16  # conversations replayed concurrently
+EVAL_REQUESTS_PER_MINUTE = 500  # LLM requests, a follow-up question takes two (the rewrite and the answer)
 
 # UI
 UI_SEARCH_DEFAULT_K = 5
 
+# SERVER (docbot.server)
+SERVER_MAX_SESSIONS = 1000
+SERVER_SESSION_TTL = 60 * 60  # seconds, idle sessions are dropped
+
 # LOGGING
 LOGGER_NAME = "docbot"
 DEFAULT_LOG_FORMAT = "[%(asctime)s] %(levelname)s in %(module)s: %(message)s"
 
+# METRICS (docbot.metrics)
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # seconds, histogram buckets of the latencies
+METRICS_QUANTILES = (0.5, 0.95, 0.99)  # quantiles of the summaries (e.g. first-token latency of every LLM)
+METRICS_WINDOW = 1000  # recent values of a summary the quantiles are computed from
+METRICS_WRITE_INTERVAL = 5  # seconds, the metrics file is written at most once per interval (background thread)
+
 # LLM
 LLM_MODEL_DEFAULT = ConfigOpenAIModels(class_="OpenAI", model="gpt-4o-mini", context_window_tokens=16385)
 
 RETRIEVER_TOP_K = 5  # get top_k results from vector store
 RETRIEVER_SEARCH_TYPE = "similarity"  # similarity or similarity_with_score
+RAG_CACHE_MAX_ITEMS = 16  # RAG helpers (model, temperature, context window, top k, search) kept by get_rag
+COALESCE_WORKERS = 32  # threads running the coalesced executions of the sync chains (docbot.coalesce)
+# speculative retrieval: reuse documents retrieved for the user's question if the rewritten question is similar
+SPECULATIVE_RETRIEVAL_SIMILARITY = 0.8
 OPENAI_TIMEOUT = 10
+OPENAI_MAX_CONNECTIONS = 100  # size of the HTTP connection pool shared by all OpenAI clients
+# resilience of the LLM calls (docbot.resilience)
+HEDGE_MIN_SAMPLES = 20  # first-token latencies of the model observed before its percentile is used as the hedge delay
+HEDGE_DEFAULT_DELAY = 2.0  # seconds, hedge delay until enough latencies are observed
+HEDGE_MIN_DELAY = 0.2  # seconds, the duplicate request is never sent earlier
+BREAKER_FAILURES = 5  # consecutive failures of a model which open its circuit breaker
+BREAKER_RESET_TIMEOUT = 30  # seconds the open circuit breaker rejects the calls before it lets a call through
 CONTEXT_MAX_TOKENS = RETRIEVER_TOP_K * CHUNK_SIZE
 CONTEXT_BUFFER_METADATA = CHUNK_SIZE
+CONTEXT_MIN_TRUNCATED_TOKENS = 100  # a document is truncated to fit the context only if it keeps at least this many
+TOKEN_CACHE_MAX_ITEMS = 10_000  # memoized token counts of chunks and prompts (per model)
 
 # We need to keep sufficient chat history, but it does not make sense to keep it extremely long because of $$$
 # Short answer - 40 tokens, long answer 200 tokens -> support around 5 long message at max.
 CHAT_HISTORY_MAX_TOKENS = 1200
+# Optional rolling summary of the turns dropped from the chat history (DOCBOT_MEMORY=summary)
+SUMMARY_MAX_TOKENS = 300
+SUMMARY_WORKERS = 4  # background threads summarizing the chat history (shared by all sessions)
+
+# Semantic cache of answers, keyed on the embedding of the standalone question
+SEMANTIC_CACHE_THRESHOLD = 0.95  # minimal cosine similarity for a cache hit
+SEMANTIC_CACHE_TTL = 24 * 60 * 60  # seconds
+SEMANTIC_CACHE_MAX_ITEMS = 1000
 
 # basic prompt for RAG (not used for the final application)
 RAG_PROMPT_BASIC = PromptTemplate.from_template(
@@ -115,6 +191,13 @@ RAG_PROMPT_ACTOR_ISSUES = PromptTemplate.from_template(
     """
 )
 
+# final prompt with the chat history (used with the summary memory)
+RAG_PROMPT_ACTOR_ISSUES_HISTORY = PromptTemplate.from_template(
+    template=RAG_PROMPT_ACTOR_ISSUES.template.replace(
+        "    Context: {context}", "    Chat history: {chat_history}\n\n    Context: {context}"
+    )
+)
+
 PROMPT_STANDALONE_QUESTION = PromptTemplate.from_template(
     template="""Given the following conversation, decide whether the user utterance is a statement, standalone
     question, or a follow up question.
@@ -127,6 +210,22 @@ PROMPT_STANDALONE_QUESTION = PromptTemplate.from_template(
 """
 )
 
+PROMPT_SUMMARY = PromptTemplate.from_template(
+    template="""Progressively summarize the conversation between a user and the Apify documentation assistant.
+    Extend the current summary with the new lines of the conversation and return the new summary.
+    Keep the facts the user shared about their use case (Actors, errors, settings), drop greetings and small talk.
+    The summary must be shorter than {max_words} words.
+
+    Current summary:
+    {summary}
+
+    New lines of conversation:
+    {new_lines}
+
+    New summary:
+"""
+)
+
 PROMPT_WELCOME = """**Welcome to the Apify's Platform documentation Assistant!** Just type your question below for detailed support on
 the Apify Platform. \nWhat can I help you with?"""
 
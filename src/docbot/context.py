@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.context
+    ~~~~~~~~~~~~~~
+
+    Assembly of the LLM context: pack retrieved documents into a token budget.
+
+    Token counts are memoized per model by a digest of the formatted text (the document prompt included),
+    so the tokenizer runs only for documents and prompts not seen before and the memo does not hold the texts.
+
+    :copyright: © 2024 by Jiri
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Hashable
+
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.prompts import PromptTemplate, format_document
+
+from docbot.constants import (
+    CONTEXT_MAX_TOKENS,
+    CONTEXT_MIN_TRUNCATED_TOKENS,
+    DEFAULT_DOCUMENT_PROMPT,
+    LOGGER_NAME,
+    TOKEN_CACHE_MAX_ITEMS,
+)
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class TokenCounter:
+    """Count tokens with the model's tokenizer, the counts are memoized (LRU) by a digest of the text."""
+
+    def __init__(self, count: Callable[[str], int], max_items: int = TOKEN_CACHE_MAX_ITEMS):
+        self._count = count
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._memo: OrderedDict[Hashable, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str, key: Hashable | None = None) -> int:
+        """Return number of tokens of the text, memoized by key (defaults to the digest of the text)."""
+        key = self.key(text) if key is None else key
+        with self._lock:
+            if (n := self._memo.get(key)) is not None:
+                self.hits += 1
+                self._memo.move_to_end(key)
+                return n
+        n = self.count(text)
+        with self._lock:
+            self.misses += 1
+            self._memo[key] = n
+            while len(self._memo) > self.max_items:
+                self._memo.popitem(last=False)
+        return n
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    def count(self, text: str) -> int:
+        """Return number of tokens of the text (not memoized)."""
+        return self._count(text)
+
+    def fits(self, text: str, max_tokens: int) -> bool:
+        """Check that the text has at most `max_tokens` tokens (not memoized).
+
+        A token has at least one byte, texts with fewer UTF-8 bytes than `max_tokens` are not tokenized.
+        """
+        return len(text.encode()) <= max_tokens or self.count(text) <= max_tokens
+
+
+_counters: dict[str, TokenCounter] = {}
+
+
+def get_token_counter(llm: BaseLanguageModel) -> TokenCounter:
+    """Return process-wide token counter for the model of the llm."""
+    name = getattr(llm, "model_name", None) or type(llm).__name__
+    if (counter := _counters.get(name)) is None:
+        counter = _counters[name] = TokenCounter(llm.get_num_tokens)
+    return counter
+
+
+@dataclass
+class PackedContext:
+    text: str
+    docs: list[Document]
+    tokens: int
+    budget: int
+    truncated: int = 0
+    dropped: list[Document] = field(default_factory=list)
+
+    def as_dict(self) -> dict:
+        return {
+            "tokens": self.tokens,
+            "budget": self.budget,
+            "kept": len(self.docs),
+            "truncated": self.truncated,
+            "dropped": len(self.dropped),
+        }
+
+
+class ContextPacker:
+    """Pack documents (in the retrieval order) into the token budget.
+
+    A document which does not fit is truncated if at least `min_truncated_tokens` remain, otherwise it is dropped.
+    """
+
+    def __init__(
+        self,
+        counter: TokenCounter,
+        max_tokens: int = CONTEXT_MAX_TOKENS,
+        document_prompt: PromptTemplate = DEFAULT_DOCUMENT_PROMPT,
+        document_separator: str = "\n\n",
+        min_truncated_tokens: int = CONTEXT_MIN_TRUNCATED_TOKENS,
+    ):
+        self.counter = counter
+        self.max_tokens = max_tokens
+        self.document_prompt = document_prompt
+        self.document_separator = document_separator
+        self.min_truncated_tokens = min_truncated_tokens
+
+    def pack(self, docs: list[Document]) -> PackedContext:
+        separator = self.counter(self.document_separator)
+        strings, kept, dropped, truncated, tokens = [], [], [], 0, 0
+        for doc in docs:
+            remaining = self.max_tokens - tokens - (separator if kept else 0)
+            s = format_document(doc, self.document_prompt)
+            n = self.counter(s)
+            if n > remaining:
+                if remaining < self.min_truncated_tokens or (t := self.truncate(doc, n, remaining)) is None:
+                    dropped.append(doc)
+                    continue
+                doc, s, n = t
+                truncated += 1
+            strings.append(s)
+            kept.append(doc)
+            tokens += n + (separator if len(kept) > 1 else 0)
+
+        if truncated or dropped:
+            logger.debug("Context packed: %s docs kept (%s truncated), %s dropped", len(kept), truncated, len(dropped))
+        return PackedContext(self.document_separator.join(strings), kept, tokens, self.max_tokens, truncated, dropped)
+
+    def truncate(self, doc: Document, tokens: int, max_tokens: int) -> tuple[Document, str, int] | None:
+        """Shorten the page content (estimate by the characters per token) until the formatted document fits."""
+        content = doc.page_content
+        for _ in range(3):
+            if not (content := content[: int(len(content) * max_tokens / tokens * 0.95)]):
+                break
+            d = Document(page_content=content, metadata={**doc.metadata, "truncated": True})
+            s = format_document(d, self.document_prompt)
+            if (tokens := self.counter.count(s)) <= max_tokens:
+                return d, s, tokens
+        return None
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.embeddings
+    ~~~~~~~~~~~~~~~~~
+
+    Embeddings with a two-tier cache (in-memory LRU and on-disk SQLite).
+
+    Vectors are stored and returned as float32 values by both tiers, so that a text always gets the same vector.
+
+    :copyright: © 2024 by Jiri
+"""
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable
+
+from langchain_core.embeddings import Embeddings
+
+from docbot.constants import (
+    EMBEDDING_CACHE_DISK_SIZE,
+    EMBEDDING_CACHE_MEMORY_SIZE,
+    EMBEDDING_CACHE_TOUCH_BATCH,
+    LOGGER_NAME,
+)
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text before it is used as a cache key (unicode form and whitespace)."""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def as_float32(vector: list[float]) -> list[float]:
+    """Round the vector to float32, the precision of the disk tier."""
+    return array("f", vector).tolist()
+
+
+@dataclass
+class CacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / total if total else 0.0
+
+    def as_dict(self) -> dict:
+        return {**asdict(self), "hit_rate": self.hit_rate}
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that caches vectors keyed by model name and normalized text.
+
+    The first tier is an in-memory LRU, the second tier is a SQLite file which survives restarts.
+    Both tiers are bounded by the number of stored vectors, the least recently used vectors are evicted first.
+    The access times of the disk hits are written in batches of `touch_batch` (and before an eviction).
+    Set `path` to None to use the in-memory tier only.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model_name: str,
+        path: Path | str | None = None,
+        memory_max_items: int = EMBEDDING_CACHE_MEMORY_SIZE,
+        disk_max_items: int = EMBEDDING_CACHE_DISK_SIZE,
+        touch_batch: int = EMBEDDING_CACHE_TOUCH_BATCH,
+    ):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.memory_max_items = memory_max_items
+        self.disk_max_items = disk_max_items
+        self.touch_batch = touch_batch
+        self.stats = CacheStats()
+
+        self._memory: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()  # memory tier and stats
+        self._db_lock = threading.Lock()  # disk tier, the memory hits do not wait for the disk
+        self._touched: dict[str, float] = {}
+        self._db: sqlite3.Connection | None = None
+        if path is not None:
+            self._db = self._connect(Path(path))
+
+    @staticmethod
+    def _connect(path: Path) -> sqlite3.Connection:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, accessed REAL NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+        return db
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{normalize_text(text)}".encode()).hexdigest()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self.key(t) for t in texts]
+        vectors, missing = self._lookup(keys)
+        if missing:
+            self._store(keys, vectors, missing, self.embeddings.embed_documents([texts[i] for i in missing]))
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self.key(text)
+        vectors, missing = self._lookup([key])
+        if missing:
+            self._store([key], vectors, missing, [self.embeddings.embed_query(text)])
+        return vectors[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self.key(t) for t in texts]
+        vectors, missing = await self._off_loop(self._lookup, keys)
+        if missing:
+            computed = await self.embeddings.aembed_documents([texts[i] for i in missing])
+            await self._off_loop(self._store, keys, vectors, missing, computed)
+        return vectors
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = self.key(text)
+        vectors, missing = await self._off_loop(self._lookup, [key])
+        if missing:
+            await self._off_loop(self._store, [key], vectors, missing, [await self.embeddings.aembed_query(text)])
+        return vectors[0]
+
+    async def _off_loop(self, fn: Callable, *args):
+        """Run the cache operation in a worker thread if it reads or writes the disk tier."""
+        return await asyncio.to_thread(fn, *args) if self._db is not None else fn(*args)
+
+    def _lookup(self, keys: list[str]) -> tuple[list, list[int]]:
+        """Return vectors found in cache (None if not found) and indices of missing keys."""
+        vectors: list = [None] * len(keys)
+        to_disk: list[int] = []
+        with self._lock:
+            for i, k in enumerate(keys):
+                if (v := self._memory.get(k)) is not None:
+                    self._memory.move_to_end(k)
+                    vectors[i] = v
+                    self.stats.memory_hits += 1
+                else:
+                    to_disk.append(i)
+
+        found = self._disk_get({keys[i] for i in to_disk}) if to_disk and self._db is not None else {}
+        with self._lock:
+            for i in to_disk:
+                if (v := found.get(keys[i])) is not None:
+                    vectors[i] = v
+                    self._memory_put(keys[i], v)
+                    self.stats.disk_hits += 1
+            missing = [i for i in to_disk if vectors[i] is None]
+            self.stats.misses += len(missing)
+        return vectors, missing
+
+    def _store(self, keys: list[str], vectors: list, missing: list[int], computed: list[list[float]]) -> None:
+        computed = [as_float32(v) for v in computed]
+        with self._lock:
+            for i, v in zip(missing, computed):
+                vectors[i] = v
+                self._memory_put(keys[i], v)
+        if self._db is not None:
+            self._disk_put({keys[i]: v for i, v in zip(missing, computed)})
+
+    def _memory_put(self, key: str, vector: list[float]) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_max_items:
+            self._memory.popitem(last=False)
+
+    def _disk_get(self, keys: set[str]) -> dict[str, list[float]]:
+        keys_, rows = list(keys), []
+        with self._db_lock:
+            for i in range(0, len(keys_), 500):
+                batch = keys_[i : i + 500]
+                sql = f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})"
+                rows.extend(self._db.execute(sql, batch).fetchall())
+            now = time.time()
+            self._touched.update((k, now) for k, _ in rows)
+            if len(self._touched) >= self.touch_batch:
+                self._flush_touched()
+        return {k: array("f", v).tolist() for k, v in rows}
+
+    def _flush_touched(self) -> None:
+        """Write the access times of the disk hits (the disk lock must be held)."""
+        if self._touched:
+            self._db.executemany(
+                "UPDATE embeddings SET accessed = ? WHERE key = ?", [(t, k) for k, t in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def _disk_put(self, items: dict[str, list[float]]) -> None:
+        now = time.time()
+        with self._db_lock:
+            self._flush_touched()
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, accessed) VALUES (?, ?, ?)",
+                [(k, array("f", v).tobytes(), now) for k, v in items.items()],
+            )
+            (count,) = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.disk_max_items:
+                self._db.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY accessed LIMIT ?)",
+                    (count - self.disk_max_items,),
+                )
+                logger.debug("Embeddings cache evicted %s vectors from disk", count - self.disk_max_items)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        if self._db is not None:
+            with self._db_lock:
+                self._touched.clear()
+                self._db.execute("DELETE FROM embeddings")
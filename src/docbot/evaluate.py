@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.evaluate
+    ~~~~~~~~~~~~~~~
+
+    Replay conversations through the RAG chain to regression-test prompt and retrieval changes.
+
+    Conversations are read from a JSON lines file, one conversation per line (a single "question" is accepted too):
+
+        {"id": "actor-basics", "questions": ["What is an Actor?", "How do I run it?"]}
+
+    Turns of a conversation are replayed in order with their own chat memory, conversations run concurrently
+    under a rate limit of LLM requests. Every turn is written as a JSON line: the answer, retrieved urls,
+    latencies by stages and token usage. A conversation is written once all its turns are finished,
+    an interrupted run is resumed by skipping the conversations which are already in the output.
+    Output with the `.parquet` suffix is converted from JSON lines at the end (requires pandas and pyarrow).
+
+    With `--dry-run`, the questions (as they are) are only retrieved and packed into the context, without the LLM.
+
+        python -m docbot.evaluate questions.jsonl results.jsonl --concurrency 16 --rpm 500
+
+    :copyright: © 2024 by Jiri
+"""
+import asyncio
+import json
+import logging
+import statistics
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, TextIO
+
+from langchain_core.documents import Document
+
+from docbot.chains import RagChainHelper
+from docbot.clients import RateLimiter, close_openai_async_client
+from docbot.constants import EVAL_CONCURRENCY, EVAL_REQUESTS_PER_MINUTE, LOGGER_NAME, PROMPT_WELCOME
+from docbot.memory import TokenBufferMemory
+from docbot.selection import split_selection
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+@dataclass
+class Conversation:
+    id: str
+    questions: list[str]
+
+
+def read_conversations(path: Path) -> Iterator[Conversation]:
+    """Stream conversations from a JSON lines file, the id defaults to the line number."""
+    with path.open(encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if line.strip():
+                data = json.loads(line)
+                questions = data.get("questions") or [data["question"]]
+                yield Conversation(str(data.get("id", n)), [str(q) for q in questions])
+
+
+def load_completed(path: Path) -> set[str]:
+    """Return ids of the conversations with all turns in the output, drop incomplete conversations from the file."""
+    if not path.exists():
+        return set()
+    records, turns = [], Counter()
+    with path.open(encoding="utf-8") as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except json.JSONDecodeError:  # the last line written when the run was interrupted
+                break
+            records.append((r["id"], r["turns"], line))
+            turns[r["id"]] += 1
+
+    completed = {id_ for id_, n, _ in records if turns[id_] == n}
+    if len(completed) != len(turns) or sum(turns.values()) != len(records):
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text("".join(line for id_, _, line in records if id_ in completed), encoding="utf-8")
+        tmp.replace(path)
+    return completed
+
+
+class Evaluation:
+    """Replay conversations concurrently, each conversation with its own memory."""
+
+    def __init__(
+        self,
+        rag: RagChainHelper,
+        concurrency: int = EVAL_CONCURRENCY,
+        requests_per_minute: int = EVAL_REQUESTS_PER_MINUTE,
+        dry_run: bool = False,
+    ):
+        self.rag = rag
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(requests_per_minute)
+        self.dry_run = dry_run
+        self.stats = Counter()
+
+    async def run(self, conversations: Iterable[Conversation], output: TextIO) -> list[dict]:
+        """Replay the conversations, write their turns into the output and return the turns."""
+        # sync retrievers and callbacks run in the default executor, do not let it limit the concurrency
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(self.concurrency))
+        queue: asyncio.Queue[Conversation | None] = asyncio.Queue(maxsize=self.concurrency)
+        results: list[dict] = []
+
+        async def worker() -> None:
+            while (c := await queue.get()) is not None:
+                turns = await self.conversation(c)
+                output.write("".join(json.dumps(t, ensure_ascii=False) + "\n" for t in turns))
+                output.flush()
+                results.extend(turns)
+                self.stats["conversations"] += 1
+                if self.stats["conversations"] % 50 == 0:
+                    logger.info("Evaluated %s conversations, %s turns", self.stats["conversations"], len(results))
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for _ in range(self.concurrency):
+                    tg.create_task(worker())
+                for c in conversations:
+                    await queue.put(c)
+                for _ in range(self.concurrency):
+                    await queue.put(None)
+        finally:
+            await close_openai_async_client()
+        return results
+
+    async def conversation(self, c: Conversation) -> list[dict]:
+        memory = self.rag.create_memory()
+        memory.chat_memory.add_ai_message(PROMPT_WELCOME)
+        turns = []
+        for i, question in enumerate(c.questions):
+            record = {"id": c.id, "turn": i, "turns": len(c.questions), "question": question, "error": None}
+            try:
+                if self.dry_run:
+                    record |= await self.retrieve(question)
+                else:
+                    # the follow-up questions are rewritten to the standalone question first
+                    await self.limiter.acquire(2 if i else 1)
+                    record |= await self.answer(question, memory)
+            except Exception as e:
+                logger.warning("Conversation %s, turn %s failed: %s", c.id, i, e)
+                record["error"] = str(e)
+                self.stats["errors"] += 1
+            turns.append(record)
+        return turns
+
+    async def answer(self, question: str, memory: TokenBufferMemory) -> dict:
+        inputs, ctx, answer = {"question": question}, [], []
+        async for s in self.rag.astream_with_debug(inputs, ctx, memory):
+            answer.append(s.content)
+        memory.save_context(inputs, {"answer": "".join(answer)})
+
+        debug = {k: v for c in ctx if isinstance(c, dict) for k, v in c.items()}
+        metrics = debug.get("metrics", {})
+        return {
+            "standalone_question": debug.get("standalone_question"),
+            "question_path": debug.get("question_path"),
+            "answer": "".join(answer),
+            "urls": [d.metadata.get("url") for d in ctx if isinstance(d, Document)],
+            "ttft": metrics.get("ttft"),
+            "latency": metrics.get("total"),
+            "stages": metrics.get("stages"),
+            "tokens": metrics.get("tokens"),
+            "compression": debug.get("compression"),
+            "packing": debug.get("packing"),
+        }
+
+    async def retrieve(self, question: str) -> dict:
+        t = time.perf_counter()
+        docs = await self.rag.retriever.ainvoke(question)
+        retrieval = time.perf_counter() - t
+        docs, compression = split_selection(docs)[0], None
+        if self.rag.compressor is not None:
+            compression = await asyncio.to_thread(self.rag.compressor.compress, question, docs)
+            docs = compression.docs
+        packed = self.rag.context_packer.pack(docs)
+        return {
+            "urls": [d.metadata.get("url") for d in packed.docs],
+            "latency": time.perf_counter() - t,
+            "stages": {"retrieval": retrieval, **({"compression": compression.time} if compression else {})},
+            "compression": compression and compression.as_dict(),
+            "packing": packed.as_dict(),
+        }
+
+
+def summarize(turns: list[dict], elapsed: float) -> dict:
+    """Return summary of the evaluated turns: latency percentiles, token usage and throughput."""
+
+    def percentiles(values: list[float]) -> dict:
+        if not values:
+            return {}
+        p95 = statistics.quantiles(values, n=20, method="inclusive")[-1] if len(values) > 1 else values[0]
+        return {"p50": round(statistics.median(values), 3), "p95": round(p95, 3)}
+
+    ok = [t for t in turns if not t["error"]]
+    tokens = Counter()
+    for t in ok:
+        for stage in (t.get("tokens") or {}).values():
+            tokens.update(stage)
+    return {
+        "turns": len(turns),
+        "errors": len(turns) - len(ok),
+        "latency": percentiles([t["latency"] for t in ok if t.get("latency") is not None]),
+        "ttft": percentiles([t["ttft"] for t in ok if t.get("ttft") is not None]),
+        "tokens": dict(tokens),
+        "elapsed": round(elapsed, 1),
+        "turns_per_second": round(len(turns) / elapsed, 2) if elapsed else 0.0,
+    }
+
+
+def to_parquet(source: Path, target: Path) -> None:
+    """Convert the JSON lines output to Parquet (nested fields are kept as structs)."""
+    import pandas as pd
+
+    pd.read_json(source, lines=True, dtype=False).to_parquet(target, index=False)
+
+
+def evaluate(evaluation: Evaluation, source: Path, output: Path, restart: bool = False) -> list[dict]:
+    """Evaluate the conversations which are not in the output yet, return turns of this run.
+
+    Parquet output is written at the end, until then the turns are written to `<output>.partial.jsonl`.
+    """
+    parquet = output.suffix == ".parquet"
+    results = output.with_suffix(".partial.jsonl") if parquet else output
+    if restart:
+        results.unlink(missing_ok=True)
+    if done := load_completed(results):
+        logger.info("Resuming, %s conversations are already evaluated", len(done))
+    conversations = (c for c in read_conversations(source) if c.id not in done)
+
+    start = time.perf_counter()
+    results.parent.mkdir(parents=True, exist_ok=True)
+    with results.open("a", encoding="utf-8") as f:
+        turns = asyncio.run(evaluation.run(conversations, f))
+    logger.info("Evaluation finished: %s", json.dumps(summarize(turns, time.perf_counter() - start)))
+
+    if parquet:
+        to_parquet(results, output)
+        results.unlink()
+        logger.info("Results saved to %s", output)
+    return turns
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from docbot.chains import get_rag
+    from docbot.constants import LLM_MODEL_DEFAULT, RETRIEVER_TOP_K, SEARCH_TYPES
+
+    parser = argparse.ArgumentParser(description="Replay conversations through the RAG chain")
+    parser.add_argument("input", type=Path, help="JSON lines file with conversations")
+    parser.add_argument("output", type=Path, help="Results, JSON lines (.jsonl) or Parquet (.parquet)")
+    parser.add_argument("--model", default=LLM_MODEL_DEFAULT.model_name, help="LLM model name")
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--top-k", type=int, default=RETRIEVER_TOP_K, help="Number of retrieved documents")
+    parser.add_argument("--search", choices=SEARCH_TYPES, help="Search type (default: DOCBOT_SEARCH)")
+    parser.add_argument("--concurrency", type=int, default=EVAL_CONCURRENCY, help="Concurrent conversations")
+    parser.add_argument("--rpm", type=int, default=EVAL_REQUESTS_PER_MINUTE, help="LLM requests per minute")
+    parser.add_argument("--dry-run", action="store_true", help="Retrieve only, without the LLM")
+    parser.add_argument("--restart", action="store_true", help="Ignore results of a previous run")
+    args = parser.parse_args()
+
+    # every question goes through the chain, answers are neither replayed from the cache nor shared by identical turns
+    m = LLM_MODEL_DEFAULT
+    rag_ = get_rag(
+        args.model, args.temperature, m.context_window_tokens, args.top_k, args.search or "", False, coalesce=False
+    )
+    evaluate(Evaluation(rag_, args.concurrency, args.rpm, args.dry_run), args.input, args.output, args.restart)
@@ -13,38 +13,33 @@ import streamlit as st
 from langchain.memory import StreamlitChatMessageHistory
 from langchain_core.documents import Document
 
-from docbot.chains import RagChainHelper
-from docbot.constants import (
-    LLM_MODEL_DEFAULT,
-    LOGGER_NAME,
-    PROMPT_WELCOME,
-    RESPONSE_ERROR,
-)
-from docbot.vectorstore import db_vcs
+from docbot.chains import RagChainHelper, get_rag
+from docbot.constants import LLM_MODEL_DEFAULT, LOGGER_NAME, PROMPT_WELCOME, RESPONSE_ERROR
+from docbot.fe.retrival import ui_filters
+from docbot.filters import SearchFilter
+from docbot.metrics import get_metrics
 
 logger = logging.getLogger(LOGGER_NAME)
 
 
-def init_app(model_name: str, temperature: float, max_token_limit: int):
-    if not all(x in st.session_state for x in ("rag", "st_memory", "debug_info")):
-        rag = RagChainHelper(model_name, temperature, max_token_limit, db_vcs)
-        st.session_state.rag = rag
-
-        st.session_state.rag.memory.chat_memory.add_ai_message(PROMPT_WELCOME)
+def init_app(rag: RagChainHelper):
+    """Set up the session, the RAG chain is shared by all sessions, only the memory belongs to the session."""
+    if not all(x in st.session_state for x in ("memory", "st_memory", "debug_info")):
+        st.session_state.memory = rag.create_memory()
+        st.session_state.memory.chat_memory.add_ai_message(PROMPT_WELCOME)
 
         # We are using two types of memory, one RAG internal for LLM and one for ST.
         st.session_state.st_memory = StreamlitChatMessageHistory(key="langchain_messages")
         st.session_state.st_memory.add_ai_message(PROMPT_WELCOME)
 
-        st.session_state.max_query_tokens = rag.get_max_query_tokens()
         st.session_state.debug_info = []
 
 
 def clear_app_session(clear: bool = False):
     if clear:
-        st.session_state.rag.memory.clear()
+        st.session_state.memory.clear()
         st.session_state.st_memory.clear()
-        st.session_state.rag.memory.chat_memory.add_ai_message(PROMPT_WELCOME)
+        st.session_state.memory.chat_memory.add_ai_message(PROMPT_WELCOME)
         st.session_state.st_memory.add_ai_message(PROMPT_WELCOME)
         st.session_state.debug_info = []
 
@@ -62,21 +57,23 @@ def ui_settings():
         with c4:
             max_token_limit = st.number_input("Context window", value=LLM_MODEL_DEFAULT.context_window_tokens)
 
+        search_filter = ui_filters()
         show_prompt = st.checkbox("Show prompt")
         debug_context = st.checkbox("Show debug window with context", value=True)
 
-        return m, temperature, max_token_limit, show_prompt, debug_context
+        return m, temperature, max_token_limit, search_filter, show_prompt, debug_context
 
 
 def main():
     st.title("Chat with Apify's documentation")
-    model_name, temperature, max_token_limit, show_prompt, debug_enabled = ui_settings()
+    model_name, temperature, max_token_limit, search_filter, show_prompt, debug_enabled = ui_settings()
 
-    init_app(model_name, temperature, max_token_limit)
+    rag = get_rag(model_name, temperature, max_token_limit)
+    init_app(rag)
     if st.button("Clear session"):
         clear_app_session(clear=True)
 
-    show_prompt and st.write(st.session_state.rag.chain.get_prompts())
+    show_prompt and st.write(rag.chain.get_prompts())
 
     c1, c2 = st.columns(2)
     with c1:
@@ -87,21 +84,20 @@ def main():
 
     if query := st.chat_input("Type your message"):
         with c1:
-            context, response = handle_chat_message(query)
+            context, response = handle_chat_message(rag, query, search_filter)
 
         if debug_enabled:
             with c2:
                 ui_debug(query, response, context)
 
 
-def handle_chat_message(query: str):
+def handle_chat_message(rag: RagChainHelper, query: str, search_filter: SearchFilter | None = None):
     """Check that query is valid and call RAG chain."""
 
-    memory_st = st.session_state.st_memory
-    rag: RagChainHelper = st.session_state.rag
+    memory_st, memory = st.session_state.st_memory, st.session_state.memory
 
     with st.chat_message("user"):
-        if rag.llm.get_num_tokens(query) > st.session_state.max_query_tokens:
+        if not rag.token_counter.fits(query, rag.get_max_query_tokens()):
             st.error("Your query is too long, exceeding LLM context window limit, please rephrase")
             st.stop()
         memory_st.add_user_message(query)
@@ -113,9 +109,11 @@ def handle_chat_message(query: str):
         # noinspection PyBroadException
         try:
             inputs = {"question": query}
-            response = msg_placeholder.write_stream(rag.stream_with_debug(inputs, context))
+            response = msg_placeholder.write_stream(
+                rag.stream_with_debug(inputs, context, memory, search_filter=search_filter)
+            )
             memory_st.add_ai_message(response)
-            rag.memory.save_context(inputs, {"answer": response})
+            memory.save_context(inputs, {"answer": response})
         except Exception as e:
             logger.error("Error occurred when calling chain: %s", e)
             msg_placeholder.markdown(f"{response} \n\n {RESPONSE_ERROR}")
@@ -140,19 +138,57 @@ def ui_debug(query: str, answer: str, context: list[Document] | list[dict]) -> N
     standalone_question = "".join(
         d.get("standalone_question") for d in context if isinstance(d, dict) and d.get("standalone_question")
     )
+    question_path = next((d["question_path"] for d in context if isinstance(d, dict) and d.get("question_path")), "")
+    speculative = next((d["speculative"] for d in context if isinstance(d, dict) and d.get("speculative")), None)
+    packing = next((d["packing"] for d in context if isinstance(d, dict) and d.get("packing")), None)
+    selection = next((d["selection"] for d in context if isinstance(d, dict) and d.get("selection")), None)
+    compression = next((d["compression"] for d in context if isinstance(d, dict) and d.get("compression")), None)
+    metrics = next((d["metrics"] for d in context if isinstance(d, dict) and d.get("metrics")), None)
     st.session_state.debug_info.append(
         {
             "user": query,
             "assistant": answer,
             "context_md": md,
             "standalone_question": standalone_question,
+            "question_path": question_path,
+            "speculative": speculative,
+            "packing": packing,
+            "selection": selection,
+            "compression": compression,
+            "metrics": metrics,
         }
     )
 
     for i, msg in enumerate(st.session_state.debug_info):
         expanded = i == len(st.session_state.debug_info)
         with st.expander(
-            label=f"{msg.get('user')} / {msg.get('standalone_question')}",
+            label=f"{msg.get('user')} / {msg.get('standalone_question')} ({msg.get('question_path')})",
             expanded=expanded,
         ):
+            msg.get("speculative") and st.write(msg.get("speculative"))
+            msg.get("compression") and st.write({"compression": msg.get("compression")})
+            msg.get("packing") and st.write(msg.get("packing"))
+            msg.get("selection") and ui_selection(msg.get("selection"))
+            msg.get("metrics") and ui_metrics(msg.get("metrics"))
             st.write(msg.get("context_md"))
+
+
+def ui_selection(selection: list[dict]) -> None:
+    """Candidates of the adaptive retrieval: kept in the context and dropped (below threshold, elbow, duplicate)."""
+    kept = sum(c["selection"] == "kept" for c in selection)
+    st.markdown(f"**adaptive retrieval**: {kept} of {len(selection)} candidates kept")
+    st.dataframe(selection, hide_index=True)
+
+
+def ui_metrics(metrics: dict) -> None:
+    """Latency of the turn by stages (timeline of the spans), token counts and cache hits."""
+    ttft = f"{metrics['ttft']:.2f} s" if metrics.get("ttft") is not None else "-"
+    st.markdown(f"**time to first token**: {ttft}, **total**: {metrics['total']:.2f} s")
+    st.dataframe(
+        [{"stage": name, "start [s]": start, "duration [s]": duration} for name, start, duration in metrics["spans"]],
+        hide_index=True,
+    )
+    st.write({"tokens": metrics["tokens"], "cache": metrics["cache"]})
+    if llm := get_metrics().summary("docbot_llm_ttft_seconds"):
+        st.markdown("**LLM time to first token** (recent requests of the process)")
+        st.dataframe(llm, hide_index=True)
@@ -8,20 +8,22 @@
     :copyright: © 2024 by Jiri
 """
 
-import pandas as pd
 import streamlit as st
 from langchain_core.documents import Document
 
-from docbot.chains import RagChainHelper
-from docbot.constants import LLM_MODEL_DEFAULT
+from docbot.chains import get_rag, with_search_filter
+from docbot.bm25 import BM25Retriever
+from docbot.cache import get_retrieval_cache
+from docbot.constants import LLM_MODEL_DEFAULT, SEARCH_TYPES, SOURCE_TYPES
 from docbot.fe.config import UI_SEARCH_DEFAULT_K
-from docbot.vectorstore import db_vcs, retriever
+from docbot.filters import SearchFilter
+from docbot.vectorstore import get_db, get_retriever
 
 
 def main():
     st.title("Search")
 
-    k, query = ui_search()
+    k, query, search, search_filter = ui_search()
     generate_answer = st.checkbox("Generate answer")
     st.button("Search")
 
@@ -30,14 +32,8 @@ def main():
     if generate_answer:
         try:
             m = LLM_MODEL_DEFAULT
-            rag = RagChainHelper(
-                model_name=m.model_name,
-                temperature=0,
-                max_token_limit=m.context_window_tokens,
-                db=db_vcs,
-                retriever_top_k=k,
-            )
-            v = rag.chain.invoke({"question": query})
+            rag = get_rag(m.model_name, 0, m.context_window_tokens, k, search)
+            v = rag.chain.invoke({"question": query}, with_search_filter(None, search_filter))
             result = [(r, 0) for r in v.get("docs")]
             answer_placeholder.markdown(v["answer"].content)
         except Exception as e:
@@ -45,9 +41,7 @@ def main():
             st.stop()
     else:
         try:
-            result: list[tuple[Document, float]] = retriever.vectorstore.similarity_search_with_relevance_scores(
-                query, k=k
-            )
+            result: list[tuple[Document, float]] = search_with_scores(query, k, search, search_filter)
         except Exception as e:
             st.error(e)
             st.stop()
@@ -58,27 +52,73 @@ def main():
             "title": r.metadata.get("title"),
             "url": r.metadata.get("url"),
             "score": score,
+            **({"selection": r.metadata["selection"]} if "selection" in r.metadata else {}),
         }
         for r, score in result
     ]
 
     st.subheader("Search results", help="Note that score is not available when `Generate answer` is enabled")
     if results:
+        import pandas as pd
+
         df = pd.DataFrame().from_records(results)
         st.table(df)
 
 
+def search_with_scores(
+    query: str, k: int, search: str, search_filter: SearchFilter | None = None
+) -> list[tuple[Document, float]]:
+    """Search documents, score is relevance (vector), BM25 score (bm25), reciprocal rank fusion score (hybrid)
+    or cosine similarity (adaptive, dropped candidates included).
+
+    Results are cached (unless disabled by `DOCBOT_RETRIEVAL_CACHE`), the page is re-run on every interaction.
+    """
+    store_filter = search_filter.to_store_filter() if search_filter else None
+
+    def search_() -> list[tuple[Document, float]]:
+        if search == "vector":
+            kwargs = {"filter": store_filter} if store_filter else {}
+            return get_db().similarity_search_with_relevance_scores(query, k=k, **kwargs)
+        r = get_retriever(search, k, store_filter)
+        return (
+            r.get_index().search(query, k, store_filter)
+            if isinstance(r, BM25Retriever)
+            else r.search_with_scores(query)
+        )
+
+    if (cache := get_retrieval_cache()) is None:
+        return search_()
+    key = cache.key(query, k, f"{search}:scores", store_filter)
+    return list(cache.get_or_compute(key, lambda: tuple(search_())))
+
+
 def ui_search():
-    c1, c2 = st.columns([3, 1])
+    c1, c2, c3 = st.columns([3, 1, 1])
     with c1:
         query = st.text_input("Query", value="What is an Actor?")
     with c2:
         k = st.number_input("k", value=UI_SEARCH_DEFAULT_K)
-    return k, query
+    with c3:
+        search = st.selectbox("Search type", options=SEARCH_TYPES)
+    return k, query, search, ui_filters()
+
+
+def ui_filters() -> SearchFilter:
+    """Filters of the retrieved documents: source types, URL prefix and date range."""
+    c1, c2, c3, c4 = st.columns(4)
+    with c1:
+        source_types = st.multiselect("Source type", options=SOURCE_TYPES, help="All sources if empty")
+    with c2:
+        url_prefix = st.text_input("URL prefix", placeholder="docs.apify.com/platform")
+    with c3:
+        since = st.date_input("From", value=None)
+    with c4:
+        until = st.date_input("To", value=None)
+    return SearchFilter(tuple(source_types), url_prefix.strip(), since, until)
 
 
 if __name__ == "__main__":
-    retriever_ = db_vcs.as_retriever(
+    retriever_ = get_db().as_retriever(
         search_type="similarity",
         search_kwargs={"k": 3},
     )
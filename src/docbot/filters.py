@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.filters
+    ~~~~~~~~~~~~~~
+
+    Metadata filters of the retrieval: source type (e.g. documentation or Actor issues), URL prefix and date.
+
+    Ingestion stores the filterable fields with every chunk (see `index_metadata`): `source_type`,
+    `url_prefixes` (host and leading path segments of the URL) and `timestamp` (unix time of the date field).
+    `SearchFilter` is translated to the Pinecone filter language, which is pushed down into the vector store query.
+    The local vector store and the BM25 index evaluate the same filters with `MetadataIndex` (inverted index
+    of the metadata values) and score only the matching rows.
+
+    :copyright: © 2024 by Jiri
+"""
+import operator
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date, datetime, time, timezone
+from typing import Any, Hashable, Sequence
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from docbot.constants import URL_PREFIX_MAX_DEPTH
+
+SOURCE_TYPE = "source_type"
+URL_PREFIXES = "url_prefixes"
+TIMESTAMP = "timestamp"
+
+COMPARISONS = {"$gt": operator.gt, "$gte": operator.ge, "$lt": operator.lt, "$lte": operator.le}
+
+
+def url_key(url: str) -> str:
+    """Return URL without the scheme, www, query and slashes: https://www.apify.com/store/ -> apify.com/store"""
+    parts = urlsplit(url.strip() if "://" in url else f"//{url.strip()}")
+    host = parts.netloc.lower().removeprefix("www.")
+    return "/".join([host, *(s for s in parts.path.split("/") if s)])
+
+
+def url_prefixes(url: str, max_depth: int = URL_PREFIX_MAX_DEPTH) -> list[str]:
+    """Return the host and the URL prefixes up to `max_depth` path segments, the values matched by the URL filter."""
+    parts = url_key(url).split("/")[: max_depth + 1]
+    return ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+def parse_timestamp(value: Any) -> int | None:
+    """Return unix time of an ISO date or datetime (UTC if without the time zone), None if it cannot be parsed."""
+    try:
+        dt = datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+    return int((dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp())
+
+
+def index_metadata(metadata: dict, source_type: str, date_field: str | None = None) -> dict:
+    """Return metadata with the filterable fields: source type, URL prefixes (of `url`) and timestamp."""
+    metadata = {**metadata, SOURCE_TYPE: source_type}
+    if url := metadata.get("url"):
+        metadata[URL_PREFIXES] = url_prefixes(str(url))
+    if date_field and (timestamp := parse_timestamp(metadata.get(date_field))) is not None:
+        metadata[TIMESTAMP] = timestamp
+    return metadata
+
+
+@dataclass(frozen=True)
+class SearchFilter:
+    """Filter of the retrieved documents, the empty filter matches everything.
+
+    The URL prefix matches whole path segments (at most `URL_PREFIX_MAX_DEPTH`), the dates are inclusive.
+    """
+
+    source_types: tuple[str, ...] = ()
+    url_prefix: str = ""
+    since: date | None = None
+    until: date | None = None
+
+    def __bool__(self) -> bool:
+        return bool(self.source_types or self.url_prefix or self.since or self.until)
+
+    def to_store_filter(self) -> dict | None:
+        """Return the filter in the Pinecone filter language (conditions of all fields must match)."""
+        result: dict[str, dict] = {}
+        if self.source_types:
+            result[SOURCE_TYPE] = {"$in": list(self.source_types)}
+        if self.url_prefix:
+            result[URL_PREFIXES] = {"$eq": url_prefixes(self.url_prefix)[-1]}
+        if self.since or self.until:
+            result[TIMESTAMP] = {}
+            if self.since:
+                result[TIMESTAMP]["$gte"] = int(datetime.combine(self.since, time.min, timezone.utc).timestamp())
+            if self.until:
+                result[TIMESTAMP]["$lte"] = int(datetime.combine(self.until, time.max, timezone.utc).timestamp())
+        return result or None
+
+    def as_dict(self) -> dict:
+        return {
+            "source_types": list(self.source_types),
+            "url_prefix": self.url_prefix,
+            "since": self.since and self.since.isoformat(),
+            "until": self.until and self.until.isoformat(),
+        }
+
+
+class MetadataIndex:
+    """Inverted index of the metadata values, evaluates filters without a scan of the metadata.
+
+    Supports the subset of the Pinecone filter language: `{"field": value}`, `$eq`, `$ne`, `$in`, `$nin`,
+    `$gt`, `$gte`, `$lt`, `$lte` and `$and`. A list value matches if any of its items matches.
+    """
+
+    def __init__(self, metadatas: Sequence[dict]):
+        self.metadatas = metadatas
+        self._values: dict[str, dict[Hashable, np.ndarray]] = {}
+        self._numbers: dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.metadatas)
+
+    def values(self, field: str) -> dict[Hashable, np.ndarray]:
+        """Return rows of every value of the field, built on the first use."""
+        if (index := self._values.get(field)) is None:
+            rows: dict[Hashable, list[int]] = defaultdict(list)
+            for i, m in enumerate(self.metadatas):
+                value = m.get(field)
+                for v in value if isinstance(value, list) else [value]:
+                    if v is not None and isinstance(v, Hashable):
+                        rows[v].append(i)
+            index = self._values[field] = {v: np.asarray(r, dtype=np.int64) for v, r in rows.items()}
+        return index
+
+    def numbers(self, field: str) -> np.ndarray:
+        """Return numeric values of the field (NaN if missing), built on the first use."""
+        if (column := self._numbers.get(field)) is None:
+            values = (m.get(field) for m in self.metadatas)
+            column = np.fromiter(
+                (v if isinstance(v, (int, float)) else np.nan for v in values), dtype=np.float64, count=len(self)
+            )
+            self._numbers[field] = column
+        return column
+
+    def mask(self, filter: dict) -> np.ndarray:
+        """Return boolean mask of the rows matching the filter."""
+        mask = np.ones(len(self), dtype=bool)
+        for field, condition in filter.items():
+            if field == "$and":
+                for f in condition:
+                    mask &= self.mask(f)
+                continue
+            for op, value in (condition if isinstance(condition, dict) else {"$eq": condition}).items():
+                mask &= self._match(field, op, value)
+        return mask
+
+    def _match(self, field: str, op: str, value: Any) -> np.ndarray:
+        if op in COMPARISONS:
+            with np.errstate(invalid="ignore"):
+                return COMPARISONS[op](self.numbers(field), value)
+        if op not in ("$eq", "$ne", "$in", "$nin"):
+            raise ValueError(f"Unsupported filter operator: {op}")
+
+        mask = np.zeros(len(self), dtype=bool)
+        index = self.values(field)
+        for v in value if op in ("$in", "$nin") else [value]:
+            if (rows := index.get(v)) is not None:
+                mask[rows] = True
+        return ~mask if op in ("$ne", "$nin") else mask
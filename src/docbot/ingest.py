@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.ingest
+    ~~~~~~~~~~~~~
+
+    Bulk ingestion of documents into the vector store.
+
+    Records are streamed from a CSV or JSON lines file, split into overlapping token chunks
+    (`CHUNK_SIZE`, `CHUNK_OVERLAP`), embedded in batches by concurrent workers under a tokens-per-minute
+    rate limit and upserted by a single writer. The stages are connected by bounded queues, so the memory
+    does not grow with the size of the input.
+
+    Progress is checkpointed, an interrupted run continues from the last checkpoint. Chunk ids are derived
+    from the source and the record id (`source:id-n`), so records processed again after the resume are overwritten,
+    not duplicated, and sources sharing record ids do not overwrite each other.
+
+    Re-ingestion is incremental: the manifest keeps content hashes of the ingested chunks, only new or changed
+    chunks are embedded and chunks which disappeared from the source are deleted from the vector store.
+    An existing BM25 index (see `docbot.bm25`) is rebuilt after ingesting into the local store, for Pinecone
+    it must be rebuilt from a local snapshot.
+
+        python -m docbot.ingest issues.csv --text-field issue --id-field id --metadata-fields url title created_at \\
+            --source-type issues --date-field created_at
+
+    :copyright: © 2024 by Jiri
+"""
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Iterator, Protocol
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from docbot.clients import RateLimiter, close_openai_async_client
+from docbot.constants import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    EMBEDDING_MODEL,
+    INGEST_BATCH_SIZE,
+    INGEST_CHECKPOINT_INTERVAL,
+    INGEST_CONCURRENCY,
+    INGEST_LOCAL_SAVE_BATCHES,
+    INGEST_TOKENS_PER_MINUTE,
+    LOGGER_NAME,
+    PINECONE_UPSERT_MAX_BYTES,
+    PINECONE_UPSERT_MAX_VECTORS,
+)
+from docbot.filters import index_metadata
+from docbot.localstore import LocalVectorStore
+
+logger = logging.getLogger(LOGGER_NAME)
+
+Record = tuple[str, str, dict]  # id, text, metadata
+STATS = ("added", "changed", "unchanged", "removed")
+
+
+class Encoding(Protocol):
+    def encode_ordinary(self, text: str) -> list[int]:
+        ...
+
+    def decode(self, tokens: list[int]) -> str:
+        ...
+
+
+def read_records(
+    path: Path,
+    text_field: str,
+    id_field: str | None = None,
+    metadata_fields: Iterable[str] = (),
+    line_separator: str | None = None,
+    source_type: str | None = None,
+    date_field: str | None = None,
+) -> Iterator[Record]:
+    """Stream records from a CSV or JSON lines file (by suffix), one at a time.
+
+    Record id is the value of `id_field` or the record number. `line_separator` is replaced by a newline.
+    The metadata includes the filterable fields (see `docbot.filters`), the source type defaults to the file name
+    without the suffix.
+    """
+    csv.field_size_limit(sys.maxsize)
+    with open(path, encoding="utf-8", newline="") as f:
+        rows = map(json.loads, filter(str.strip, f)) if path.suffix == ".jsonl" else csv.DictReader(f)
+        for n, row in enumerate(rows):
+            text = str(row.get(text_field) or "")
+            if line_separator:
+                text = text.replace(line_separator, "\n")
+            metadata = {"source": path.name, **{k: row[k] for k in metadata_fields if row.get(k) is not None}}
+            metadata = index_metadata(metadata, source_type or path.stem, date_field)
+            yield str(row[id_field]) if id_field else f"{path.stem}-{n}", text, metadata
+
+
+class TokenChunker:
+    """Split text into chunks of `size` tokens, consecutive chunks share `overlap` tokens."""
+
+    def __init__(self, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP, encoding: Encoding | None = None):
+        if not 0 <= overlap < size:
+            raise ValueError(f"Chunk overlap must be smaller than the chunk size, got {overlap=} {size=}")
+        self.size = size
+        self.overlap = overlap
+        self._encoding = encoding
+
+    @property
+    def encoding(self) -> Encoding:
+        if self._encoding is None:
+            import tiktoken
+
+            self._encoding = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+        return self._encoding
+
+    def split(self, text: str) -> list[tuple[str, int]]:
+        """Return chunks and their number of tokens."""
+        tokens = self.encoding.encode_ordinary(text)
+        starts = range(0, max(len(tokens) - self.overlap, 1), self.size - self.overlap) if tokens else ()
+        return [(self.encoding.decode(t), len(t)) for t in (tokens[s : s + self.size] for s in starts)]
+
+
+def chunk_id(source: str, record_id: str, n: int) -> str:
+    """Vector id of the n-th chunk of a record, namespaced by the source (record ids are unique per source only)."""
+    return f"{source}:{record_id}-{n}"
+
+
+def content_hash(text: str, metadata: dict) -> str:
+    """Hash of everything stored with the vector, a chunk is re-embedded when the hash changes."""
+    content = json.dumps([EMBEDDING_MODEL, text, metadata], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class Manifest:
+    """Content hashes of the ingested chunks (SQLite), per source.
+
+    Every ingestion run marks the chunks it has seen with the run id, chunks of the ingested sources
+    not seen by the run are stale (removed from the source).
+    """
+
+    def __init__(self, path: Path | str):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (source TEXT NOT NULL, id TEXT NOT NULL, hash TEXT NOT NULL, "
+            "run INTEGER NOT NULL, PRIMARY KEY (source, id))"
+        )
+
+    def get(self, source: str, ids: list[str]) -> dict[str, str]:
+        """Return hashes of the known chunks."""
+        sql = f"SELECT id, hash FROM chunks WHERE source = ? AND id IN ({','.join('?' * len(ids))})"
+        with self._lock:
+            return dict(self._db.execute(sql, [source, *ids]).fetchall()) if ids else {}
+
+    def put(self, chunks: list[tuple[str, str, str]], run: int) -> None:
+        """Store (source, id, hash) of the chunks seen by the run."""
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO chunks (source, id, hash, run) VALUES (?, ?, ?, ?)",
+                [(*c, run) for c in chunks],
+            )
+            self._db.execute("COMMIT")
+
+    def stale(self, sources: list[str], run: int) -> list[str]:
+        """Return ids of the chunks of the sources not seen by the run."""
+        sql = f"SELECT id FROM chunks WHERE source IN ({','.join('?' * len(sources))}) AND run != ?"
+        with self._lock:
+            return [id_ for (id_,) in self._db.execute(sql, [*sources, run])] if sources else []
+
+    def delete(self, sources: list[str], run: int) -> None:
+        sql = f"DELETE FROM chunks WHERE source IN ({','.join('?' * len(sources))}) AND run != ?"
+        with self._lock:
+            sources and self._db.execute(sql, [*sources, run])
+
+
+@dataclass
+class Batch:
+    ids: list[str] = field(default_factory=list)
+    texts: list[str] = field(default_factory=list)
+    metadatas: list[dict] = field(default_factory=list)
+    hashes: list[str] = field(default_factory=list)
+    tokens: int = 0
+    seq: int = 0
+    records: int = 0  # number of records completed when the batch was sealed
+    stats: Counter[str] = field(default_factory=Counter)  # added, changed and unchanged chunks
+    seen: list[tuple[str, str, str]] = field(default_factory=list)  # manifest entries (source, id, hash)
+    vectors: np.ndarray | None = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, id_: str, text: str, metadata: dict, hash_: str, tokens: int) -> None:
+        self.ids.append(id_)
+        self.texts.append(text)
+        self.metadatas.append(metadata)
+        self.hashes.append(hash_)
+        self.tokens += tokens
+
+
+def upsert_requests(
+    vectors: list[dict], max_vectors: int = PINECONE_UPSERT_MAX_VECTORS, max_bytes: int = PINECONE_UPSERT_MAX_BYTES
+) -> Iterator[list[dict]]:
+    """Split Pinecone vectors into upsert requests within the limits of vectors and bytes (JSON size) per request."""
+    request, size = [], 0
+    for v in vectors:
+        n = len(json.dumps(v, ensure_ascii=False, default=str))
+        if request and (len(request) == max_vectors or size + n > max_bytes):
+            yield request
+            request, size = [], 0
+        request.append(v)
+        size += n
+    if request:
+        yield request
+
+
+class StoreWriter:
+    """Upsert embedded batches into the vector store.
+
+    The local store is saved as a whole snapshot, batches are therefore kept until `flush` adds them in memory
+    and the snapshot is written every `save_every` batches and by the final flush only.
+    Pinecone vectors are upserted directly, other stores embed the texts again using `add_texts`.
+    """
+
+    def __init__(self, store: VectorStore, save_every: int = INGEST_LOCAL_SAVE_BATCHES):
+        self.store = store
+        self.save_every = save_every
+        self._pending: list[Batch] = []
+        self._unsaved = 0  # batches added to the local store since the last snapshot
+
+    def write(self, batch: Batch) -> None:
+        if isinstance(self.store, LocalVectorStore):
+            self._pending.append(batch)
+            return
+
+        from langchain_pinecone import PineconeVectorStore
+
+        if isinstance(self.store, PineconeVectorStore):
+            vectors = [
+                {"id": id_, "values": v.tolist(), "metadata": {**m, self.store._text_key: t}}
+                for id_, t, m, v in zip(batch.ids, batch.texts, batch.metadatas, batch.vectors)
+            ]
+            for request in upsert_requests(vectors):
+                self.store._index.upsert(vectors=request, namespace=self.store._namespace)
+        else:
+            self.store.add_texts(batch.texts, batch.metadatas, ids=batch.ids)
+
+    def flush(self, final: bool = False) -> bool:
+        """Add the pending batches to the local store, return True if all written batches are persisted."""
+        if b := self._pending:
+            self.store.add_vectors(
+                np.concatenate([x.vectors for x in b]),
+                [t for x in b for t in x.texts],
+                [m for x in b for m in x.metadatas],
+                [i for x in b for i in x.ids],
+                save=False,
+            )
+            self._unsaved += len(b)
+            self._pending = []
+        if self._unsaved and (final or self._unsaved >= self.save_every):
+            self.store.save()
+            self._unsaved = 0
+        return not self._unsaved
+
+
+def load_checkpoint(path: Path, params: dict, restart: bool = False) -> dict:
+    """Return saved progress if the checkpoint was created with the same parameters, otherwise start over."""
+    if path.exists() and not restart:
+        state = json.loads(path.read_text(encoding="utf-8"))
+        if state.get("params") == params:
+            return state
+        logger.warning("Checkpoint %s was created with different parameters, starting from the beginning", path)
+    return {
+        "params": params,
+        "run": time.time_ns(),
+        "records": 0,
+        "sources": [],
+        **dict.fromkeys(STATS, 0),
+        "done": False,
+    }
+
+
+def save_checkpoint(path: Path, state: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.with_suffix(".tmp").write_text(json.dumps(state), encoding="utf-8")
+    os.replace(path.with_suffix(".tmp"), path)
+
+
+class Ingestion:
+    """Pipeline: read and chunk records -> embed batches (concurrent workers) -> upsert (single writer)."""
+
+    def __init__(
+        self,
+        store: VectorStore,
+        embeddings: Embeddings,
+        chunker: TokenChunker | None = None,
+        batch_size: int = INGEST_BATCH_SIZE,
+        concurrency: int = INGEST_CONCURRENCY,
+        tokens_per_minute: int = INGEST_TOKENS_PER_MINUTE,
+        checkpoint: Path | None = None,
+        checkpoint_interval: float = INGEST_CHECKPOINT_INTERVAL,
+        manifest: Manifest | None = None,
+    ):
+        self.store = store
+        self.writer = StoreWriter(store)
+        self.embeddings = embeddings
+        self.chunker = chunker or TokenChunker()
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(tokens_per_minute)
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.manifest = manifest
+
+    async def run(self, records: Iterable[Record], state: dict) -> dict:
+        """Ingest records following the `state["records"]` already ingested ones, return the final state."""
+        # bounded queues: reading stops when the embedding or upsert falls behind
+        self._batches: asyncio.Queue[Batch | None] = asyncio.Queue(maxsize=2 * self.concurrency)
+        self._embedded: asyncio.Queue[Batch | None] = asyncio.Queue(maxsize=2 * self.concurrency)
+        self._state, self._seq, self._started = state, 0, time.monotonic()
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(self._produce(records, state["records"]))
+                tg.create_task(self._embed_all())
+                tg.create_task(self._upsert())
+        finally:
+            await close_openai_async_client()
+        return state
+
+    async def _put(self, batch: Batch, records: int) -> None:
+        batch.seq, batch.records = self._seq, records
+        self._seq += 1
+        await self._batches.put(batch)
+
+    async def _produce(self, records: Iterable[Record], offset: int) -> None:
+        batch, completed, sources = Batch(), offset, self._state["sources"]
+        for n, (id_, text, metadata) in enumerate(records):
+            if n < offset:
+                continue
+            if (source := metadata.get("source", "")) not in sources:
+                sources.append(source)
+            chunks = self.chunker.split(text)
+            ids = [chunk_id(source, id_, i) for i in range(len(chunks))]
+            known = self.manifest.get(source, ids) if self.manifest else {}
+            for i, (cid, (chunk, tokens)) in enumerate(zip(ids, chunks)):
+                metadata_ = {**metadata, "chunk": i}
+                hash_ = content_hash(chunk, metadata_)
+                # unchanged chunks are not embedded, but they are tracked by the batch as well
+                if len(batch) == self.batch_size or len(batch.seen) == 10 * self.batch_size:
+                    await self._put(batch, completed)
+                    batch = Batch()
+                batch.seen.append((source, cid, hash_))
+                if known.get(cid) == hash_:
+                    batch.stats["unchanged"] += 1
+                    continue
+                batch.stats["changed" if cid in known else "added"] += 1
+                batch.add(cid, chunk, metadata_, hash_, tokens)
+            completed = n + 1
+        await self._put(batch, completed)
+        for _ in range(self.concurrency):
+            await self._batches.put(None)
+
+    async def _embed(self) -> None:
+        while (batch := await self._batches.get()) is not None:
+            if len(batch):
+                await self.limiter.acquire(batch.tokens)
+                batch.vectors = np.asarray(await self.embeddings.aembed_documents(batch.texts), dtype=np.float32)
+            await self._embedded.put(batch)
+
+    async def _embed_all(self) -> None:
+        await asyncio.gather(*(self._embed() for _ in range(self.concurrency)))
+        await self._embedded.put(None)
+
+    async def _upsert(self) -> None:
+        # batches arrive out of order, the checkpoint covers only the batches with all predecessors written
+        # the manifest is updated together with the checkpoint, after the vectors are flushed to the store
+        done: dict[int, Batch] = {}
+        seen: list[tuple[str, str, str]] = []
+        next_seq, last_checkpoint = 0, time.monotonic()
+        while (batch := await self._embedded.get()) is not None:
+            if len(batch):
+                await asyncio.to_thread(self.writer.write, batch)
+            seen.extend(batch.seen)
+            done[batch.seq] = batch
+            while next_seq in done:
+                b = done.pop(next_seq)
+                self._state["records"] = b.records
+                for k in STATS:
+                    self._state[k] += b.stats[k]
+                next_seq += 1
+            if time.monotonic() - last_checkpoint > self.checkpoint_interval:
+                if await asyncio.to_thread(self._checkpoint, seen):
+                    seen = []
+                last_checkpoint = time.monotonic()
+
+        await asyncio.to_thread(self._checkpoint, seen, True)
+        await asyncio.to_thread(self._remove_stale)
+
+    def _checkpoint(self, seen: list[tuple[str, str, str]], final: bool = False) -> bool:
+        """Save the progress, return False if it was not saved because the local store snapshot is behind."""
+        # the manifest and checkpoint must not get ahead of the vectors persisted in the store
+        if saved := self.writer.flush(final):
+            if self.manifest:
+                self.manifest.put(seen, self._state["run"])
+            if self.checkpoint:
+                save_checkpoint(self.checkpoint, self._state)
+        elapsed = time.monotonic() - self._started
+        written = self._state["added"] + self._state["changed"]
+        logger.info(
+            "Ingested %s records, %s chunks embedded (%.1f chunks/s), %s unchanged",
+            self._state["records"],
+            written,
+            written / elapsed if elapsed else 0,
+            self._state["unchanged"],
+        )
+        return saved
+
+    def _remove_stale(self) -> None:
+        """Delete chunks which are no longer in the ingested sources and finish the run."""
+        if self.manifest:
+            sources, run = self._state["sources"], self._state["run"]
+            if stale := self.manifest.stale(sources, run):
+                self.store.delete(stale)
+            self.manifest.delete(sources, run)
+            self._state["removed"] = len(stale)
+        self._state["done"] = True
+        if self.checkpoint:
+            save_checkpoint(self.checkpoint, self._state)
+        logger.info("Chunks %s", ", ".join(f"{k}: {self._state[k]}" for k in STATS))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from docbot.bm25 import rebuild_index
+    from docbot.cache import bump_index_version
+    from docbot.config import get_config
+    from docbot.constants import BM25_INDEX_DIR, INGEST_CHECKPOINT_DIR, INGEST_MANIFEST_FILE
+    from docbot.vectorstore import get_db, get_embeddings
+
+    parser = argparse.ArgumentParser(description="Ingest a CSV or JSON lines file into the vector store")
+    parser.add_argument("input", type=Path, help="CSV or JSON lines (.jsonl) file")
+    parser.add_argument("--text-field", default="text", help="Field with the document text")
+    parser.add_argument("--id-field", help="Field with a unique record id (default: record number)")
+    parser.add_argument("--metadata-fields", nargs="*", default=[], help="Fields stored as metadata")
+    parser.add_argument("--line-separator", help="Separator replaced by a newline, e.g. '=>'")
+    parser.add_argument("--source-type", help="Source type for the filters, e.g. docs, issues (default: file name)")
+    parser.add_argument("--date-field", help="Metadata field with the date for the filters (ISO format)")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="Chunks per embedding request")
+    parser.add_argument("--concurrency", type=int, default=INGEST_CONCURRENCY, help="Concurrent embedding requests")
+    parser.add_argument("--tpm", type=int, default=INGEST_TOKENS_PER_MINUTE, help="Embedding tokens per minute")
+    parser.add_argument("--checkpoint", type=Path, help="Checkpoint file (default: in the data directory)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the beginning")
+    parser.add_argument("--manifest", type=Path, help="Manifest of ingested chunks (default: in the data directory)")
+    args = parser.parse_args()
+
+    config = get_config()
+    checkpoint_ = args.checkpoint or config.DATA_DIR / INGEST_CHECKPOINT_DIR / f"{args.input.name}.json"
+    manifest_ = args.manifest or config.DATA_DIR / INGEST_CHECKPOINT_DIR / INGEST_MANIFEST_FILE.format(
+        store=config.VECTOR_STORE
+    )
+    stat = args.input.stat()
+    params_ = {
+        "input": str(args.input.resolve()),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "text_field": args.text_field,
+        "id_field": args.id_field,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+    }
+    state_ = load_checkpoint(checkpoint_, params_, restart=args.restart)
+    if state_["done"]:
+        logger.info("%s is already ingested, use --restart to ingest it again", args.input)
+        sys.exit(0)
+    if state_["records"]:
+        logger.info("Resuming %s after %s records", args.input, state_["records"])
+
+    # bulk vectors bypass the embedding cache, they would evict the cached queries
+    ingestion = Ingestion(
+        get_db(),
+        get_embeddings().embeddings,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        tokens_per_minute=args.tpm,
+        checkpoint=checkpoint_,
+        manifest=Manifest(manifest_),
+    )
+    records_ = read_records(
+        args.input,
+        args.text_field,
+        args.id_field,
+        args.metadata_fields,
+        args.line_separator,
+        args.source_type,
+        args.date_field,
+    )
+    state_ = asyncio.run(ingestion.run(records_, state_))
+    if state_["added"] or state_["changed"] or state_["removed"]:
+        if (bm25_dir := config.DATA_DIR / BM25_INDEX_DIR).exists():
+            if isinstance(ingestion.store, LocalVectorStore):
+                rebuild_index(ingestion.store, bm25_dir)
+            else:
+                logger.warning(
+                    "BM25 index %s is outdated, snapshot the index (`python -m docbot.localstore`) and rebuild it "
+                    "(`python -m docbot.bm25`)",
+                    bm25_dir,
+                )
+        bump_index_version()
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.localstore
+    ~~~~~~~~~~~~~~~~~
+
+    Local in-process vector store - an alternative to Pinecone.
+
+    Vectors are stored as a contiguous float32 matrix (`vectors.npy`, memory-mapped on load) and documents
+    (id, text, metadata) in a JSON lines sidecar (`metadata.jsonl`), one line per matrix row.
+
+    Optionally (`DOCBOT_VECTOR_QUANTIZATION`), the first pass scans a compact copy of the vectors kept in memory:
+    int8 codes (4x smaller) or sign bits (32x smaller, Hamming distance). The best candidates are rescored with
+    the full-precision vectors, only their rows of the memory-mapped matrix are read. The quantized copy is saved
+    next to the vectors (`vectors.int8.npz`, `vectors.binary.npz`) or built on load if missing or outdated.
+
+    Snapshot the Pinecone index into the local format:
+
+        python -m docbot.localstore --out .docbot/index
+
+    :copyright: © 2024 by Jiri
+"""
+import json
+import logging
+import os
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from docbot.constants import LOCAL_INDEX_SCAN_ROWS, LOGGER_NAME, QUANTIZATION_OVERSAMPLING
+from docbot.filters import MetadataIndex
+
+logger = logging.getLogger(LOGGER_NAME)
+
+VECTORS_FILE = "vectors.npy"
+METADATA_FILE = "metadata.jsonl"
+QUANTIZED_FILE = "vectors.{method}.npz"
+
+# number of set bits of every byte, for the Hamming distance of the binary codes
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize rows so that the dot product equals the cosine similarity."""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return (vectors / np.where(norms == 0, 1, norms)).astype(np.float32)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Return indices of the k highest scores, sorted by score (descending)."""
+    if k >= len(scores):
+        return np.argsort(-scores)
+    idx = np.argpartition(-scores, k)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+@dataclass
+class QuantizedVectors:
+    """Compact copy of the vectors for the first-pass scan.
+
+    int8: codes with a per-dimension scale, binary: sign bits packed into bytes.
+    """
+
+    method: str
+    codes: np.ndarray
+    scale: np.ndarray  # per-dimension scale (int8), empty (binary)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scale.nbytes
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, method: str, rows: int = LOCAL_INDEX_SCAN_ROWS) -> "QuantizedVectors":
+        """Quantize the (normalized) vectors block by block, the memory-mapped vectors are not loaded at once."""
+        blocks = range(0, len(vectors), rows)
+        if method == "binary":
+            codes = np.empty((len(vectors), (vectors.shape[1] + 7) // 8), dtype=np.uint8)
+            for i in blocks:
+                codes[i : i + rows] = np.packbits(vectors[i : i + rows] > 0, axis=1)
+            return cls(method, codes, np.empty(0, dtype=np.float32))
+        if method != "int8":
+            raise ValueError(f"Unknown quantization: {method}")
+
+        scale = np.zeros(vectors.shape[1], dtype=np.float32)
+        for i in blocks:
+            scale = np.maximum(scale, np.abs(vectors[i : i + rows]).max(axis=0))
+        scale = np.where(scale == 0, 1, scale) / 127
+        codes = np.empty(vectors.shape, dtype=np.int8)
+        for i in blocks:
+            codes[i : i + rows] = np.rint(vectors[i : i + rows] / scale)
+        return cls(method, codes, scale.astype(np.float32))
+
+    def scores(
+        self, query: np.ndarray, subset: np.ndarray | None = None, rows: int = LOCAL_INDEX_SCAN_ROWS
+    ) -> np.ndarray:
+        """Return approximate similarity of the vectors (all or the subset) to the normalized query.
+
+        Higher is more similar.
+        """
+        codes = self.codes if subset is None else self.codes[subset]
+        scores = np.empty(len(codes), dtype=np.float32)
+        if self.method == "int8":
+            q = query * self.scale
+            for i in range(0, len(codes), rows):
+                scores[i : i + rows] = codes[i : i + rows] @ q
+        else:
+            q = np.packbits(query > 0)
+            for i in range(0, len(codes), rows):
+                scores[i : i + rows] = -POPCOUNT[codes[i : i + rows] ^ q].sum(axis=1, dtype=np.int32)
+        return scores
+
+    def save(self, path: Path) -> None:
+        with open(path.with_name(f"{path.name}.tmp"), "wb") as f:
+            np.savez(f, codes=self.codes, scale=self.scale)
+        os.replace(path.with_name(f"{path.name}.tmp"), path)
+
+    @classmethod
+    def load(cls, path: Path, method: str) -> "QuantizedVectors":
+        with np.load(path) as data:
+            return cls(method, data["codes"], data["scale"])
+
+
+class LocalVectorStore(VectorStore):
+    """Vector store kept in memory, searched with cosine similarity (vectorized NumPy top-k).
+
+    The store is read from `path` if it exists. Changes (`add_texts`, `delete`) are written back to `path`.
+    With `quantization` (int8 or binary), the search scans the quantized vectors and rescores
+    `oversampling * k` best candidates with the full-precision vectors. With a metadata filter
+    (see `docbot.filters.MetadataIndex`), only the matching rows are scored.
+    """
+
+    def __init__(
+        self, path: Path | str, embedding: Embeddings, quantization: str = "none", oversampling: int | None = None
+    ):
+        self.path = Path(path)
+        self._embedding = embedding
+        self.quantization = quantization
+        self.oversampling = oversampling or QUANTIZATION_OVERSAMPLING.get(quantization, 1)
+        self.ids: list[str] = []
+        self.texts: list[str] = []
+        self.metadatas: list[dict] = []
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self._quantized: QuantizedVectors | None = None
+        self._metadata_index: MetadataIndex | None = None
+        self.load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def load(self) -> None:
+        if not (self.path / VECTORS_FILE).exists():
+            logger.warning("Local vector store %s does not exist, starting with an empty store", self.path)
+            return
+
+        self.vectors = np.load(self.path / VECTORS_FILE, mmap_mode="r")
+        self.ids, self.texts, self.metadatas = [], [], []
+        with open(self.path / METADATA_FILE, encoding="utf-8") as f:
+            for line in f:
+                d = json.loads(line)
+                self.ids.append(d["id"])
+                self.texts.append(d["text"])
+                self.metadatas.append(d["metadata"])
+        self._metadata_index = None
+        logger.info("Local vector store loaded: %s vectors, %s dims", *self.vectors.shape)
+        if self.quantization != "none":
+            if (quantized := self._load_quantized()) is None:
+                self.save_quantized()
+            else:
+                self._quantized = quantized
+            logger.info(
+                "Quantized vectors (%s): %.1f MB in memory instead of %.1f MB",
+                self.quantization,
+                self.quantized.nbytes / 2**20,
+                self.vectors.nbytes / 2**20,
+            )
+
+    @property
+    def quantized_path(self) -> Path:
+        return self.path / QUANTIZED_FILE.format(method=self.quantization)
+
+    def _load_quantized(self) -> QuantizedVectors | None:
+        """Return the saved quantized vectors, None if they are missing or older than the vectors."""
+        path = self.quantized_path
+        if not path.exists() or path.stat().st_mtime < (self.path / VECTORS_FILE).stat().st_mtime:
+            return None
+        quantized = QuantizedVectors.load(path, self.quantization)
+        return quantized if len(quantized) == len(self.ids) else None
+
+    @property
+    def quantized(self) -> QuantizedVectors:
+        """Quantized vectors, built on the first use after the vectors changed."""
+        if self._quantized is None or len(self._quantized) != len(self.ids):
+            self._quantized = QuantizedVectors.build(self.vectors, self.quantization)
+        return self._quantized
+
+    def save_quantized(self) -> None:
+        try:
+            self.quantized.save(self.quantized_path)
+        except OSError as e:  # e.g. read-only index in the container, keep it in memory only
+            logger.warning("Quantized vectors %s not saved: %s", self.quantized_path, e)
+
+    def save(self) -> None:
+        """Write vectors and metadata to disk (atomically replace the old files) and memory-map the new vectors."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / f"{VECTORS_FILE}.tmp", "wb") as f:
+            np.save(f, np.ascontiguousarray(self.vectors, dtype=np.float32))
+        with open(self.path / f"{METADATA_FILE}.tmp", "w", encoding="utf-8") as f:
+            for id_, text, metadata in zip(self.ids, self.texts, self.metadatas):
+                f.write(json.dumps({"id": id_, "text": text, "metadata": metadata}, ensure_ascii=False) + "\n")
+        os.replace(self.path / f"{VECTORS_FILE}.tmp", self.path / VECTORS_FILE)
+        os.replace(self.path / f"{METADATA_FILE}.tmp", self.path / METADATA_FILE)
+        self.vectors = np.load(self.path / VECTORS_FILE, mmap_mode="r")
+        if self.quantization != "none" and self.ids:
+            self.save_quantized()
+
+    def add_vectors(
+        self, vectors: np.ndarray, texts: list[str], metadatas: list[dict], ids: list[str], save: bool = True
+    ) -> list[str]:
+        """Add precomputed vectors, replace rows with existing ids."""
+        if existing := set(ids) & set(self.ids):
+            self.delete(list(existing), save=False)
+
+        vectors = normalize(np.asarray(vectors, dtype=np.float32))
+        self.vectors = np.concatenate([self.vectors, vectors]) if len(self.ids) else vectors
+        self.ids.extend(ids)
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas)
+        self._quantized = None
+        self._metadata_index = None
+        save and self.save()
+        return ids
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: list[dict] | None = None,
+        ids: list[str] | None = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        vectors = np.asarray(self._embedding.embed_documents(texts), dtype=np.float32)
+        return self.add_vectors(vectors, texts, metadatas, ids)
+
+    def delete(self, ids: list[str] | None = None, save: bool = True, **kwargs: Any) -> bool | None:
+        if not ids:
+            return False
+        ids_ = set(ids)
+        keep = [i for i, id_ in enumerate(self.ids) if id_ not in ids_]
+        self.vectors = np.asarray(self.vectors[keep])
+        self.ids = [self.ids[i] for i in keep]
+        self.texts = [self.texts[i] for i in keep]
+        self.metadatas = [self.metadatas[i] for i in keep]
+        self._quantized = None
+        self._metadata_index = None
+        save and self.save()
+        return True
+
+    @property
+    def metadata_index(self) -> MetadataIndex:
+        if self._metadata_index is None:
+            self._metadata_index = MetadataIndex(self.metadatas)
+        return self._metadata_index
+
+    def _search(self, embedding: list[float], k: int, filter: dict | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Return rows of the k most similar vectors and their scores, with the filter only the matching rows are scored."""
+        q = normalize(np.asarray(embedding, dtype=np.float32))
+        subset = np.flatnonzero(self.metadata_index.mask(filter)) if filter else None
+        rows = np.arange(len(self.ids)) if subset is None else subset
+        if self.quantization == "none":
+            scores = (self.vectors if subset is None else self.vectors[rows]) @ q
+        else:
+            # rescore the best candidates with the full-precision vectors, read in the file order
+            rows = rows[np.sort(top_k(self.quantized.scores(q, subset), k * self.oversampling))]
+            scores = np.asarray(self.vectors[rows]) @ q
+        best = top_k(scores, k)
+        return rows[best], scores[best]
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: list[float], k: int = 4, filter: dict | None = None, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        """Return the k most similar documents with the cosine similarity."""
+        if not self.ids:
+            return []
+        rows, scores = self._search(embedding, k, filter)
+        return [
+            (Document(page_content=self.texts[r], metadata=self.metadatas[r]), float(s)) for r, s in zip(rows, scores)
+        ]
+
+    def similarity_search_with_vectors(
+        self, embedding: list[float], k: int = 4, filter: dict | None = None
+    ) -> tuple[list[Document], np.ndarray, np.ndarray]:
+        """Return the k most similar documents, their cosine similarities and (normalized) vectors."""
+        if not self.ids:
+            return [], np.zeros(0, dtype=np.float32), np.zeros((0, self.vectors.shape[1]), dtype=np.float32)
+        rows, scores = self._search(embedding, k, filter)
+        docs = [Document(page_content=self.texts[r], metadata=self.metadatas[r]) for r in rows]
+        return docs, scores, np.asarray(self.vectors[rows])
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: dict | None = None, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k, filter, **kwargs)
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, **kwargs: Any) -> list[Document]:
+        return [d for d, _ in self.similarity_search_by_vector_with_score(embedding, k, **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return [d for d, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # cosine similarity [-1, 1] -> relevance [0, 1], the same as Pinecone
+        return lambda score: (score + 1) / 2
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: list[dict] | None = None,
+        path: Path | str | None = None,
+        **kwargs: Any,
+    ) -> "LocalVectorStore":
+        if path is None:
+            raise ValueError("Path to the local vector store is required")
+        store = cls(path, embedding)
+        store.add_texts(texts, metadatas, **kwargs)
+        return store
+
+
+def snapshot_pinecone(
+    index, path: Path | str, embedding: Embeddings, text_key: str = "text", namespace: str = "", batch_size: int = 100
+) -> LocalVectorStore:
+    """Export all vectors from the Pinecone index into the local vector store at path.
+
+    The index must support listing of vector ids (serverless indexes).
+    """
+    ids, vectors, texts, metadatas = [], [], [], []
+    for page in index.list(namespace=namespace):
+        for i in range(0, len(page), batch_size):
+            fetched = index.fetch(ids=page[i : i + batch_size], namespace=namespace).vectors
+            for id_, v in fetched.items():
+                metadata = dict(v.metadata or {})
+                ids.append(id_)
+                vectors.append(np.asarray(v.values, dtype=np.float32))
+                texts.append(metadata.pop(text_key, ""))
+                metadatas.append(metadata)
+        logger.info("Snapshot: %s vectors fetched", len(ids))
+
+    store = LocalVectorStore(path, embedding)
+    store.delete(store.ids, save=False)
+    vectors and store.add_vectors(np.stack(vectors), texts, metadatas, ids, save=False)
+    store.save()
+    return store
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from langchain_pinecone import PineconeVectorStore
+
+    from docbot.cache import bump_index_version
+    from docbot.config import get_config
+    from docbot.constants import LOCAL_INDEX_DIR
+    from docbot.vectorstore import get_embeddings
+
+    config = get_config()
+    parser = argparse.ArgumentParser(description="Snapshot Pinecone index into the local vector store")
+    parser.add_argument("--out", type=Path, default=config.DATA_DIR / LOCAL_INDEX_DIR, help="Output directory")
+    parser.add_argument("--index", default=config.PINECONE_INDEX_NAME, help="Pinecone index name")
+    parser.add_argument("--namespace", default="", help="Pinecone namespace")
+    args = parser.parse_args()
+
+    pinecone_index = PineconeVectorStore.get_pinecone_index(args.index, pinecone_api_key=config.pinecone_api_key)
+    snapshot_pinecone(pinecone_index, args.out, get_embeddings(), namespace=args.namespace)
+    bump_index_version()
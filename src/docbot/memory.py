@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.memory
+    ~~~~~~~~~~~~~
+
+    Chat memory limited by the number of tokens.
+
+    Unlike `ConversationTokenBufferMemory`, tokens are counted once per message when the message is added,
+    the total is kept up to date and the oldest messages are evicted in constant time. The rendered history
+    (`get_buffer_string`) is cached until the next change, so the cost of a turn does not grow with the length
+    of the conversation.
+
+    `SummaryBufferMemory` compacts the evicted messages into a rolling summary. The summary is updated
+    in the background after the answer is saved, so it does not add to the latency of the turn.
+
+    :copyright: © 2024 by Jiri
+"""
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cache
+from typing import Any, Callable, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, get_buffer_string
+from langchain_core.output_parsers import StrOutputParser
+
+from docbot.constants import (
+    CHAT_HISTORY_MAX_TOKENS,
+    LOGGER_NAME,
+    PROMPT_SUMMARY,
+    PROMPT_WELCOME,
+    SUMMARY_MAX_TOKENS,
+    SUMMARY_WORKERS,
+)
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class TokenBufferHistory(BaseChatMessageHistory):
+    """Chat messages with their token counts. The oldest messages are evicted when over `max_token_limit`."""
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        max_token_limit: int = CHAT_HISTORY_MAX_TOKENS,
+        on_evict: Callable[[list[BaseMessage]], None] | None = None,
+    ):
+        self.count_tokens = count_tokens
+        self.max_token_limit = max_token_limit
+        self.on_evict = on_evict
+        self.total_tokens = 0
+        self._buffer: deque[tuple[BaseMessage, str, int]] = deque()  # message, rendered line, tokens
+        self._messages: list[BaseMessage] | None = None
+        self._string: str | None = None
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        if self._messages is None:
+            self._messages = [m for m, _, _ in self._buffer]
+        return self._messages
+
+    @property
+    def buffer_string(self) -> str:
+        """History rendered by `get_buffer_string`, cached until the next change."""
+        if self._string is None:
+            self._string = "\n".join(line for _, line, _ in self._buffer)
+        return self._string
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.add_messages([message])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        for m in messages:
+            line = get_buffer_string([m])
+            tokens = self.count_tokens(line) + 1  # + newline
+            self._buffer.append((m, line, tokens))
+            self.total_tokens += tokens
+
+        evicted = []
+        while self.total_tokens > self.max_token_limit and self._buffer:
+            m, _, tokens = self._buffer.popleft()
+            self.total_tokens -= tokens
+            evicted.append(m)
+        self._messages = self._string = None
+        if evicted and self.on_evict:
+            self.on_evict(evicted)
+
+    def clear(self) -> None:
+        self._buffer.clear()
+        self.total_tokens = 0
+        self._messages = self._string = None
+
+
+class TokenBufferMemory:
+    """Chat memory with the interface of `ConversationTokenBufferMemory` (`return_messages=True`)."""
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        max_token_limit: int = CHAT_HISTORY_MAX_TOKENS,
+        input_key: str = "question",
+        output_key: str = "answer",
+        memory_key: str = "history",
+    ):
+        self.chat_memory = TokenBufferHistory(count_tokens, max_token_limit)
+        self.input_key = input_key
+        self.output_key = output_key
+        self.memory_key = memory_key
+
+    @property
+    def memory_variables(self) -> list[str]:
+        return [self.memory_key]
+
+    @property
+    def max_tokens(self) -> int:
+        """Maximal number of tokens of the rendered history."""
+        return self.chat_memory.max_token_limit
+
+    @property
+    def buffer(self) -> list[BaseMessage]:
+        return self.chat_memory.messages
+
+    @property
+    def buffer_as_str(self) -> str:
+        return self.chat_memory.buffer_string
+
+    def load_memory_variables(self, inputs: dict[str, Any]) -> dict[str, Any]:
+        return {self.memory_key: self.buffer}
+
+    def save_context(self, inputs: dict[str, Any], outputs: dict[str, str]) -> None:
+        self.chat_memory.add_messages(
+            [HumanMessage(content=inputs[self.input_key]), AIMessage(content=outputs[self.output_key])]
+        )
+
+    def clear(self) -> None:
+        self.chat_memory.clear()
+
+
+@cache
+def get_summary_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="docbot-summary")
+
+
+class SummaryBufferMemory(TokenBufferMemory):
+    """Token buffer memory which compacts evicted messages into a rolling summary of at most `max_summary_tokens`.
+
+    The summary is the first message of the history. It is updated in a background thread after `save_context`,
+    a turn started before the update finishes uses the previous summary.
+    """
+
+    _summary_prefix = "Summary of the earlier conversation: "
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        llm: BaseLanguageModel,
+        max_token_limit: int = CHAT_HISTORY_MAX_TOKENS,
+        max_summary_tokens: int = SUMMARY_MAX_TOKENS,
+        **kwargs,
+    ):
+        super().__init__(count_tokens, max_token_limit, **kwargs)
+        self.chat_memory.on_evict = self._evicted
+        self.max_summary_tokens = max_summary_tokens
+        self.summary = ""
+        self._summarize_chain = PROMPT_SUMMARY | llm.bind(max_tokens=max_summary_tokens) | StrOutputParser()
+        self._pending: list[BaseMessage] = []
+        self._lock = threading.Lock()
+        self._running = False
+        self._generation = 0  # incremented by clear, a running update of the cleared summary is discarded
+        self._future: Future | None = None
+        self._cached: tuple[list[BaseMessage], str, list[BaseMessage], str] | None = None
+
+    @property
+    def max_tokens(self) -> int:
+        count_tokens = self.chat_memory.count_tokens
+        return self.chat_memory.max_token_limit + self.max_summary_tokens + count_tokens(self._summary_prefix)
+
+    @property
+    def buffer(self) -> list[BaseMessage]:
+        return self._render()[0]
+
+    @property
+    def buffer_as_str(self) -> str:
+        return self._render()[1]
+
+    def _render(self) -> tuple[list[BaseMessage], str]:
+        """Return the summary message followed by the recent messages and their string, cached until a change."""
+        messages, summary = self.chat_memory.messages, self.summary
+        if not summary:
+            return messages, self.chat_memory.buffer_string
+        if self._cached is None or self._cached[0] is not messages or self._cached[1] is not summary:
+            summary_message = SystemMessage(content=self._summary_prefix + summary)
+            string = "\n".join(filter(None, (get_buffer_string([summary_message]), self.chat_memory.buffer_string)))
+            self._cached = (messages, summary, [summary_message, *messages], string)
+        return self._cached[2], self._cached[3]
+
+    def _evicted(self, messages: list[BaseMessage]) -> None:
+        with self._lock:
+            self._pending.extend(m for m in messages if m.content != PROMPT_WELCOME)
+            if not self._pending or self._running:
+                return
+            self._running = True
+        self._future = get_summary_executor().submit(self._summarize)
+
+    def _summarize(self) -> None:
+        """Fold the pending messages into the summary, until there are no more pending messages."""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._running = False
+                    return
+                pending, self._pending, generation = self._pending, [], self._generation
+
+            try:
+                summary = self._summarize_chain.invoke(
+                    {
+                        "summary": self.summary,
+                        "new_lines": get_buffer_string(pending),
+                        "max_words": int(self.max_summary_tokens * 0.75),
+                    }
+                )
+                summary = self._cap(summary.strip())
+            except Exception as e:
+                logger.error("Chat history summarization failed, %s messages dropped: %s", len(pending), e)
+                continue
+
+            with self._lock:
+                if generation == self._generation:
+                    self.summary = summary
+            logger.debug("Chat history summary updated with %s messages", len(pending))
+
+    def _cap(self, summary: str) -> str:
+        """Enforce the token limit in case the model ignores it (truncate by the characters per token)."""
+        while summary and (tokens := self.chat_memory.count_tokens(summary)) > self.max_summary_tokens:
+            summary = summary[: int(len(summary) * self.max_summary_tokens / tokens * 0.95)]
+        return summary
+
+    def wait(self, timeout: float | None = None) -> None:
+        """Wait until the summary is updated (for tests and benchmarks)."""
+        if self._future is not None:
+            self._future.result(timeout)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._pending = []
+            self.summary = ""
+        super().clear()
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.metrics
+    ~~~~~~~~~~~~~~
+
+    Instrumentation of the RAG chain: a callback handler collects timing spans of the chain stages,
+    time to first token, LLM token counts and cache hits of one turn. Turns are logged as JSON
+    and aggregated into process-wide metrics in the Prometheus text format (served by `docbot.server`
+    on `/metrics`, or written to `DOCBOT_METRICS_FILE` by a background thread at most every `METRICS_WRITE_INTERVAL`,
+    e.g. for the node exporter textfile collector).
+    LLM requests are recorded by `docbot.resilience` (summaries of the first-token latency per model).
+
+    :copyright: © 2024 by Jiri
+"""
+import atexit
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+from typing import Any, Sequence
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler, BaseCallbackManager
+from langchain_core.messages import BaseMessage, get_buffer_string
+from langchain_core.outputs import LLMResult
+from langchain_core.runnables import RunnableConfig, ensure_config
+
+from docbot.config import get_config
+from docbot.constants import (
+    LOGGER_NAME,
+    METRICS_BUCKETS,
+    METRICS_QUANTILES,
+    METRICS_WINDOW,
+    METRICS_WRITE_INTERVAL,
+)
+from docbot.context import TokenCounter
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# named runs of the RAG chain measured as stages -> order in the pipeline (stages of the same order run in parallel),
+# the retriever is measured as "retrieval"
+STAGES = {
+    "load_memory": 0,
+    "rewrite": 1,
+    "speculative_retrieval": 1,
+    "answer_cache": 2,
+    "retrieval": 2,
+    "coalesced": 2,
+    "compression": 3,
+    "packing": 4,
+    "generation": 5,
+}
+
+
+@dataclass
+class Span:
+    name: str
+    start: float  # seconds since the start of the turn
+    duration: float
+
+
+class TurnMetrics(BaseCallbackHandler):
+    """Callback handler collecting metrics of one turn (one call of the chain)."""
+
+    run_inline = True  # measure in the calling thread, also in async chains
+
+    def __init__(self, counter: TokenCounter | None = None):
+        self.counter = counter
+        self.start = time.perf_counter()
+        self.total: float | None = None
+        self.ttft: float | None = None
+        self.spans: list[Span] = []
+        self.tokens: dict[str, dict[str, int]] = {}
+        self.cache: dict[str, bool] = {}
+        self.error = False
+        self._runs: dict[UUID, tuple[str | None, str | None, float]] = {}  # run -> own stage, stage, start
+        self._messages: dict[UUID, list[BaseMessage]] = {}
+        self._cached: dict[UUID, bool] = {}  # cached retriever run -> hit
+
+    def _start(self, run_id: UUID, parent_run_id: UUID | None, name: str | None) -> None:
+        stage = name if name in STAGES else None
+        self._runs[run_id] = (stage, stage or self.stage(parent_run_id), time.perf_counter())
+
+    def _end(self, run_id: UUID) -> None:
+        if (run := self._runs.pop(run_id, None)) and run[0]:
+            self.add_span(run[0], run[2])
+
+    def stage(self, run_id: UUID | None) -> str | None:
+        """Return the stage of the run (its own or of the innermost named parent run)."""
+        return run[1] if (run := self._runs.get(run_id)) else None
+
+    def add_span(self, name: str, start: float, end: float | None = None) -> None:
+        """Add span measured by `time.perf_counter`, ending now by default.
+
+        A streamed run starts when the next step starts to pull its output, before its own input is ready.
+        The span starts when the preceding stages end at the earliest.
+        """
+        end = (time.perf_counter() if end is None else end) - self.start
+        start = max([start - self.start, *(s.start + s.duration for s in self.spans if STAGES[s.name] < STAGES[name])])
+        self.spans.append(Span(name, start, end - start))
+
+    def first_token(self) -> None:
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.start
+
+    def finish(self) -> None:
+        self.total = time.perf_counter() - self.start
+
+    def on_chain_start(
+        self, serialized: dict, inputs: Any, *, run_id: UUID, parent_run_id: UUID | None = None, **kwargs: Any
+    ) -> None:
+        self._start(run_id, parent_run_id, kwargs.get("name"))
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_retriever_start(
+        self, serialized: dict, query: str, *, run_id: UUID, parent_run_id: UUID | None = None, **kwargs: Any
+    ) -> None:
+        # the retriever of the speculative retrieval is measured by its parent run,
+        # retrievers nested in another retriever (hybrid, cached) by the outermost one
+        nested = self.stage(parent_run_id) in ("retrieval", "speculative_retrieval")
+        self._start(run_id, parent_run_id, None if nested else "retrieval")
+        # the cached retriever calls the inner retriever only on a miss
+        if (serialized or {}).get("id", [""])[-1] == "CachedRetriever":
+            self._cached[run_id] = True
+        if parent_run_id in self._cached:
+            self._cached[parent_run_id] = False
+
+    def on_retriever_end(self, documents: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        if (hit := self._cached.pop(run_id, None)) is not None and self.stage(run_id) == "retrieval":
+            self.cache["retrieval"] = hit
+        self._end(run_id)
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._cached.pop(run_id, None)
+        self._end(run_id)
+
+    def on_chat_model_start(
+        self,
+        serialized: dict,
+        messages: list[list[BaseMessage]],
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        **kwargs: Any,
+    ) -> None:
+        self._start(run_id, parent_run_id, None)
+        self._messages[run_id] = messages[0]
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        stage, messages = self.stage(run_id) or "llm", self._messages.pop(run_id, [])
+        self._runs.pop(run_id, None)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if "prompt_tokens" in usage:
+            prompt, completion = usage["prompt_tokens"], usage.get("completion_tokens", 0)
+        elif self.counter is not None:
+            # streamed responses do not report the usage, count the tokens of the rendered prompt and the answer
+            prompt = self.counter.count(get_buffer_string(messages))
+            completion = sum(self.counter.count(g.text) for generations in response.generations for g in generations)
+        else:
+            return
+        tokens = self.tokens.setdefault(stage, {"prompt": 0, "completion": 0})
+        tokens["prompt"] += prompt
+        tokens["completion"] += completion
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._runs.pop(run_id, None)
+        self._messages.pop(run_id, None)
+
+    def stages(self) -> dict[str, float]:
+        """Return total duration of each stage."""
+        result: dict[str, float] = {}
+        for s in self.spans:
+            result[s.name] = result.get(s.name, 0.0) + s.duration
+        return result
+
+    def as_dict(self) -> dict:
+        return {
+            "total": self.total,
+            "ttft": self.ttft,
+            "stages": self.stages(),
+            "spans": [
+                (s.name, round(s.start, 6), round(s.duration, 6)) for s in sorted(self.spans, key=lambda s: s.start)
+            ],
+            "tokens": self.tokens,
+            "cache": self.cache,
+            "error": self.error,
+        }
+
+
+def add_handler(config: RunnableConfig | None, handler: BaseCallbackHandler) -> RunnableConfig:
+    """Return copy of the config with the callback handler added (inherited by the child runs)."""
+    config = ensure_config(config)
+    callbacks = config.get("callbacks")
+    if isinstance(callbacks, BaseCallbackManager):
+        callbacks = callbacks.copy()
+        callbacks.add_handler(handler, inherit=True)
+    else:
+        callbacks = [*(callbacks or []), handler]
+    return {**config, "callbacks": callbacks}
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Window:
+    """Recent values (ring buffer) for the quantiles of a summary, with the sum and count of all values."""
+
+    def __init__(self, size: int = METRICS_WINDOW):
+        self.values: deque[float] = deque(maxlen=size)
+        self.sum = 0.0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def observe(self, value: float) -> None:
+        self.values.append(value)
+        self.sum += value
+        self.count += 1
+
+    def quantiles(self, qs: Sequence[float] = METRICS_QUANTILES) -> dict[float, float]:
+        """Return quantiles of the recent values (nearest rank)."""
+        values = sorted(self.values)
+        return {q: values[max(0, math.ceil(q * len(values)) - 1)] for q in qs} if values else {}
+
+
+def _labels(labels: tuple[tuple[str, str], ...], **extra: str) -> str:
+    items = [*labels, *extra.items()]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+
+
+class Metrics:
+    """Process-wide metrics of the turns, rendered in the Prometheus text format."""
+
+    help = {
+        "docbot_turns_total": ("counter", "Number of answered questions."),
+        "docbot_turn_errors_total": ("counter", "Number of questions which failed."),
+        "docbot_llm_tokens_total": ("counter", "Number of LLM tokens by the chain stage and type."),
+        "docbot_cache_requests_total": ("counter", "Number of cache lookups by the cache and result."),
+        "docbot_turn_seconds": ("histogram", "Total latency of the answer."),
+        "docbot_time_to_first_token_seconds": ("histogram", "Latency of the first token of the answer."),
+        "docbot_stage_seconds": ("histogram", "Latency of the RAG chain stages."),
+        "docbot_llm_requests_total": ("counter", "Number of LLM requests by model and result (ok, error, rejected)."),
+        "docbot_llm_hedges_total": ("counter", "Number of hedged LLM requests by model and the winner."),
+        "docbot_llm_fallbacks_total": ("counter", "Number of LLM requests served by the fallback model."),
+        "docbot_llm_ttft_seconds": ("summary", "Latency of the first token by model (quantiles of recent requests)."),
+    }
+
+    def __init__(
+        self,
+        path: Path | None = None,
+        buckets: Sequence[float] = METRICS_BUCKETS,
+        write_interval: float = METRICS_WRITE_INTERVAL,
+    ):
+        self.path = path
+        self.buckets = buckets
+        self.write_interval = write_interval
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._histograms: dict[str, dict[tuple, Histogram]] = {}
+        self._summaries: dict[str, dict[tuple, Window]] = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Event()  # metrics changed since the file was written
+        self._writer: threading.Thread | None = None
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = tuple(labels.items())
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            if (h := histograms.get(key := tuple(labels.items()))) is None:
+                h = histograms[key] = Histogram(self.buckets)
+            h.observe(value)
+
+    def observe_summary(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            summaries = self._summaries.setdefault(name, {})
+            if (w := summaries.get(key := tuple(labels.items()))) is None:
+                w = summaries[key] = Window()
+            w.observe(value)
+
+    def quantile(self, name: str, q: float, min_count: int = 1, **labels: str) -> float | None:
+        """Return quantile of the recent values of the summary, None if fewer than `min_count` were observed."""
+        with self._lock:
+            w = self._summaries.get(name, {}).get(tuple(labels.items()))
+            return w.quantiles([q])[q] if w is not None and len(w) >= min_count else None
+
+    def summary(self, name: str) -> list[dict]:
+        """Return labels, p50, p95, p99 (`METRICS_QUANTILES`) and count of every series of the summary."""
+        with self._lock:
+            return [
+                {**dict(labels), **{f"p{q * 100:g}": v for q, v in w.quantiles().items()}, "count": w.count}
+                for labels, w in self._summaries.get(name, {}).items()
+            ]
+
+    def record(self, turn: TurnMetrics) -> None:
+        """Aggregate metrics of the turn, log them and schedule writing of the metrics file (if set)."""
+        self.inc("docbot_turn_errors_total" if turn.error else "docbot_turns_total")
+        turn.total is not None and self.observe("docbot_turn_seconds", turn.total)
+        turn.ttft is not None and self.observe("docbot_time_to_first_token_seconds", turn.ttft)
+        for stage, duration in turn.stages().items():
+            self.observe("docbot_stage_seconds", duration, stage=stage)
+        for stage, tokens in turn.tokens.items():
+            for kind, n in tokens.items():
+                self.inc("docbot_llm_tokens_total", n, stage=stage, type=kind)
+        for name, hit in turn.cache.items():
+            self.inc("docbot_cache_requests_total", cache=name, result="hit" if hit else "miss")
+
+        logger.info("Turn metrics: %s", json.dumps(turn.as_dict()))
+        self.path and self.schedule_write()
+
+    def schedule_write(self) -> None:
+        """Write the metrics file in the background, the caller (e.g. the event loop) does not wait for the disk."""
+        self._changed.set()
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="docbot-metrics", daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _write_loop(self) -> None:
+        while True:
+            self._changed.wait()
+            self.flush()
+            time.sleep(self.write_interval)
+
+    def flush(self) -> None:
+        """Write the metrics file now if the metrics changed since the last write."""
+        if self.path and self._changed.is_set():
+            self._changed.clear()
+            self.write(self.path)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, text) in self.help.items():
+                values = self._counters.get(name) or self._histograms.get(name) or self._summaries.get(name)
+                if not values:
+                    continue
+                lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+                if kind == "counter":
+                    lines += [f"{name}{_labels(labels)} {value:g}" for labels, value in values.items()]
+                    continue
+                if kind == "summary":
+                    for labels, w in values.items():
+                        lines += [
+                            f'{name}{_labels(labels, quantile=f"{q:g}")} {v:.6f}' for q, v in w.quantiles().items()
+                        ]
+                        lines += [
+                            f"{name}_sum{_labels(labels)} {w.sum:.6f}",
+                            f"{name}_count{_labels(labels)} {w.count}",
+                        ]
+                    continue
+                for labels, h in values.items():
+                    lines += [f'{name}_bucket{_labels(labels, le=f"{b:g}")} {n}' for b, n in zip(h.buckets, h.counts)]
+                    lines += [
+                        f'{name}_bucket{_labels(labels, le="+Inf")} {h.count}',
+                        f"{name}_sum{_labels(labels)} {h.sum:.6f}",
+                        f"{name}_count{_labels(labels)} {h.count}",
+                    ]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path) -> None:
+        """Write the metrics atomically (the file is never read half-written), every write uses its own temp file."""
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=path.parent, prefix=f"{path.name}.", suffix=".tmp", delete=False
+            ) as f:
+                f.write(self.render())
+            os.replace(f.name, path)
+        except OSError as e:
+            logger.warning("Metrics file %s not written: %s", path, e)
+
+
+@cache
+def get_metrics() -> Metrics:
+    return Metrics(get_config().METRICS_FILE)
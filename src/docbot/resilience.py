@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.resilience
+    ~~~~~~~~~~~~~~~~~
+
+    Resilient LLM calls: hedged requests, fallback model and circuit breaker.
+
+    `ResilientChatModel` wraps the chat model of the RAG chain (both the question rewrite and the generation):
+
+    - hedging: if the first token has not arrived within the `DOCBOT_HEDGE_PERCENTILE` of the recent first-token
+      latencies of the model, a duplicate request is sent, the first one to produce a token wins and the other
+      one is cancelled,
+    - circuit breaker: after `BREAKER_FAILURES` consecutive failures of a model, its calls fail fast
+      for `BREAKER_RESET_TIMEOUT` seconds (the breaker is shared by all chains using the model),
+    - fallback: a call failing before the first token (or rejected by the breaker) is served by the fallback
+      model (`DOCBOT_FALLBACK_MODEL`, e.g. a smaller one). Once tokens are streamed, an error is raised.
+
+    First-token latency (p50, p95, p99) and results of the requests per model are in `docbot.metrics`.
+
+    :copyright: © 2024 by Jiri
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.chat_models import agenerate_from_stream, generate_from_stream
+from langchain_core.messages import BaseMessage, BaseMessageChunk
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from docbot.constants import (
+    BREAKER_FAILURES,
+    BREAKER_RESET_TIMEOUT,
+    HEDGE_DEFAULT_DELAY,
+    HEDGE_MIN_DELAY,
+    HEDGE_MIN_SAMPLES,
+    LOGGER_NAME,
+)
+from docbot.metrics import get_metrics
+
+logger = logging.getLogger(LOGGER_NAME)
+
+TTFT = "docbot_llm_ttft_seconds"
+
+
+class CircuitOpenError(RuntimeError):
+    """The model is rejected by its open circuit breaker."""
+
+
+class CircuitBreaker:
+    """Fail fast while the upstream is degraded.
+
+    Opens after `failures` consecutive failures and rejects the calls for `reset_timeout` seconds, then it lets
+    the calls through (half-open): a success closes it, a failure opens it again.
+    """
+
+    def __init__(self, failures: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if (opened := self._opened) is None:
+            return "closed"
+        return "open" if time.monotonic() - opened < self.reset_timeout else "half_open"
+
+    def allow(self) -> bool:
+        return self.state != "open"
+
+    def success(self) -> None:
+        with self._lock:
+            self._failures, self._opened = 0, None
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failures or self._opened is not None:
+                self._opened is None and logger.warning("Circuit breaker opened after %s failures", self._failures)
+                self._opened = time.monotonic()
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(model_name: str) -> CircuitBreaker:
+    """Return process-wide circuit breaker of the model."""
+    if (breaker := _breakers.get(model_name)) is None:
+        breaker = _breakers.setdefault(model_name, CircuitBreaker())
+    return breaker
+
+
+def name_of(model: BaseChatModel) -> str:
+    return getattr(model, "model_name", None) or type(model).__name__
+
+
+class ResilientChatModel(BaseChatModel):
+    """Chat model with hedged requests, circuit breaker and fallback model (see the module docstring).
+
+    Hedging is disabled with `hedge_percentile=0`.
+    """
+
+    primary: BaseChatModel
+    fallback: BaseChatModel | None = None
+    hedge_percentile: float = 95
+
+    @property
+    def _llm_type(self) -> str:
+        return f"resilient-{self.primary._llm_type}"
+
+    @property
+    def model_name(self) -> str:
+        return name_of(self.primary)
+
+    def get_num_tokens(self, text: str) -> int:
+        return self.primary.get_num_tokens(text)
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return get_breaker(self.model_name)
+
+    def hedge_delay(self) -> float | None:
+        """Return seconds to wait for the first token before the duplicate request, None if hedging is disabled."""
+        if not self.hedge_percentile:
+            return None
+        q = get_metrics().quantile(TTFT, self.hedge_percentile / 100, HEDGE_MIN_SAMPLES, model=self.model_name)
+        return HEDGE_DEFAULT_DELAY if q is None else max(q, HEDGE_MIN_DELAY)
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        streamed = False
+        try:
+            for chunk in self._guarded(self._hedged(messages, stop, kwargs)):
+                streamed = True
+                yield self._generation_chunk(chunk, run_manager)
+        except Exception as e:
+            if streamed or self.fallback is None:
+                raise
+            self._fall_back(e)
+            for chunk in self._observed(self.fallback, self.fallback.stream(messages, stop=stop, **kwargs)):
+                yield self._generation_chunk(chunk, run_manager)
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        streamed = False
+        try:
+            async for chunk in self._aguarded(self._ahedged(messages, stop, kwargs)):
+                streamed = True
+                yield await self._ageneration_chunk(chunk, run_manager)
+        except Exception as e:
+            if streamed or self.fallback is None:
+                raise
+            self._fall_back(e)
+            async for chunk in self._aobserved(self.fallback, self.fallback.astream(messages, stop=stop, **kwargs)):
+                yield await self._ageneration_chunk(chunk, run_manager)
+
+    @staticmethod
+    def _generation_chunk(chunk: BaseMessageChunk, run_manager: CallbackManagerForLLMRun | None) -> ChatGenerationChunk:
+        """Wrap the chunk of the primary or fallback model and report the new token to the callbacks."""
+        generation = ChatGenerationChunk(message=chunk)
+        run_manager and run_manager.on_llm_new_token(str(chunk.content), chunk=generation)
+        return generation
+
+    @staticmethod
+    async def _ageneration_chunk(
+        chunk: BaseMessageChunk, run_manager: AsyncCallbackManagerForLLMRun | None
+    ) -> ChatGenerationChunk:
+        generation = ChatGenerationChunk(message=chunk)
+        if run_manager:
+            await run_manager.on_llm_new_token(str(chunk.content), chunk=generation)
+        return generation
+
+    def _fall_back(self, error: Exception) -> None:
+        logger.warning("LLM %s failed (%r), falling back to %s", self.model_name, error, name_of(self.fallback))
+        get_metrics().inc("docbot_llm_fallbacks_total", model=self.model_name)
+
+    def _reject(self) -> None:
+        if not self.breaker.allow():
+            get_metrics().inc("docbot_llm_requests_total", model=self.model_name, result="rejected")
+            raise CircuitOpenError(f"Circuit breaker of {self.model_name} is open")
+
+    def _guarded(self, chunks: Iterator[BaseMessageChunk]) -> Iterator[BaseMessageChunk]:
+        """Stream of the primary model guarded by its circuit breaker."""
+        self._reject()
+        try:
+            yield from chunks
+        except Exception:
+            self.breaker.failure()
+            get_metrics().inc("docbot_llm_requests_total", model=self.model_name, result="error")
+            raise
+        self.breaker.success()
+        get_metrics().inc("docbot_llm_requests_total", model=self.model_name, result="ok")
+
+    async def _aguarded(self, chunks: AsyncIterator[BaseMessageChunk]) -> AsyncIterator[BaseMessageChunk]:
+        self._reject()
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except Exception:
+            self.breaker.failure()
+            get_metrics().inc("docbot_llm_requests_total", model=self.model_name, result="error")
+            raise
+        self.breaker.success()
+        get_metrics().inc("docbot_llm_requests_total", model=self.model_name, result="ok")
+
+    @staticmethod
+    def _observed(model: BaseChatModel, chunks: Iterator[BaseMessageChunk]) -> Iterator[BaseMessageChunk]:
+        """Record the first-token latency of the stream."""
+        start, first = time.perf_counter(), True
+        for chunk in chunks:
+            if first:
+                get_metrics().observe_summary(TTFT, time.perf_counter() - start, model=name_of(model))
+                first = False
+            yield chunk
+
+    @staticmethod
+    async def _aobserved(model: BaseChatModel, chunks: AsyncIterator[BaseMessageChunk]) -> AsyncIterator:
+        start, first = time.perf_counter(), True
+        async for chunk in chunks:
+            if first:
+                get_metrics().observe_summary(TTFT, time.perf_counter() - start, model=name_of(model))
+                first = False
+            yield chunk
+
+    def _observe_ttft(self, start: float) -> None:
+        get_metrics().observe_summary(TTFT, time.perf_counter() - start, model=self.model_name)
+
+    def _hedge_won(self, winner: int) -> None:
+        get_metrics().inc("docbot_llm_hedges_total", model=self.model_name, winner="hedge" if winner else "first")
+        logger.debug("Hedged request of %s, winner: %s", self.model_name, "hedge" if winner else "first")
+
+    def _hedged(self, messages: list[BaseMessage], stop: list[str] | None, kwargs: dict) -> Iterator[BaseMessageChunk]:
+        """Stream of the first request producing a token, a duplicate one is sent after the hedge delay.
+
+        The requests run in threads and put (attempt, chunk, error) into a queue, chunk None means the end.
+        Only the first-token latency of the winner is recorded, the cancelled request would skew the percentile.
+        """
+        out: queue.Queue = queue.Queue()
+        cancelled: list[threading.Event] = []
+        started: list[float] = []
+
+        def attempt(n: int) -> None:
+            try:
+                for chunk in self.primary.stream(messages, stop=stop, **kwargs):
+                    if cancelled[n].is_set():
+                        return
+                    out.put((n, chunk, None))
+            except Exception as e:
+                out.put((n, None, e))
+            else:
+                out.put((n, None, None))
+
+        def start() -> None:
+            cancelled.append(threading.Event())
+            started.append(time.perf_counter())
+            threading.Thread(target=attempt, args=(len(cancelled) - 1,), daemon=True).start()
+
+        start()
+        delay, winner, failed, first = self.hedge_delay(), None, 0, True
+        try:
+            while True:
+                try:
+                    n, chunk, error = out.get(timeout=delay if winner is None and len(cancelled) == 1 else None)
+                except queue.Empty:
+                    start()
+                    continue
+                if winner is None:
+                    if error is not None and (failed := failed + 1) < len(cancelled):
+                        continue  # the other request may still succeed
+                    winner = n
+                    len(cancelled) > 1 and self._hedge_won(winner)
+                    for i, c in enumerate(cancelled):
+                        i != winner and c.set()
+                if n != winner:
+                    continue
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    return
+                if first:
+                    self._observe_ttft(started[winner])
+                    first = False
+                yield chunk
+        finally:
+            for c in cancelled:
+                c.set()
+
+    async def _ahedged(
+        self, messages: list[BaseMessage], stop: list[str] | None, kwargs: dict
+    ) -> AsyncIterator[BaseMessageChunk]:
+        """Async version of `_hedged`, the requests run as tasks."""
+        out: asyncio.Queue = asyncio.Queue()
+        tasks: list[asyncio.Task] = []
+        started: list[float] = []
+
+        async def attempt(n: int) -> None:
+            try:
+                async for chunk in self.primary.astream(messages, stop=stop, **kwargs):
+                    out.put_nowait((n, chunk, None))
+            except Exception as e:
+                out.put_nowait((n, None, e))
+            else:
+                out.put_nowait((n, None, None))
+
+        def start() -> None:
+            started.append(time.perf_counter())
+            tasks.append(asyncio.create_task(attempt(len(tasks))))
+
+        start()
+        delay, winner, failed, first = self.hedge_delay(), None, 0, True
+        try:
+            while True:
+                try:
+                    timeout = delay if winner is None and len(tasks) == 1 else None
+                    n, chunk, error = await asyncio.wait_for(out.get(), timeout)
+                except asyncio.TimeoutError:
+                    start()
+                    continue
+                if winner is None:
+                    if error is not None and (failed := failed + 1) < len(tasks):
+                        continue
+                    winner = n
+                    len(tasks) > 1 and self._hedge_won(winner)
+                    for i, t in enumerate(tasks):
+                        i != winner and t.cancel()
+                if n != winner:
+                    continue
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    return
+                if first:
+                    self._observe_ttft(started[winner])
+                    first = False
+                yield chunk
+        finally:
+            for t in tasks:
+                t.cancel()
+
+
+def create_resilient_chat_model(model_name: str, temperature: float) -> ResilientChatModel:
+    """Create chat model with hedging (`DOCBOT_HEDGE_PERCENTILE`) and fallback model (`DOCBOT_FALLBACK_MODEL`)."""
+    from docbot.clients import create_chat_model
+    from docbot.config import get_config
+
+    config = get_config()
+    fallback = config.FALLBACK_MODEL
+    return ResilientChatModel(
+        primary=create_chat_model(model_name, temperature),
+        fallback=create_chat_model(fallback, temperature) if fallback and fallback != model_name else None,
+        hedge_percentile=config.HEDGE_PERCENTILE,
+    )
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.rewrite
+    ~~~~~~~~~~~~~~
+
+    Rules deciding whether the user's question has to be rewritten into a standalone question by LLM.
+
+    A rule is a callable `(question, chat_history) -> bool`, it returns True if the LLM rewrite is needed.
+    The rule of the app is selected by `DOCBOT_REWRITE` (see `REWRITE_RULES`).
+
+    :copyright: © 2024 by Jiri
+"""
+import re
+from typing import Callable
+
+from langchain_core.messages import BaseMessage
+
+from docbot.constants import PROMPT_WELCOME, SPECULATIVE_RETRIEVAL_SIMILARITY
+
+RewriteRule = Callable[[str, list[BaseMessage]], bool]
+
+# Words referring to the previous conversation, e.g. "How can I use it?"
+FOLLOW_UP_WORDS = {
+    "it", "its", "this", "that", "these", "those", "they", "them", "their", "there", "he", "she", "his", "her",
+    "above", "previous", "previously", "former", "latter", "same", "also", "else", "more", "again", "one", "ones",
+}  # fmt: skip
+FOLLOW_UP_PREFIXES = ("and ", "but ", "or ", "what about", "how about", "why not", "so ", "then ")
+MIN_STANDALONE_WORDS = 4
+
+
+def has_usable_history(question: str, chat_history: list[BaseMessage]) -> bool:
+    """Rewrite only if there is a chat history other than the welcome message."""
+    return any(m.content != PROMPT_WELCOME for m in chat_history)
+
+
+def is_follow_up(question: str, chat_history: list[BaseMessage]) -> bool:
+    """Rewrite only if there is a chat history and the question looks like a follow-up.
+
+    Cheap heuristic: short questions, questions starting with a conjunction and questions containing references
+    to the previous conversation (pronouns such as "it" or "those") are treated as follow-ups.
+    """
+    if not has_usable_history(question, chat_history):
+        return False
+
+    q = question.strip().lower()
+    words = re.findall(r"[a-z']+", q)
+    return len(words) < MIN_STANDALONE_WORDS or q.startswith(FOLLOW_UP_PREFIXES) or bool(FOLLOW_UP_WORDS & set(words))
+
+
+def always(question: str, chat_history: list[BaseMessage]) -> bool:
+    """Always rewrite the question (the original behaviour)."""
+    return True
+
+
+REWRITE_RULES: dict[str, RewriteRule] = {"history": has_usable_history, "follow_up": is_follow_up, "always": always}
+
+
+def is_same_question(a: str, b: str, threshold: float = SPECULATIVE_RETRIEVAL_SIMILARITY) -> bool:
+    """Return True if the questions do not differ materially (Jaccard similarity of their words)."""
+    wa, wb = set(re.findall(r"\w+", a.lower())), set(re.findall(r"\w+", b.lower()))
+    return wa == wb or len(wa & wb) / len(wa | wb) >= threshold
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.selection
+    ~~~~~~~~~~~~~~~~
+
+    Adaptive top-k retrieval: the number of documents in the context depends on the question.
+
+    `ADAPTIVE_FETCH_K` candidates are fetched together with their scores (cosine similarity) and vectors
+    in one vector store query. The candidates are cut at the relevance threshold and at the score-gap "elbow"
+    (the largest drop of the score), then at most k of them are selected by maximal marginal relevance,
+    which also drops the near-duplicates of the selected chunks (e.g. the same paragraph on several pages).
+
+    The retriever returns all candidates, the kept ones first. Every document has `score` and `selection`
+    (kept or the reason why it was dropped) in the metadata, `split_selection` separates the kept ones.
+
+    :copyright: © 2024 by Jiri
+"""
+import asyncio
+import logging
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+
+from docbot.constants import (
+    ADAPTIVE_DUPLICATE_SIMILARITY,
+    ADAPTIVE_ELBOW_GAP,
+    ADAPTIVE_FETCH_K,
+    ADAPTIVE_MIN_K,
+    ADAPTIVE_MMR_LAMBDA,
+    ADAPTIVE_SCORE_THRESHOLD,
+    LOGGER_NAME,
+    RETRIEVER_TOP_K,
+)
+from docbot.localstore import LocalVectorStore, normalize
+
+logger = logging.getLogger(LOGGER_NAME)
+
+SELECTION = "selection"
+SCORE = "score"
+KEPT = "kept"
+BELOW_THRESHOLD = "below_threshold"
+ELBOW = "elbow"
+DUPLICATE = "duplicate"
+OVER_K = "over_k"
+
+
+def select(
+    scores: np.ndarray,
+    vectors: np.ndarray,
+    k: int = RETRIEVER_TOP_K,
+    min_k: int = ADAPTIVE_MIN_K,
+    threshold: float = ADAPTIVE_SCORE_THRESHOLD,
+    elbow_gap: float = ADAPTIVE_ELBOW_GAP,
+    lambda_mult: float = ADAPTIVE_MMR_LAMBDA,
+    duplicate_similarity: float = ADAPTIVE_DUPLICATE_SIMILARITY,
+) -> tuple[list[int], list[str]]:
+    """Return indices of the kept candidates (in the order of selection) and the selection of every candidate.
+
+    The candidates must be sorted by score (descending), the best `min_k` are never cut by the threshold or elbow.
+    """
+    n = len(scores)
+    reasons = np.full(n, KEPT, dtype=object)
+    min_k = min(min_k, n)
+
+    cut = max(int(np.count_nonzero(scores >= threshold)), min_k)
+    reasons[cut:] = BELOW_THRESHOLD
+    gaps = scores[: cut - 1] - scores[1:cut]
+    gaps[: min_k - 1] = 0
+    if len(gaps) and gaps.max() >= elbow_gap:
+        elbow = int(np.argmax(gaps)) + 1
+        reasons[elbow:cut] = ELBOW
+        cut = elbow
+
+    # maximal marginal relevance over the pairwise similarities of the candidates (at most fetch_k x fetch_k)
+    v = normalize(vectors[:cut])
+    similarity = v @ v.T
+    available = np.ones(cut, dtype=bool)
+    redundancy = np.zeros(cut, dtype=np.float32)
+    kept: list[int] = []
+    while len(kept) < k and available.any():
+        mmr = lambda_mult * scores[:cut] - (1 - lambda_mult) * redundancy
+        j = int(np.argmax(np.where(available, mmr, -np.inf)))
+        kept.append(j)
+        available[j] = False
+        redundancy = np.maximum(redundancy, similarity[j])
+        duplicates = available & (similarity[j] >= duplicate_similarity)
+        reasons[:cut][duplicates] = DUPLICATE
+        available &= ~duplicates
+    reasons[:cut][available] = OVER_K
+    return kept, reasons.tolist()
+
+
+def split_selection(docs: list[Document]) -> tuple[list[Document], list[Document]]:
+    """Return kept and dropped documents, documents without the selection (other retrievers) are kept."""
+    kept = [d for d in docs if d.metadata.get(SELECTION, KEPT) == KEPT]
+    return kept, [d for d in docs if d.metadata.get(SELECTION, KEPT) != KEPT]
+
+
+def selection_report(docs: list[Document]) -> list[dict] | None:
+    """Return title, url, score and selection of the candidates for the debug view, None without the selection."""
+    if not any(SELECTION in d.metadata for d in docs):
+        return None
+    return [
+        {
+            SELECTION: d.metadata[SELECTION],
+            SCORE: d.metadata.get(SCORE),
+            "title": d.metadata.get("title"),
+            "url": d.metadata.get("url"),
+        }
+        for d in docs
+    ]
+
+
+def pinecone_search_with_vectors(
+    store: VectorStore, embedding: list[float], k: int, filter: dict | None = None
+) -> tuple[list[Document], np.ndarray, np.ndarray]:
+    """Return the k most similar documents with their scores and vectors in one Pinecone query."""
+    # the same query as `PineconeVectorStore.max_marginal_relevance_search_by_vector`
+    results = store._index.query(
+        vector=embedding,
+        top_k=k,
+        include_values=True,
+        include_metadata=True,
+        namespace=store._namespace,
+        filter=filter,
+    )
+    matches = [m for m in results["matches"] if store._text_key in m["metadata"]]
+    docs = [Document(page_content=m["metadata"].pop(store._text_key), metadata=m["metadata"]) for m in matches]
+    scores = np.array([m["score"] for m in matches], dtype=np.float32)
+    return docs, scores, np.array([m["values"] for m in matches], dtype=np.float32).reshape(len(matches), -1)
+
+
+class AdaptiveRetriever(BaseRetriever):
+    """Vector search returning up to k relevant and diverse documents (see the module docstring)."""
+
+    store: VectorStore
+    k: int = RETRIEVER_TOP_K
+    fetch_k: int = ADAPTIVE_FETCH_K
+    min_k: int = ADAPTIVE_MIN_K
+    threshold: float = ADAPTIVE_SCORE_THRESHOLD
+    elbow_gap: float = ADAPTIVE_ELBOW_GAP
+    lambda_mult: float = ADAPTIVE_MMR_LAMBDA
+    duplicate_similarity: float = ADAPTIVE_DUPLICATE_SIMILARITY
+    filter: dict | None = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def candidates(self, embedding: list[float]) -> tuple[list[Document], np.ndarray, np.ndarray]:
+        """Return fetch_k candidates sorted by score, with their scores and vectors."""
+        if isinstance(self.store, LocalVectorStore):
+            return self.store.similarity_search_with_vectors(embedding, self.fetch_k, self.filter)
+        return pinecone_search_with_vectors(self.store, embedding, self.fetch_k, self.filter)
+
+    def search_with_scores(self, query: str) -> list[tuple[Document, float]]:
+        return self.choose(self.candidates(self.store.embeddings.embed_query(query)))
+
+    def choose(self, candidates: tuple[list[Document], np.ndarray, np.ndarray]) -> list[tuple[Document, float]]:
+        """Return copies of the candidates with the score and selection in metadata, the kept ones first."""
+        docs, scores, vectors = candidates
+        if not docs:
+            return []
+        kept, reasons = select(
+            scores,
+            vectors,
+            self.k,
+            self.min_k,
+            self.threshold,
+            self.elbow_gap,
+            self.lambda_mult,
+            self.duplicate_similarity,
+        )
+        order = kept + [i for i in range(len(docs)) if reasons[i] != KEPT]
+        logger.debug("Adaptive retrieval: %s of %s candidates kept", len(kept), len(docs))
+        return [
+            (
+                Document(
+                    page_content=docs[i].page_content,
+                    metadata={**docs[i].metadata, SCORE: float(scores[i]), SELECTION: reasons[i]},
+                ),
+                float(scores[i]),
+            )
+            for i in order
+        ]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        return [d for d, _ in self.search_with_scores(query)]
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        embedding = await self.store.embeddings.aembed_query(query)
+        candidates = await asyncio.to_thread(self.candidates, embedding)
+        return [d for d, _ in self.choose(candidates)]
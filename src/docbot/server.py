@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+    docbot.server
+    ~~~~~~~~~~~~~
+
+    ASGI service streaming answers over server-sent events (SSE).
+
+    The service is a plain ASGI application, run it with any ASGI server, e.g.:
+
+        uvicorn docbot.server:app
+
+    Endpoints:
+        POST /chat  {"session_id": "...", "question": "..."}  ->  text/event-stream
+            events: `token` (answer chunk), `done` (standalone question, source urls and metrics), `error`
+        DELETE /sessions/<session_id>  ->  clear chat memory of the session
+        GET /health
+        GET /metrics  ->  latencies, token counts and cache hits in the Prometheus text format
+
+    :copyright: © 2024 by Jiri
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable
+
+from langchain_core.documents import Document
+
+from docbot.chains import RagChainHelper, get_rag
+from docbot.clients import close_openai_async_client
+from docbot.constants import (
+    LLM_MODEL_DEFAULT,
+    LOGGER_NAME,
+    PROMPT_WELCOME,
+    RESPONSE_ERROR,
+    SERVER_MAX_SESSIONS,
+    SERVER_SESSION_TTL,
+)
+from docbot.memory import TokenBufferMemory
+from docbot.metrics import get_metrics
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+@dataclass
+class Session:
+    memory: TokenBufferMemory
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    last_used: float = field(default_factory=time.monotonic)
+
+
+def default_rag() -> RagChainHelper:
+    """Return RAG helper shared by all sessions, configured the same way as the Streamlit chat."""
+    m = LLM_MODEL_DEFAULT
+    return get_rag(m.model_name, m.temperature, m.context_window_tokens)
+
+
+def create_memory() -> TokenBufferMemory:
+    """Create chat memory for a new session."""
+    memory = default_rag().create_memory()
+    memory.chat_memory.add_ai_message(PROMPT_WELCOME)
+    return memory
+
+
+class Sessions:
+    """Chat sessions with their own memory. Idle sessions expire, the least recently used are dropped first."""
+
+    def __init__(
+        self,
+        factory: Callable[[], TokenBufferMemory] = create_memory,
+        max_sessions: int = SERVER_MAX_SESSIONS,
+        ttl: float = SERVER_SESSION_TTL,
+    ):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, session_id: str) -> Session:
+        now = time.monotonic()
+        while self._sessions and now - next(iter(self._sessions.values())).last_used > self.ttl:
+            self._sessions.popitem(last=False)
+
+        if (session := self._sessions.get(session_id)) is None:
+            session = self._sessions[session_id] = Session(self.factory())
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        session.last_used = now
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def delete(self, session_id: str) -> bool:
+        return self._sessions.pop(session_id, None) is not None
+
+
+class ClientDisconnected(Exception):
+    """The client closed the connection while the answer was streamed."""
+
+
+def sse(event: str, data) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+
+class App:
+    """ASGI application. The RAG chain is shared by all sessions, the sessions hold the chat memory only."""
+
+    def __init__(self, sessions: Sessions | None = None, rag: Callable[[], RagChainHelper] = default_rag):
+        self.sessions = sessions if sessions is not None else Sessions()
+        self.rag = rag
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        method, path = scope["method"], scope["path"].rstrip("/")
+        if method == "POST" and path == "/chat":
+            return await self.chat(receive, send)
+        if method == "DELETE" and path.startswith("/sessions/"):
+            deleted = self.sessions.delete(path.removeprefix("/sessions/"))
+            return await self.json(send, {"deleted": deleted}, 200 if deleted else 404)
+        if method == "GET" and path == "/health":
+            return await self.json(send, {"status": "ok", "sessions": len(self.sessions)})
+        if method == "GET" and path == "/metrics":
+            return await self.text(send, get_metrics().render(), b"text/plain; version=0.0.4")
+        return await self.json(send, {"error": "Not found"}, 404)
+
+    @staticmethod
+    async def lifespan(receive: Callable, send: Callable) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await close_openai_async_client()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def read_json(receive: Callable) -> dict:
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                return json.loads(body or b"{}")
+
+    @staticmethod
+    async def json(send: Callable, data: dict, status: int = 200) -> None:
+        body = json.dumps(data).encode()
+        headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    @staticmethod
+    async def text(send: Callable, text: str, content_type: bytes = b"text/plain") -> None:
+        body = text.encode()
+        headers = [(b"content-type", content_type), (b"content-length", str(len(body)).encode())]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def chat(self, receive: Callable, send: Callable) -> None:
+        try:
+            request = await self.read_json(receive)
+            if not isinstance(request, dict):
+                raise ValueError("the body is not a JSON object")
+            session_id, question = str(request["session_id"]), request["question"]
+            if not isinstance(question, str):
+                raise ValueError("the question is not a string")
+        except (ValueError, KeyError) as e:
+            return await self.json(send, {"error": f"Invalid request: {e}"}, 400)
+
+        async def emit(event: str, data, more_body: bool = True) -> None:
+            try:
+                await send({"type": "http.response.body", "body": sse(event, data), "more_body": more_body})
+            except OSError as e:  # servers which raise when the client is gone, uvicorn drops the message silently
+                raise ClientDisconnected from e
+
+        session = self.sessions.get(session_id)
+        headers = [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+
+        # messages of one session are processed in order, the memory is updated after each answer
+        async with session.lock:
+            # the answer is cancelled (the LLM stream closed) as soon as the client disconnects
+            answer = asyncio.create_task(self.answer(session, session_id, question, emit))
+            disconnect = asyncio.create_task(self.wait_disconnect(receive))
+            try:
+                await asyncio.wait((answer, disconnect), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                disconnect.cancel()
+                if not answer.done():
+                    answer.cancel()
+                    logger.info("Client of session %s disconnected", session_id)
+                await asyncio.wait((answer, disconnect))
+
+    @staticmethod
+    async def wait_disconnect(receive: Callable) -> None:
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    async def answer(self, session: Session, session_id: str, question: str, emit: Callable) -> None:
+        inputs, ctx, answer = {"question": question}, [], []
+        try:
+            async for s in self.rag().astream_with_debug(inputs, ctx, session.memory):
+                answer.append(s.content)
+                await emit("token", s.content)
+            session.memory.save_context(inputs, {"answer": "".join(answer)})
+            done = {
+                "standalone_question": "".join(
+                    c["standalone_question"] for c in ctx if isinstance(c, dict) and c.get("standalone_question")
+                ),
+                "urls": [d.metadata.get("url") for d in ctx if isinstance(d, Document)],
+                "metrics": next((c["metrics"] for c in ctx if isinstance(c, dict) and c.get("metrics")), None),
+            }
+            await emit("done", done, more_body=False)
+        except ClientDisconnected:
+            # nothing can be sent any more, the unfinished answer is not saved to the memory
+            logger.info("Client of session %s disconnected", session_id)
+        except Exception as e:
+            logger.error("Error occurred when calling chain: %s", e)
+            try:
+                await emit("error", RESPONSE_ERROR, more_body=False)
+            except ClientDisconnected:
+                logger.info("Client of session %s disconnected", session_id)
+
+
+app = App()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("docbot.server:app", host="0.0.0.0", port=8000)
@@ -3,30 +3,131 @@
     docbot.vectorstore
     ~~~~~~~~~~~~~~~~~~
 
-    Vector store - Pinecone
+    Vector store - Pinecone or local (selected by `DOCBOT_VECTOR_STORE`)
+
+    Documents are ingested by `python -m docbot.ingest`.
+
+    Embeddings, vector store and BM25 index are process-wide singletons created on the first use,
+    importing this module does not create any client. The BM25 index is loaded again when the index version
+    changes (after `python -m docbot.bm25` or an ingestion, which rebuilds the BM25 index of the local store only).
 
     :copyright: © 2024 by Jiri
 """
 import logging
+import threading
+from functools import cache
+from typing import TYPE_CHECKING
+
+from docbot.config import get_config
+from docbot.constants import (
+    BM25_INDEX_DIR,
+    EMBEDDING_CACHE_FILE,
+    EMBEDDING_MODEL,
+    LOCAL_INDEX_DIR,
+    LOGGER_NAME,
+    RETRIEVER_SEARCH_TYPE,
+    RETRIEVER_TOP_K,
+)
 
-from langchain_openai.embeddings import OpenAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
+if TYPE_CHECKING:
+    from langchain_core.retrievers import BaseRetriever
+    from langchain_core.vectorstores import VectorStore
 
-from docbot.config import OPENAI_API_KEY, PINECONE_API_KEY, PINECONE_INDEX_NAME
-from docbot.constants import EMBEDDING_MODEL, LOGGER_NAME
+    from docbot.bm25 import BM25Index
+    from docbot.embeddings import CachedEmbeddings
 
 logger = logging.getLogger(LOGGER_NAME)
 
-embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY, model=EMBEDDING_MODEL)
 
+@cache
+def get_embeddings() -> "CachedEmbeddings":
+    from langchain_openai.embeddings import OpenAIEmbeddings
+
+    from docbot.clients import LoopLocal, get_openai_async_client, get_openai_client
+    from docbot.embeddings import CachedEmbeddings
+
+    config = get_config()
+    return CachedEmbeddings(
+        OpenAIEmbeddings(
+            openai_api_key=config.openai_api_key,
+            model=EMBEDDING_MODEL,
+            client=get_openai_client().embeddings,
+            async_client=LoopLocal(lambda: get_openai_async_client().embeddings),
+        ),
+        model_name=EMBEDDING_MODEL,
+        path=config.DATA_DIR / EMBEDDING_CACHE_FILE,
+    )
+
+
+@cache
+def get_db() -> "VectorStore":
+    config = get_config()
+    if config.VECTOR_STORE == "local":
+        from docbot.localstore import LocalVectorStore
+
+        return LocalVectorStore(
+            config.DATA_DIR / LOCAL_INDEX_DIR, embedding=get_embeddings(), quantization=config.VECTOR_QUANTIZATION
+        )
+
+    from langchain_pinecone import PineconeVectorStore
+
+    return PineconeVectorStore(
+        index_name=config.PINECONE_INDEX_NAME, pinecone_api_key=config.pinecone_api_key, embedding=get_embeddings()
+    )
+
+
+_bm25: tuple[str, "BM25Index | None"] | None = None  # index version and the index loaded for it
+_bm25_lock = threading.Lock()
+
+
+def get_bm25_index() -> "BM25Index | None":
+    """Return the BM25 index of the current index version (None if the index was not built)."""
+    from docbot.bm25 import BM25Index
+    from docbot.cache import get_index_version
+
+    global _bm25
+    version = get_index_version().get()
+    if _bm25 is None or _bm25[0] != version:
+        with _bm25_lock:
+            if _bm25 is None or _bm25[0] != version:
+                path = get_config().DATA_DIR / BM25_INDEX_DIR
+                _bm25 = version, BM25Index.load(path) if path.exists() else None
+    return _bm25[1]
+
+
+def get_retriever(search: str = "vector", k: int = RETRIEVER_TOP_K, filter: dict | None = None) -> "BaseRetriever":
+    """Return retriever for the search type: vector, bm25, hybrid (BM25 and vector combined) or adaptive.
+
+    The adaptive search returns up to k relevant and diverse documents (see `docbot.selection`).
+
+    The metadata filter (see `docbot.filters.SearchFilter.to_store_filter`) is pushed down into the search.
+    """
+    from docbot.bm25 import BM25Retriever, HybridRetriever
 
-db_vcs = PineconeVectorStore(index_name=PINECONE_INDEX_NAME, pinecone_api_key=PINECONE_API_KEY, embedding=embeddings)
+    if search == "adaptive":
+        from docbot.selection import AdaptiveRetriever
 
-retriever = db_vcs.as_retriever()
+        return AdaptiveRetriever(store=get_db(), k=k, filter=filter)
+    search_kwargs = {"k": k, "filter": filter} if filter else {"k": k}
+    vector = get_db().as_retriever(search_type=RETRIEVER_SEARCH_TYPE, search_kwargs=search_kwargs)
+    if search == "vector":
+        return vector
+    if get_bm25_index() is None:
+        raise ValueError(
+            f"BM25 index not found in {get_config().DATA_DIR / BM25_INDEX_DIR}, run `python -m docbot.bm25`"
+        )
+    bm25 = BM25Retriever(index=get_bm25_index, k=k, filter=filter)
+    return bm25 if search == "bm25" else HybridRetriever(retrievers=[bm25, vector], k=k)
 
 
-if __name__ == '__main__':
-    import pandas as pd
-    df = pd.read_csv("/home/jirka/Downloads/Store_Public_Actor_Issues_for_AI_2024_11_28.csv")
-    aggregated_issues = [row.values[1].replace("=>", "\n") for _, row in df.iterrows()]
-    db_vcs.add_texts(aggregated_issues, embedding_chunk_size=2000)
+def __getattr__(name: str):
+    """Backwards compatible module attributes (embeddings, db_vcs, retriever, bm25_index), created on first access."""
+    if name == "embeddings":
+        return get_embeddings()
+    if name == "db_vcs":
+        return get_db()
+    if name == "retriever":
+        return get_db().as_retriever()
+    if name == "bm25_index":
+        return get_bm25_index()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
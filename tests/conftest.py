@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.conftest
+    ~~~~~~~~~~~~~~
+
+    Deterministic fakes shared by the tests, nothing is sent over the network.
+
+    :copyright: © 2024 by Jiri
+"""
+import hashlib
+
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+
+
+def vector(text: str, size: int = 8) -> list[float]:
+    """Unit vector (float64) derived from the hash of the text."""
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    v = np.random.default_rng(seed).standard_normal(size)
+    return (v / np.linalg.norm(v)).tolist()
+
+
+class CountingEmbeddings(Embeddings):
+    """Hash embeddings counting the embedded texts."""
+
+    def __init__(self, size: int = 8):
+        self.size = size
+        self.calls: list[str] = []
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.calls.extend(texts)
+        return [vector(t, self.size) for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return self.embed_query(text)
+
+
+@pytest.fixture
+def embeddings() -> CountingEmbeddings:
+    return CountingEmbeddings()
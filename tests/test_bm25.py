@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import pytest
+from langchain_core.documents import Document
+
+from docbot.bm25 import (
+    CURRENT_FILE,
+    DOCUMENTS_FILE,
+    GENERATION_PREFIX,
+    BM25Index,
+    BM25Retriever,
+    HybridRetriever,
+    current_dir,
+    rebuild_index,
+)
+from docbot.filters import SearchFilter
+from docbot.localstore import LocalVectorStore
+
+DOCS = [
+    Document(page_content="Actors are serverless programs running on the platform.", metadata={"source_type": "docs"}),
+    Document(page_content="Store the results of an Actor run in a dataset.", metadata={"source_type": "docs"}),
+    Document(page_content="Proxy rotation for the crawler.", metadata={"source_type": "issues"}),
+]
+
+
+@pytest.fixture
+def index() -> BM25Index:
+    return BM25Index.build(DOCS)
+
+
+def test_search_ranks_by_bm25(index):
+    results = index.search("dataset results", k=3)
+    assert [d.page_content for d, _ in results] == [DOCS[1].page_content]
+    assert index.search("unknown words", k=3) == []
+
+
+def test_search_with_filter(index):
+    store_filter = SearchFilter(source_types=("issues",)).to_store_filter()
+    assert index.search("actor proxy", k=3, filter=store_filter)[0][0] == DOCS[2]
+
+
+def test_save_and_load(index, tmp_path):
+    index.save(tmp_path)
+    assert not list(tmp_path.glob("*.tmp"))
+    loaded = BM25Index.load(tmp_path)
+    assert [d for d, _ in loaded.search("actor", k=3)] == [d for d, _ in index.search("actor", k=3)]
+
+
+def test_save_switches_generations(index, tmp_path):
+    index.save(tmp_path)
+    first = BM25Index.load(tmp_path)
+    BM25Index.build(DOCS[:1]).save(tmp_path)
+    # an unfinished save (crash) is not visible
+    (tmp_path / f"{GENERATION_PREFIX}0.tmp").mkdir()
+    assert len(BM25Index.load(tmp_path)) == 1
+    # the previous generation is kept for the loaded (memory-mapped) index, older ones are removed
+    assert first.search("actor", k=3) == index.search("actor", k=3)
+    BM25Index.build(DOCS[:2]).save(tmp_path)
+    assert len(BM25Index.load(tmp_path)) == 2
+    assert len([p for p in tmp_path.glob(f"{GENERATION_PREFIX}*") if p.suffix != ".tmp"]) == 2
+
+
+def test_save_replaces_index_without_generations(index, tmp_path):
+    index.save(tmp_path)
+    for p in current_dir(tmp_path).iterdir():
+        p.replace(tmp_path / p.name)
+    (tmp_path / CURRENT_FILE).unlink()
+    assert len(BM25Index.load(tmp_path)) == 3
+
+    BM25Index.build(DOCS[:1]).save(tmp_path)
+    assert len(BM25Index.load(tmp_path)) == 1
+    assert not (tmp_path / DOCUMENTS_FILE).exists()
+
+
+def test_load_rejects_inconsistent_files(index, tmp_path):
+    index.save(tmp_path)
+    BM25Index.build(DOCS[:2]).save(tmp_path / "other")
+    (current_dir(tmp_path / "other") / "doc_len.npy").replace(current_dir(tmp_path) / "doc_len.npy")
+    with pytest.raises(ValueError, match="inconsistent"):
+        BM25Index.load(tmp_path)
+
+
+def test_rebuild_index_from_local_store(embeddings, tmp_path):
+    store = LocalVectorStore(tmp_path / "index", embeddings)
+    store.add_texts([d.page_content for d in DOCS], [d.metadata for d in DOCS])
+    rebuild_index(store, tmp_path / "bm25")
+    assert BM25Index.load(tmp_path / "bm25").search("dataset", k=1)[0][0] == DOCS[1]
+
+
+def test_retriever_uses_the_current_index(index):
+    current = [index]
+    retriever = BM25Retriever(index=lambda: current[0], k=2)
+    assert retriever.invoke("dataset")[0] == DOCS[1]
+    current[0] = BM25Index.build([Document(page_content="A new dataset page.")])
+    assert retriever.invoke("dataset")[0].page_content == "A new dataset page."
+
+
+def test_hybrid_fuses_ranks(index):
+    bm25 = BM25Retriever(index=index, k=3)
+    hybrid = HybridRetriever(retrievers=[bm25, bm25], k=2)
+    assert [d for d, _ in hybrid.search_with_scores("actor dataset")] == [
+        d for d, _ in index.search("actor dataset", 2)
+    ]
+
+
+def test_get_bm25_index_reloads_on_index_version_change(index, tmp_path, monkeypatch):
+    from types import SimpleNamespace
+
+    from docbot import vectorstore
+    from docbot.cache import IndexVersion, bump_index_version
+    from docbot.constants import BM25_INDEX_DIR
+
+    version = IndexVersion(tmp_path / "index_version", check_interval=0)
+    monkeypatch.setattr("docbot.cache.get_index_version", lambda: version)
+    monkeypatch.setattr(vectorstore, "get_config", lambda: SimpleNamespace(DATA_DIR=tmp_path))
+    monkeypatch.setattr(vectorstore, "_bm25", None)
+
+    index.save(tmp_path / BM25_INDEX_DIR)
+    first = vectorstore.get_bm25_index()
+    assert vectorstore.get_bm25_index() is first and len(first) == 3
+
+    BM25Index.build(DOCS[:1]).save(tmp_path / BM25_INDEX_DIR)
+    bump_index_version(version.path)
+    assert len(vectorstore.get_bm25_index()) == 1
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from docbot.cache import CachedRetriever, IndexVersion, RetrievalCache, SemanticCache
+
+
+@pytest.fixture
+def index_version(tmp_path) -> IndexVersion:
+    (path := tmp_path / "index_version").write_text("v1")
+    return IndexVersion(path, check_interval=0)
+
+
+class CountingRetriever(BaseRetriever):
+    queries: list[str] = []
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        self.queries.append(query)
+        return [Document(page_content=query)]
+
+
+def test_index_version_is_read_only_when_checked(tmp_path):
+    path = tmp_path / "index_version"
+    version = IndexVersion(path, check_interval=3600)
+    assert version.get() == ""
+    path.write_text("v1")
+    assert version.get() == ""
+    assert version.refresh() == "v1"
+
+
+def test_retrieval_cache_lru_and_ttl(index_version):
+    cache = RetrievalCache(ttl=3600, max_items=2, index_version=index_version)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)  # evicts "b"
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+
+    expiring = RetrievalCache(ttl=0.01, index_version=index_version)
+    expiring.put("a", 1)
+    time.sleep(0.02)
+    assert expiring.get("a") is None
+
+
+def test_retrieval_cache_dropped_on_index_version_change(index_version):
+    cache = RetrievalCache(index_version=index_version)
+    cache.put("a", 1)
+    index_version.path.write_text("v2-longer")  # the size differs, so the change is seen even with a coarse mtime
+    time.sleep(0.01)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_retrieval_cache_key_normalizes_query():
+    key = RetrievalCache.key
+    assert key("What  is an Actor?", 5, "vector") == key("What is an Actor?", 5, "vector", {})
+    assert key("q", 5, "vector") != key("q", 4, "vector") != key("q", 4, "bm25")
+    assert key("q", 5, "vector", {"a": 1, "b": 2}) == key("q", 5, "vector", {"b": 2, "a": 1})
+
+
+def test_cached_retriever_calls_inner_retriever_once(index_version):
+    inner = CountingRetriever(queries=[])
+    retriever = CachedRetriever(retriever=inner, cache=RetrievalCache(index_version=index_version), k=5)
+    assert retriever.invoke("q")[0].page_content == "q"
+    assert retriever.invoke(" q ")[0].page_content == "q"
+    assert inner.queries == ["q"]
+
+
+def test_semantic_cache_hit_by_namespace_and_threshold(embeddings, index_version):
+    cache = SemanticCache(embeddings, threshold=0.99, index_version=index_version)
+    docs = [Document(page_content="An Actor is a serverless program.")]
+    cache.put("What is an Actor?", "A program.", docs, namespace="vector")
+
+    assert cache.lookup("What is an Actor?", namespace="vector").answer == "A program."
+    assert cache.lookup("What is an Actor?", namespace="bm25") is None
+    assert cache.lookup("How much does a proxy cost?", namespace="vector") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_semantic_cache_shares_index_version_with_retrieval_cache(embeddings, index_version):
+    answers = SemanticCache(embeddings, index_version=index_version)
+    results = RetrievalCache(index_version=index_version)
+    answers.put("q", "a", [])
+    results.put("q", 1)
+    index_version.path.write_text("v2-longer")
+    time.sleep(0.01)
+    assert answers.lookup("q") is None and results.get("q") is None
+
+
+def test_semantic_cache_max_items(embeddings, index_version):
+    cache = SemanticCache(embeddings, threshold=0.99, max_items=2, index_version=index_version)
+    for q in ("a", "b", "c"):
+        cache.put(q, q.upper(), [])
+    assert len(cache) == 2
+    assert cache.lookup("a") is None and cache.lookup("c").answer == "C"
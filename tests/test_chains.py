@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+import pytest
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.retrievers import BaseRetriever
+
+from docbot import chains
+from docbot.chains import RagChainHelper, get_rag, with_search_filter
+from docbot.constants import RAG_CACHE_MAX_ITEMS
+from docbot.filters import SearchFilter
+from docbot.memory import TokenBufferMemory
+from docbot.metrics import Metrics
+
+
+class WordsChatModel(FakeListChatModel):
+    """Fake chat model counting tokens by words (no tokenizer is downloaded)."""
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+
+class FilterRetriever(BaseRetriever):
+    """Returns one document naming the filter it was created with."""
+
+    store_filter: dict | None = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        return [Document(page_content=f"{query} {self.store_filter}", metadata={"source": "s", "title": "t"})]
+
+
+@pytest.fixture(autouse=True)
+def metrics(monkeypatch):
+    monkeypatch.setattr(chains, "get_metrics", lambda: Metrics(None))
+
+
+@pytest.fixture
+def rag() -> RagChainHelper:
+    llm = WordsChatModel(responses=["An answer."] * 10)
+    return RagChainHelper("fake", 0, 10_000, None, llm=llm, retriever_factory=lambda f: FilterRetriever(store_filter=f))
+
+
+def docs(ctx: list) -> list[str]:
+    return [d.page_content for d in ctx if isinstance(d, Document)]
+
+
+def answer(stream) -> str:
+    return "".join(s.content for s in stream)
+
+
+async def aanswer(stream) -> str:
+    return "".join([s.content async for s in stream])
+
+
+def test_get_rag_cache_is_bounded():
+    assert get_rag.cache_info().maxsize == RAG_CACHE_MAX_ITEMS
+
+
+def test_search_filter_is_applied_per_call(rag):
+    search_filter = SearchFilter(source_types=("docs",))
+    unfiltered, filtered = [], []
+    assert answer(rag.stream_with_debug({"question": "q"}, unfiltered)) == "An answer."
+    assert answer(rag.stream_with_debug({"question": "q"}, filtered, search_filter=search_filter)) == "An answer."
+    assert docs(unfiltered) == ["q None"]
+    assert docs(filtered) == [f"q {search_filter.to_store_filter()}"]
+
+    ctx = []
+    asyncio.run(aanswer(rag.astream_with_debug({"question": "q"}, ctx, search_filter=search_filter)))
+    assert docs(ctx) == docs(filtered)
+
+
+def test_cache_namespace_includes_filter_of_the_call(rag):
+    search_filter = SearchFilter(url_prefix="https://docs.apify.com/platform")
+    assert rag.cache_namespace() == rag.cache_namespace(with_search_filter(None, SearchFilter()))
+    assert rag.cache_namespace() != rag.cache_namespace(with_search_filter(None, search_filter))
+
+
+def test_search_filter_requires_retriever_factory():
+    rag = RagChainHelper("fake", 0, 10_000, None, llm=WordsChatModel(responses=["a"]), retriever=FilterRetriever())
+    with pytest.raises(ValueError, match="search filters"):
+        rag.retriever_for(with_search_filter(None, SearchFilter(source_types=("docs",))))
+    assert rag.retriever_for(None) is rag.retriever
+
+
+def test_coalesced_turn_gets_the_debug_outputs_and_its_own_metrics():
+    llm = WordsChatModel(responses=["An answer."] * 10, sleep=0.05)
+    rag = RagChainHelper(
+        "fake", 0, 10_000, None, llm=llm, retriever_factory=lambda f: FilterRetriever(store_filter=f), coalesce=True
+    )
+    ctxs = [[], []]
+
+    async def main():
+        streams = [rag.astream_with_debug({"question": "q"}, ctx) for ctx in ctxs]
+        return await asyncio.gather(*map(aanswer, streams))
+
+    assert asyncio.run(main()) == ["An answer."] * 2
+    leader, joiner = sorted((ctx[-1]["metrics"] for ctx in ctxs), key=lambda m: m["cache"]["coalesced"])
+    assert docs(ctxs[0]) == docs(ctxs[1]) == ["q None"]
+    assert all(any("packing" in c for c in ctx if isinstance(c, dict)) for ctx in ctxs)
+    assert "generation" in leader["stages"] and leader["tokens"]
+    assert joiner["cache"]["coalesced"] and "coalesced" in joiner["stages"] and not joiner["tokens"]
+
+
+@pytest.mark.parametrize(("summarize_history", "coalesced"), [(False, 1), (True, 0)])
+def test_turns_with_different_history_coalesce_unless_the_prompt_uses_it(summarize_history, coalesced):
+    llm = WordsChatModel(responses=["An answer."] * 10, sleep=0.05)
+    rag = RagChainHelper(
+        "fake",
+        0,
+        10_000,
+        None,
+        llm=llm,
+        retriever=FilterRetriever(),
+        rewrite_rule=lambda q, h: False,
+        summarize_history=summarize_history,
+        coalesce=True,
+    )
+    memories = [TokenBufferMemory(lambda text: len(text.split())) for _ in range(2)]
+    memories[1].save_context({"question": "What is a dataset?"}, {"answer": "Storage of results."})
+    ctxs = [[], []]
+
+    async def main():
+        streams = [rag.astream_with_debug({"question": "q"}, ctx, m) for ctx, m in zip(ctxs, memories)]
+        return await asyncio.gather(*map(aanswer, streams))
+
+    assert asyncio.run(main()) == ["An answer."] * 2
+    assert sum(ctx[-1]["metrics"]["cache"]["coalesced"] for ctx in ctxs) == coalesced
+
+
+class SlowRetriever(BaseRetriever):
+    """Records the queries, every retrieval takes 10 ms."""
+
+    queries: list[str] = []
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        time.sleep(0.01)
+        self.queries.append(query)
+        return [Document(page_content=f"about {query}", metadata={"source": "s", "title": "t"})]
+
+
+def speculative_rag(rewritten: str) -> tuple[RagChainHelper, SlowRetriever]:
+    """RAG chain rewriting every question to `rewritten` (the first response of the model)."""
+    llm, retriever = WordsChatModel(responses=[rewritten, "An answer."]), SlowRetriever()
+    rag = RagChainHelper(
+        "fake",
+        0,
+        10_000,
+        None,
+        llm=llm,
+        retriever=retriever,
+        rewrite_rule=lambda q, h: True,
+        speculative_retrieval=True,
+    )
+    return rag, retriever
+
+
+def speculative(ctx: list) -> dict:
+    return next(c["speculative"] for c in ctx if isinstance(c, dict) and c.get("speculative"))
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_speculative_retrieval_is_reused_for_the_same_question(use_async):
+    rag, retriever = speculative_rag("What is an Actor?")
+    ctx, q = [], {"question": "what is an actor"}
+    if use_async:
+        assert asyncio.run(aanswer(rag.astream_with_debug(q, ctx))) == "An answer."
+    else:
+        assert answer(rag.stream_with_debug(q, ctx)) == "An answer."
+
+    assert retriever.queries == ["what is an actor"]  # retrieved once, for the user's question
+    assert docs(ctx) == ["about what is an actor"]
+    spec = speculative(ctx)
+    assert spec["reused"] and spec["retrieval_time"] == 0.0
+    assert spec["hidden_time"] == min(spec["rewrite_time"], spec["speculative_retrieval_time"]) > 0
+    assert ctx[-1]["metrics"]["cache"]["speculative_retrieval"]
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_speculative_retrieval_is_discarded_for_a_different_question(use_async):
+    rag, retriever = speculative_rag("How do I schedule a scraper?")
+    ctx, q = [], {"question": "what is an actor"}
+    if use_async:
+        assert asyncio.run(aanswer(rag.astream_with_debug(q, ctx))) == "An answer."
+    else:
+        assert answer(rag.stream_with_debug(q, ctx)) == "An answer."
+
+    assert retriever.queries == ["what is an actor", "How do I schedule a scraper?"]
+    assert docs(ctx) == ["about How do I schedule a scraper?"]
+    spec = speculative(ctx)
+    assert not spec["reused"] and spec["hidden_time"] == 0.0 and spec["retrieval_time"] >= 0.01
+    assert not ctx[-1]["metrics"]["cache"]["speculative_retrieval"]
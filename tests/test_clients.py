@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from docbot.clients import LoopLocal, RateLimiter, close_openai_async_client, get_openai_async_client
+
+
+@pytest.fixture(autouse=True)
+def api_key(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+
+
+def test_async_client_per_event_loop():
+    async def client():
+        return get_openai_async_client(), get_openai_async_client(), get_openai_async_client(10)
+
+    first, same, with_timeout = asyncio.run(client())
+    assert first is same and with_timeout is not first
+    assert with_timeout.timeout == 10 and with_timeout._client is first._client  # one pool of connections
+    assert asyncio.run(client())[0] is not first
+
+
+def test_loop_local_proxy_resolves_in_every_loop():
+    completions = LoopLocal(lambda: get_openai_async_client().chat.completions)
+
+    async def resolve():
+        return completions.create.__self__, get_openai_async_client().chat.completions
+
+    for _ in range(2):
+        resolved, expected = asyncio.run(resolve())
+        assert resolved is expected
+
+
+def test_close_async_client():
+    async def close():
+        client = get_openai_async_client()
+        await close_openai_async_client()
+        return client, get_openai_async_client()
+
+    closed, new = asyncio.run(close())
+    assert closed.is_closed() and new is not closed
+
+
+def test_rate_limiter_waits_for_tokens():
+    async def acquire():
+        limiter = RateLimiter(10, period=0.1)
+        start = asyncio.get_running_loop().time()
+        for _ in range(3):
+            await limiter.acquire(5)
+        return asyncio.get_running_loop().time() - start
+
+    assert 0.04 <= asyncio.run(acquire()) < 0.5
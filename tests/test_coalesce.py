@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextvars
+import threading
+import time
+
+import pytest
+
+from docbot.coalesce import SingleFlight
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+def source(chunks: list, calls: list, delay: float = 0.01, error: Exception | None = None):
+    def stream():
+        calls.append(request_id.get())
+        for c in chunks:
+            time.sleep(delay)
+            yield c
+        if error is not None:
+            raise error
+
+    return stream
+
+
+def asource(chunks: list, calls: list, delay: float = 0.01):
+    async def stream():
+        calls.append(request_id.get())
+        for c in chunks:
+            await asyncio.sleep(delay)
+            yield c
+
+    return stream
+
+
+def test_concurrent_subscribers_share_one_execution():
+    flight, calls, results = SingleFlight(), [], {}
+    started = threading.Event()
+
+    def subscriber(n: int) -> None:
+        request_id.set(n)
+        chunks, joined = flight.stream("k", source([1, 2, 3], calls, delay=0.05))
+        started.set()
+        results[n] = (list(chunks), joined)
+
+    threads = [threading.Thread(target=subscriber, args=(0,))]
+    threads[0].start()
+    started.wait()
+    threads.append(threading.Thread(target=subscriber, args=(1,)))
+    threads[1].start()
+    [t.join() for t in threads]
+
+    assert results == {0: ([1, 2, 3], False), 1: ([1, 2, 3], True)}
+    assert calls == [0]  # the execution runs with the context of the leader
+    assert flight.stats == {"executions": 1, "coalesced": 1} and len(flight) == 0
+
+
+def test_error_reaches_every_subscriber():
+    flight = SingleFlight()
+    first, _ = flight.stream("k", source([1], [], delay=0.1, error=ValueError("upstream")))
+    second, joined = flight.stream("k", source([1], []))
+    assert joined
+    for chunks in (first, second):
+        with pytest.raises(ValueError, match="upstream"):
+            list(chunks)
+    assert len(flight) == 0
+
+
+def test_async_subscribers_share_one_task():
+    flight, calls = SingleFlight(), []
+
+    async def main():
+        (a, joined_a), (b, joined_b) = (flight.astream("k", asource([1, 2], calls)) for _ in range(2))
+        return [c async for c in a], [c async for c in b], joined_a, joined_b
+
+    assert asyncio.run(main()) == ([1, 2], [1, 2], False, True)
+    assert len(calls) == 1 and len(flight) == 0
+
+
+def test_sync_subscriber_on_the_loop_thread_does_not_join_the_async_flight():
+    flight, calls = SingleFlight(), []
+
+    async def main():
+        achunks, _ = flight.astream("k", asource([1, 2], calls))
+        # waiting for the task of this loop in this thread would never end
+        chunks, joined = flight.stream("k", source([1, 2], calls))
+        return list(chunks), joined, [c async for c in achunks]
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(asyncio.run(main())), daemon=True)
+    thread.start()
+    thread.join(5)
+    assert results == [([1, 2], False, [1, 2])]
+    assert len(calls) == 2 and flight.stats["coalesced"] == 0
+
+
+def test_async_subscriber_joins_sync_flight():
+    flight = SingleFlight()
+    chunks, _ = flight.stream("k", source([1, 2], [], delay=0.1))
+
+    async def main():
+        achunks, joined = flight.astream("k", asource([], []))
+        return [c async for c in achunks], joined
+
+    assert asyncio.run(main()) == ([1, 2], True)
+    assert list(chunks) == [1, 2]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from langchain_core.documents import Document
+
+from docbot.compression import GAP, ContextCompressor, LexicalScorer, split_sentences
+
+TEXT = (
+    "Actors are serverless programs. They run in Docker containers on the platform. "
+    "Proxies rotate the IP addresses of requests. Datasets store the results of Actor runs. "
+    "Schedules start runs periodically. Webhooks notify other services about events."
+)
+
+
+def test_split_sentences_joins_short_fragments():
+    assert split_sentences("Intro:\n\nFirst sentence is here. Ok. Second one is long enough.") == [
+        "Intro: First sentence is here. Ok.",
+        "Second one is long enough.",
+    ]
+
+
+def test_lexical_scorer_ranks_sentences_with_question_terms():
+    sentences = split_sentences(TEXT)
+    scores = LexicalScorer()("Where are the results of a run stored?", sentences)
+    assert int(np.argmax(scores)) == 3 and scores[4] == 0
+
+
+def test_compressor_keeps_the_relevant_sentences_in_order():
+    compressor = ContextCompressor(LexicalScorer(), keep_ratio=0.3, min_sentences=2)
+    short = Document(page_content="Too short to compress. It has two sentences.", metadata={"title": "short"})
+    result = compressor.compress("Do the Actors use webhooks to notify services?", [Document(page_content=TEXT), short])
+
+    compressed, unchanged = result.docs
+    assert (
+        compressed.page_content == f"Actors are serverless programs.{GAP}Webhooks notify other services about events."
+    )
+    assert compressed.metadata["compressed"] and unchanged is short
+    assert (result.sentences, result.kept_sentences) == (8, 4)
+    assert result.kept_chars < result.chars and 0 < result.ratio < 1
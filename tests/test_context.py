@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from langchain_core.documents import Document
+from langchain_core.prompts import PromptTemplate
+
+from docbot.context import ContextPacker, TokenCounter
+
+
+class WordCounter(TokenCounter):
+    """Token per word, records the tokenized texts."""
+
+    def __init__(self, **kwargs):
+        self.texts: list[str] = []
+        super().__init__(self.words, **kwargs)
+
+    def words(self, text: str) -> int:
+        self.texts.append(text)
+        return len(text.split())
+
+
+PROMPT = PromptTemplate.from_template("{page_content}")
+
+
+def doc(words: int, source: str = "s") -> Document:
+    return Document(page_content=" ".join(f"w{i}" for i in range(words)), metadata={"source": source})
+
+
+def test_counter_memoizes_by_digest_lru():
+    counter = WordCounter(max_items=2)
+    assert counter("a b") == counter("a b") == 2
+    counter("c")
+    counter("d")  # evicts "a b"
+    counter("a b")
+    assert counter.texts == ["a b", "c", "d", "a b"]
+    assert (counter.hits, counter.misses) == (1, 4)
+    assert all(isinstance(k, bytes) and len(k) == 16 for k in counter._memo)
+
+
+def test_documents_with_the_same_text_and_different_prompt_fields_are_counted_separately():
+    counter = WordCounter()
+    packer = ContextPacker(counter, document_prompt=PromptTemplate.from_template("{source}: {page_content}"))
+    packer.pack([doc(3, "a"), doc(3, "bb cc")])
+    packer.pack([doc(3, "a"), doc(3, "bb cc")])
+    assert counter.texts == ["\n\n", "a: w0 w1 w2", "bb cc: w0 w1 w2"]
+
+
+def test_pack_keeps_truncates_and_drops_by_budget():
+    packer = ContextPacker(WordCounter(), max_tokens=10, document_prompt=PROMPT, min_truncated_tokens=3)
+    packed = packer.pack([doc(4), doc(4), doc(8), doc(8)])
+    # 4 + 4 (the separator has no words), 2 tokens remain for the rest, fewer than the 3 worth truncating to
+    assert packed.as_dict() == {"tokens": 8, "budget": 10, "kept": 2, "truncated": 0, "dropped": 2}
+
+    packed = packer.pack([doc(4), doc(20)])
+    assert packed.truncated == 1 and packed.tokens <= 10
+    assert packed.docs[1].metadata["truncated"] and packed.docs[1].page_content.startswith("w0 w1")
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import sqlite3
+
+from docbot.embeddings import CachedEmbeddings, as_float32
+
+
+def accessed(path, cache: CachedEmbeddings, text: str) -> float:
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT accessed FROM embeddings WHERE key = ?", (cache.key(text),)).fetchone()[0]
+
+
+def test_memory_tier_lru(embeddings):
+    cache = CachedEmbeddings(embeddings, "m", memory_max_items=2)
+    cache.embed_documents(["a", "b"])
+    cache.embed_query("a")
+    cache.embed_query("c")  # evicts "b", the least recently used
+    cache.embed_query("a")
+    cache.embed_query("b")
+    assert embeddings.calls == ["a", "b", "c", "b"]
+    assert cache.stats.memory_hits == 2 and cache.stats.misses == 4
+
+
+def test_key_normalizes_text_and_includes_model(embeddings):
+    cache = CachedEmbeddings(embeddings, "m")
+    assert cache.key("What  is\tan Actor?") == cache.key("What is an Actor?")
+    assert cache.key("a") != CachedEmbeddings(embeddings, "other").key("a")
+
+
+def test_tiers_return_the_same_float32_vector(embeddings, tmp_path):
+    path = tmp_path / "embeddings.sqlite"
+    computed = CachedEmbeddings(embeddings, "m", path).embed_query("a")
+    from_memory = CachedEmbeddings(embeddings, "m", path)
+    from_memory.embed_query("a")
+    from_disk = CachedEmbeddings(embeddings, "m", path, memory_max_items=0)
+
+    assert computed == as_float32(embeddings.embed_query("a")) != embeddings.embed_query("a")
+    assert from_memory.embed_query("a") == from_disk.embed_query("a") == computed
+    assert from_disk.stats.disk_hits == 1
+
+
+def test_disk_tier_evicts_least_recently_used(embeddings, tmp_path):
+    cache = CachedEmbeddings(
+        embeddings, "m", tmp_path / "e.sqlite", memory_max_items=0, disk_max_items=2, touch_batch=1
+    )
+    cache.embed_documents(["a", "b"])
+    cache.embed_query("a")  # "a" is used more recently than "b"
+    cache.embed_query("c")
+    embeddings.calls.clear()
+    cache.embed_documents(["a", "b", "c"])
+    assert embeddings.calls == ["b"]
+
+
+def test_access_times_are_written_in_batches(embeddings, tmp_path):
+    path = tmp_path / "e.sqlite"
+    cache = CachedEmbeddings(embeddings, "m", path, memory_max_items=0, touch_batch=2)
+    cache.embed_documents(["a", "b"])
+    stored = accessed(path, cache, "a")
+
+    cache.embed_query("a")
+    assert accessed(path, cache, "a") == stored
+    cache.embed_query("b")
+    assert accessed(path, cache, "a") > stored
+
+
+def test_async_uses_both_tiers(embeddings, tmp_path):
+    path = tmp_path / "e.sqlite"
+    cache = CachedEmbeddings(embeddings, "m", path)
+    vectors = asyncio.run(cache.aembed_documents(["a", "b"]))
+    assert asyncio.run(CachedEmbeddings(embeddings, "m", path).aembed_query("b")) == vectors[1]
+    assert embeddings.calls == ["a", "b"]
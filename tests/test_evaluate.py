@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessageChunk
+
+from docbot import evaluate as evaluate_module
+from docbot.evaluate import Evaluation, evaluate, read_conversations
+from docbot.memory import TokenBufferMemory
+
+
+class FakeRag:
+    """Answers every question by its words, records the concurrency and the history of every turn."""
+
+    compressor = None
+
+    def __init__(self):
+        self.active = self.max_active = 0
+        self.history: dict[str, int] = {}  # question -> messages in the memory
+
+    def create_memory(self) -> TokenBufferMemory:
+        return TokenBufferMemory(lambda text: len(text.split()))
+
+    async def astream_with_debug(self, inputs: dict, ctx: list, memory: TokenBufferMemory):
+        question = inputs["question"]
+        self.history[question] = len(memory.buffer)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(0.01)
+            ctx.append(Document(page_content=question, metadata={"url": f"https://docs/{question}"}))
+            ctx.append({"standalone_question": question, "question_path": "passthrough"})
+            ctx.append(
+                {"metrics": {"ttft": 0.1, "total": 0.2, "tokens": {"generation": {"prompt": 5, "completion": 2}}}}
+            )
+            for word in f"Answer to {question}".split():
+                yield AIMessageChunk(content=f"{word} ")
+        finally:
+            self.active -= 1
+
+
+class RecordingEvaluation(Evaluation):
+    """Records the amounts acquired from the rate limiter."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquired: list[int] = []
+        acquire = self.limiter.acquire
+
+        async def recording_acquire(amount: float = 1) -> None:
+            self.acquired.append(amount)
+            await acquire(amount)
+
+        self.limiter.acquire = recording_acquire
+
+
+@pytest.fixture
+def questions(tmp_path):
+    path = tmp_path / "questions.jsonl"
+    lines = [
+        {"id": "actors", "questions": ["what is an actor", "how to run it"]},
+        {"question": "what is a dataset"},
+        {"question": "what is a proxy"},
+    ]
+    path.write_text("\n".join(json.dumps(line) for line in lines) + "\n\n")
+    return path
+
+
+def read(path) -> list[dict]:
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_read_conversations(questions):
+    assert [(c.id, c.questions) for c in read_conversations(questions)] == [
+        ("actors", ["what is an actor", "how to run it"]),
+        ("2", ["what is a dataset"]),
+        ("3", ["what is a proxy"]),
+    ]
+
+
+def test_evaluate_writes_turns_of_the_conversations(questions, tmp_path):
+    rag, output = FakeRag(), tmp_path / "out" / "results.jsonl"
+    evaluation = RecordingEvaluation(rag, concurrency=2, requests_per_minute=1000)
+    turns = evaluate(evaluation, questions, output)
+
+    records = sorted(read(output), key=lambda r: (r["id"], r["turn"]))
+    assert sorted(turns, key=lambda r: (r["id"], r["turn"])) == records
+    assert [(r["id"], r["turn"], r["turns"]) for r in records] == [
+        ("2", 0, 1),
+        ("3", 0, 1),
+        ("actors", 0, 2),
+        ("actors", 1, 2),
+    ]
+    first = records[2]
+    assert first["answer"] == "Answer to what is an actor "
+    assert first["urls"] == ["https://docs/what is an actor"] and first["standalone_question"] == "what is an actor"
+    assert first["latency"] == 0.2 and first["tokens"] == {"generation": {"prompt": 5, "completion": 2}}
+    assert first["error"] is None
+
+    # turns of a conversation share the memory (after the welcome message), the follow-up counts as two requests
+    assert rag.history == {"what is an actor": 1, "how to run it": 3, "what is a dataset": 1, "what is a proxy": 1}
+    assert sorted(evaluation.acquired) == [1, 1, 1, 2]
+    assert rag.max_active == 2
+
+
+def test_evaluate_resumes_incomplete_output(questions, tmp_path):
+    output = tmp_path / "results.jsonl"
+    evaluate(Evaluation(FakeRag(), concurrency=1), questions, output)
+    lines = output.read_text().splitlines(keepends=True)
+    # the second turn of "actors" and the last line were not written completely
+    kept = [line for line in lines if json.loads(line)["id"] != "3" and json.loads(line)["turn"] == 0]
+    output.write_text("".join(kept) + lines[-1][:10])
+
+    rag = FakeRag()
+    evaluate(Evaluation(rag, concurrency=1), questions, output)
+    assert set(rag.history) == {"what is an actor", "how to run it", "what is a proxy"}
+    assert sorted((r["id"], r["turn"]) for r in read(output)) == [("2", 0), ("3", 0), ("actors", 0), ("actors", 1)]
+
+
+def test_parquet_output_is_converted_from_partial_json_lines(questions, tmp_path, monkeypatch):
+    converted = []
+
+    def to_parquet(source, target):
+        converted.append((source.name, target.name, len(read(source))))
+        target.write_bytes(b"parquet")
+
+    monkeypatch.setattr(evaluate_module, "to_parquet", to_parquet)
+    output = tmp_path / "results.parquet"
+    evaluate(Evaluation(FakeRag()), questions, output)
+    assert converted == [("results.partial.jsonl", "results.parquet", 4)]
+    assert output.exists() and not (tmp_path / "results.partial.jsonl").exists()
+
+
+def test_to_parquet(questions, tmp_path):
+    pd = pytest.importorskip("pandas", exc_type=ImportError)
+    pytest.importorskip("pyarrow", exc_type=ImportError)  # may be built for another NumPy
+    evaluate(Evaluation(FakeRag()), questions, tmp_path / "results.parquet")
+    df = pd.read_parquet(tmp_path / "results.parquet")
+    assert sorted(df["question"]) == ["how to run it", "what is a dataset", "what is a proxy", "what is an actor"]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+
+import numpy as np
+import pytest
+
+from docbot.filters import MetadataIndex, SearchFilter, index_metadata, url_key, url_prefixes
+
+
+def test_url_prefixes():
+    assert url_key("https://www.Apify.com/store/?q=1") == "apify.com/store"
+    assert url_prefixes("https://docs.apify.com/platform/actors/running", max_depth=2) == [
+        "docs.apify.com",
+        "docs.apify.com/platform",
+        "docs.apify.com/platform/actors",
+    ]
+
+
+def test_index_metadata_adds_filterable_fields():
+    metadata = index_metadata({"url": "https://docs.apify.com/a", "created_at": "2024-01-02"}, "docs", "created_at")
+    assert metadata["source_type"] == "docs"
+    assert metadata["url_prefixes"] == ["docs.apify.com", "docs.apify.com/a"]
+    assert metadata["timestamp"] == 1704153600
+    assert "timestamp" not in index_metadata({"created_at": "yesterday"}, "docs", "created_at")
+
+
+def test_search_filter_to_store_filter():
+    assert not SearchFilter() and SearchFilter().to_store_filter() is None
+    store_filter = SearchFilter(("docs",), "https://docs.apify.com/platform/", date(2024, 1, 2), date(2024, 1, 2))
+    assert store_filter.to_store_filter() == {
+        "source_type": {"$in": ["docs"]},
+        "url_prefixes": {"$eq": "docs.apify.com/platform"},
+        "timestamp": {"$gte": 1704153600, "$lte": 1704239999},
+    }
+
+
+@pytest.fixture
+def index() -> MetadataIndex:
+    docs = [
+        index_metadata({"url": "https://docs.apify.com/platform/a", "ts": 1}, "docs"),
+        index_metadata({"url": "https://docs.apify.com/sdk/b", "ts": 2}, "docs"),
+        index_metadata({"url": "https://github.com/apify/c"}, "issues"),
+    ]
+    return MetadataIndex([{**m, "timestamp": m.pop("ts", None)} for m in docs])
+
+
+def rows(mask: np.ndarray) -> list[int]:
+    return np.flatnonzero(mask).tolist()
+
+
+def test_metadata_index_operators(index):
+    assert rows(index.mask({"source_type": "docs"})) == [0, 1]
+    assert rows(index.mask({"source_type": {"$nin": ["docs"]}})) == [2]
+    assert rows(index.mask({"url_prefixes": {"$eq": "docs.apify.com/sdk"}})) == [1]
+    assert rows(index.mask({"timestamp": {"$gte": 2}})) == [1]
+    assert rows(index.mask({"timestamp": {"$lt": 5}})) == [0, 1]  # missing values never match a comparison
+    assert rows(index.mask({"$and": [{"source_type": "docs"}, {"timestamp": {"$lte": 1}}]})) == [0]
+    with pytest.raises(ValueError, match="Unsupported"):
+        index.mask({"source_type": {"$regex": "d"}})
+
+
+def test_store_filter_matches_the_index(index):
+    store_filter = SearchFilter(source_types=("docs",), url_prefix="docs.apify.com/platform").to_store_filter()
+    assert rows(index.mask(store_filter)) == [0]
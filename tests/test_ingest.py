@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+
+import numpy as np
+
+from docbot.ingest import (
+    STATS,
+    Batch,
+    Ingestion,
+    Manifest,
+    StoreWriter,
+    TokenChunker,
+    load_checkpoint,
+    upsert_requests,
+)
+from docbot.localstore import VECTORS_FILE, LocalVectorStore
+
+
+class WordEncoding:
+    """Token per word, instead of tiktoken."""
+
+    def encode_ordinary(self, text: str) -> list[str]:
+        return text.split()
+
+    def decode(self, tokens: list[str]) -> str:
+        return " ".join(tokens)
+
+
+def batch(*ids: str) -> Batch:
+    b = Batch()
+    for id_ in ids:
+        b.add(id_, f"text {id_}", {"source": "s"}, id_, 2)
+    b.vectors = np.eye(len(ids), 4, dtype=np.float32)
+    return b
+
+
+def test_upsert_requests_respect_vector_and_size_limits():
+    vectors = [{"id": str(i), "values": [0.5] * 10, "metadata": {}} for i in range(7)]
+    assert [len(r) for r in upsert_requests(vectors, max_vectors=3)] == [3, 3, 1]
+
+    size = len(json.dumps(vectors[0]))
+    requests = list(upsert_requests(vectors, max_bytes=2 * size + 1))
+    assert [len(r) for r in requests] == [2, 2, 2, 1]
+    assert [v["id"] for r in requests for v in r] == [str(i) for i in range(7)]
+    # a vector over the limit is still sent, alone
+    assert [len(r) for r in upsert_requests(vectors[:2], max_bytes=1)] == [1, 1]
+
+
+def test_local_store_snapshot_is_saved_every_n_batches(embeddings, tmp_path):
+    store = LocalVectorStore(tmp_path / "index", embeddings)
+    writer = StoreWriter(store, save_every=2)
+
+    writer.write(batch("a", "b"))
+    assert not writer.flush()
+    assert len(store) == 2 and not (tmp_path / "index" / VECTORS_FILE).exists()
+
+    writer.write(batch("c"))
+    assert writer.flush()
+    assert len(LocalVectorStore(tmp_path / "index", embeddings)) == 3
+
+    writer.write(batch("d"))
+    assert writer.flush(final=True)
+    assert LocalVectorStore(tmp_path / "index", embeddings).ids == ["a", "b", "c", "d"]
+
+
+def ingestion(embeddings, tmp_path, **kwargs) -> Ingestion:
+    return Ingestion(
+        LocalVectorStore(tmp_path / "index", embeddings),
+        embeddings,
+        chunker=TokenChunker(size=4, overlap=1, encoding=WordEncoding()),
+        batch_size=2,
+        concurrency=2,
+        checkpoint=tmp_path / "checkpoint.json",
+        manifest=Manifest(tmp_path / "manifest.sqlite"),
+        **kwargs,
+    )
+
+
+def test_checkpoint_does_not_get_ahead_of_the_local_store(embeddings, tmp_path):
+    ingestion_ = ingestion(embeddings, tmp_path)
+    ingestion_.writer.save_every = 2
+    ingestion_._state, ingestion_._started = load_checkpoint(tmp_path / "checkpoint.json", {}), 0
+    ingestion_.writer.write(batch("a"))
+    seen = [("s", "a", "a")]
+
+    assert not ingestion_._checkpoint(seen)
+    assert not (tmp_path / "checkpoint.json").exists() and not ingestion_.manifest.get("s", ["a"])
+    assert ingestion_._checkpoint(seen, final=True)
+    assert (tmp_path / "checkpoint.json").exists() and ingestion_.manifest.get("s", ["a"]) == {"a": "a"}
+
+
+def test_ingestion_into_local_store(embeddings, tmp_path):
+    ingestion_ = ingestion(embeddings, tmp_path, checkpoint_interval=0)
+    records = [(f"r{n}", f"record {n} has some words to split into chunks", {"source": "s"}) for n in range(5)]
+    state = asyncio.run(ingestion_.run(records, load_checkpoint(tmp_path / "checkpoint.json", {})))
+
+    assert state["done"] and state["records"] == 5
+    saved = LocalVectorStore(tmp_path / "index", embeddings)
+    assert len(saved) == state["added"] == len(ingestion_.manifest.get("s", saved.ids)) == 15
+    assert json.loads((tmp_path / "checkpoint.json").read_text())["records"] == 5
+
+
+def ingest(ingestion_: Ingestion, records: list, tmp_path) -> dict:
+    state = load_checkpoint(tmp_path / "checkpoint.json", {}, restart=True)
+    return {k: v for k, v in asyncio.run(ingestion_.run(records, state)).items() if k in STATS}
+
+
+def test_reingestion_counts_added_changed_unchanged_and_removed(embeddings, tmp_path):
+    ingestion_ = ingestion(embeddings, tmp_path, checkpoint_interval=0)
+    records = [(f"r{n}", f"record {n} has some words", {"source": "s"}) for n in range(3)]  # 2 chunks each
+
+    assert ingest(ingestion_, records, tmp_path) == {"added": 6, "changed": 0, "unchanged": 0, "removed": 0}
+    assert ingest(ingestion_, records, tmp_path) == {"added": 0, "changed": 0, "unchanged": 6, "removed": 0}
+
+    records = [("r0", "record 0 has some text", {"source": "s"}), records[1]]
+    assert ingest(ingestion_, records, tmp_path) == {"added": 0, "changed": 1, "unchanged": 3, "removed": 2}
+    store = LocalVectorStore(tmp_path / "index", embeddings)
+    assert sorted(store.ids) == ["s:r0-0", "s:r0-1", "s:r1-0", "s:r1-1"]
+    assert dict(zip(store.ids, store.texts))["s:r0-1"] == "some text"
+
+
+def test_sources_sharing_record_ids_do_not_overwrite_each_other(embeddings, tmp_path):
+    ingestion_ = ingestion(embeddings, tmp_path, checkpoint_interval=0)
+    docs = [("1", "docs text", {"source": "docs.csv"})]
+    issues = [("1", "issue text", {"source": "issues.csv"})]
+
+    assert ingest(ingestion_, docs, tmp_path)["added"] == 1
+    assert ingest(ingestion_, issues, tmp_path)["added"] == 1
+    assert ingest(ingestion_, docs, tmp_path) == {"added": 0, "changed": 0, "unchanged": 1, "removed": 0}
+
+    store = LocalVectorStore(tmp_path / "index", embeddings)
+    assert dict(zip(store.ids, store.texts)) == {"docs.csv:1-0": "docs text", "issues.csv:1-0": "issue text"}
+
+    # removing the record from one source keeps the other one
+    assert ingest(ingestion_, [], tmp_path)["removed"] == 0  # no source ingested
+    assert ingest(ingestion_, [("2", "new docs", {"source": "docs.csv"})], tmp_path)["removed"] == 1
+    assert sorted(LocalVectorStore(tmp_path / "index", embeddings).ids) == ["docs.csv:2-0", "issues.csv:1-0"]
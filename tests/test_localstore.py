@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from conftest import vector
+
+from docbot.localstore import (
+    METADATA_FILE,
+    QUANTIZED_FILE,
+    VECTORS_FILE,
+    LocalVectorStore,
+    QuantizedVectors,
+    snapshot_pinecone,
+)
+
+TEXTS = ["actors run on the platform", "datasets store results", "proxy rotation", "scheduling runs"]
+METADATAS = [{"source_type": "docs"}, {"source_type": "docs"}, {"source_type": "issues"}, {"source_type": "issues"}]
+
+
+@pytest.fixture
+def store(embeddings, tmp_path) -> LocalVectorStore:
+    store_ = LocalVectorStore(tmp_path / "index", embeddings)
+    store_.add_texts(TEXTS, METADATAS, ids=["a", "b", "c", "d"])
+    return store_
+
+
+def test_add_upsert_and_delete(store, embeddings, tmp_path):
+    assert store.ids == ["a", "b", "c", "d"] and store.vectors.shape == (4, 8)
+
+    store.add_texts(["proxy rotation and sessions"], [{"source_type": "issues"}], ids=["c"])
+    assert len(store) == 4 and store.ids == ["a", "b", "d", "c"]
+    assert store.similarity_search("proxy rotation and sessions", k=1)[0].page_content == "proxy rotation and sessions"
+
+    assert store.delete(["a", "d"]) and not store.delete([])
+    assert store.ids == ["b", "c"] and store.texts == ["datasets store results", "proxy rotation and sessions"]
+    assert len(store.vectors) == 2
+
+
+def test_reopen_memory_maps_the_saved_vectors(store, embeddings, tmp_path):
+    assert isinstance(store.vectors, np.memmap)  # mapped again after the write
+    assert {p.name for p in (tmp_path / "index").iterdir()} == {VECTORS_FILE, METADATA_FILE}
+
+    store.delete(["b"])
+    reopened = LocalVectorStore(tmp_path / "index", embeddings)
+    assert isinstance(reopened.vectors, np.memmap)
+    assert reopened.ids == ["a", "c", "d"] and reopened.metadatas == [METADATAS[0], *METADATAS[2:]]
+    np.testing.assert_array_equal(reopened.vectors, store.vectors)
+
+
+def test_add_vectors_without_save_keeps_the_file(store, embeddings, tmp_path):
+    store.add_vectors(np.ones((1, 8)), ["new"], [{}], ["e"], save=False)
+    assert len(store) == 5 and len(LocalVectorStore(tmp_path / "index", embeddings)) == 4
+    store.save()
+    assert len(LocalVectorStore(tmp_path / "index", embeddings)) == 5
+
+
+def test_top_k_is_ordered_by_cosine_similarity(store):
+    query = np.asarray(vector("datasets store results")) + 0.5 * np.asarray(vector("proxy rotation"))
+    results = store.similarity_search_by_vector_with_score(query.tolist(), k=3)
+    scores = [s for _, s in results]
+    assert [d.page_content for d, _ in results][:2] == ["datasets store results", "proxy rotation"]
+    assert scores == sorted(scores, reverse=True) and len(results) == 3
+
+    expected = store.vectors @ (query / np.linalg.norm(query))
+    assert scores == pytest.approx(np.sort(expected)[::-1][:3].tolist(), abs=1e-6)
+    assert len(store.similarity_search("anything", k=10)) == 4
+
+
+def test_filter_is_passed_through(store):
+    store_filter = {"source_type": {"$in": ["issues"]}}
+    docs = store.similarity_search("datasets store results", k=4, filter=store_filter)
+    assert [d.metadata["source_type"] for d in docs] == ["issues", "issues"]
+
+    retriever = store.as_retriever(search_kwargs={"k": 1, "filter": {"source_type": "docs"}})
+    assert retriever.invoke("proxy rotation")[0].metadata["source_type"] == "docs"
+    assert store.similarity_search("proxy", k=4, filter={"source_type": "forum"}) == []
+
+
+def test_empty_store(embeddings, tmp_path):
+    store_ = LocalVectorStore(tmp_path / "missing", embeddings)
+    assert len(store_) == 0 and store_.similarity_search("actors") == []
+
+
+@pytest.fixture(scope="module")
+def corpus() -> tuple[np.ndarray, np.ndarray]:
+    """Random vectors and queries near some of them (seeded)."""
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((2000, 64)).astype(np.float32)
+    queries = vectors[rng.choice(len(vectors), 50)] + 0.5 * rng.standard_normal((50, 64)).astype(np.float32)
+    return vectors, queries
+
+
+def recall(store: LocalVectorStore, exact: LocalVectorStore, queries: np.ndarray, k: int = 10) -> float:
+    """Average fraction of the exact top k found by the store."""
+    return float(np.mean([len(set(store._search(q, k)[0]) & set(exact._search(q, k)[0])) / k for q in queries]))
+
+
+@pytest.mark.parametrize(("quantization", "oversampling", "min_recall"), [("int8", None, 0.95), ("binary", None, 0.7)])
+def test_quantized_recall(corpus, embeddings, tmp_path, quantization, oversampling, min_recall):
+    vectors, queries = corpus
+    ids = [str(i) for i in range(len(vectors))]
+    exact = LocalVectorStore(tmp_path, embeddings)
+    exact.add_vectors(vectors, ids, [{}] * len(ids), ids)
+
+    store = LocalVectorStore(tmp_path, embeddings, quantization=quantization, oversampling=oversampling)
+    assert store.quantized.nbytes < store.vectors.nbytes / 3
+    assert recall(store, exact, queries) >= min_recall
+
+
+def test_binary_rescoring_improves_recall(corpus, embeddings, tmp_path):
+    vectors, queries = corpus
+    ids = [str(i) for i in range(len(vectors))]
+    exact = LocalVectorStore(tmp_path, embeddings)
+    exact.add_vectors(vectors, ids, [{}] * len(ids), ids)
+
+    without = recall(LocalVectorStore(tmp_path, embeddings, quantization="binary", oversampling=1), exact, queries)
+    with_rescoring = recall(LocalVectorStore(tmp_path, embeddings, quantization="binary"), exact, queries)
+    assert with_rescoring > without + 0.3
+
+
+def test_rescored_scores_are_exact(store, embeddings, tmp_path):
+    quantized = LocalVectorStore(tmp_path / "index", embeddings, quantization="int8")
+    query = vector("datasets store results")
+    assert quantized.similarity_search_by_vector_with_score(query, k=2) == pytest.approx(
+        store.similarity_search_by_vector_with_score(query, k=2)
+    )
+    docs = quantized.similarity_search("datasets store results", k=4, filter={"source_type": "issues"})
+    assert [d.metadata["source_type"] for d in docs] == ["issues", "issues"]
+
+
+def test_quantized_vectors_are_saved_and_rebuilt_when_outdated(store, embeddings, tmp_path):
+    path = tmp_path / "index" / QUANTIZED_FILE.format(method="binary")
+    quantized = LocalVectorStore(tmp_path / "index", embeddings, quantization="binary")
+    assert path.exists()
+    np.testing.assert_array_equal(
+        LocalVectorStore(tmp_path / "index", embeddings, quantization="binary").quantized.codes,
+        quantized.quantized.codes,
+    )
+
+    store.add_texts(["webhooks"], ids=["e"])  # the quantized file is older than the vectors
+    os.utime(path, (0, 0))
+    reopened = LocalVectorStore(tmp_path / "index", embeddings, quantization="binary")
+    assert len(reopened.quantized) == 5 and path.stat().st_mtime > 0
+
+    reopened.add_texts(["crawlers"], ids=["f"])  # saved with the vectors
+    assert len(QuantizedVectors.load(path, "binary")) == len(reopened) == 6
+
+
+class FakeIndex:
+    """Pinecone index listing and fetching the vectors by pages."""
+
+    def __init__(self, vectors: dict[str, tuple[list[float], dict]], page_size: int = 2):
+        self.vectors = vectors
+        self.page_size = page_size
+
+    def fetch(self, ids: list[str], namespace: str = ""):
+        fetched = {i: SimpleNamespace(values=self.vectors[i][0], metadata=self.vectors[i][1]) for i in ids}
+        return SimpleNamespace(vectors=fetched)
+
+    def list(self, namespace: str = ""):
+        ids = list(self.vectors)
+        for i in range(0, len(ids), self.page_size):
+            yield ids[i : i + self.page_size]
+
+
+def test_snapshot_pinecone_replaces_the_local_store(store, embeddings, tmp_path):
+    index = FakeIndex({t: (vector(t), {"text": t, **m}) for t, m in zip(TEXTS[:3], METADATAS)})
+    snapshot = snapshot_pinecone(index, tmp_path / "index", embeddings, batch_size=1)
+
+    reopened = LocalVectorStore(tmp_path / "index", embeddings, quantization="int8")
+    assert reopened.ids == snapshot.ids == TEXTS[:3]
+    assert reopened.texts == TEXTS[:3] and reopened.metadatas == METADATAS[:3]
+    assert reopened.similarity_search("proxy rotation", k=1)[0].page_content == "proxy rotation"
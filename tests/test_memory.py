@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from docbot.memory import SummaryBufferMemory, TokenBufferMemory
+
+
+def words(text: str) -> int:
+    return len(text.split())
+
+
+def save(memory: TokenBufferMemory, *turns: str) -> None:
+    for t in turns:
+        memory.save_context({"question": f"question {t}"}, {"answer": f"answer {t}"})
+
+
+def test_oldest_messages_are_evicted_over_the_limit():
+    memory = TokenBufferMemory(words, max_token_limit=12)  # a message has 3 words and a newline, 4 tokens
+    save(memory, "1")
+    assert [m.content for m in memory.buffer] == ["question 1", "answer 1"]
+    save(memory, "2", "3")
+    assert [m.content for m in memory.buffer] == ["answer 2", "question 3", "answer 3"]
+    assert memory.chat_memory.total_tokens == 12
+
+
+def test_rendered_history_is_cached_until_a_change():
+    memory = TokenBufferMemory(words)
+    save(memory, "1")
+    rendered = memory.buffer_as_str
+    assert rendered == "Human: question 1\nAI: answer 1"
+    assert memory.buffer_as_str is rendered and memory.buffer is memory.buffer
+    save(memory, "2")
+    assert memory.buffer_as_str.endswith("AI: answer 2")
+    memory.clear()
+    assert memory.buffer == [] and memory.buffer_as_str == ""
+
+
+def test_evicted_messages_are_summarized_in_the_background():
+    llm = FakeListChatModel(responses=["The user asked about Actors."])
+    memory = SummaryBufferMemory(words, llm, max_token_limit=8, max_summary_tokens=20)
+    save(memory, "1")
+    assert memory.summary == "" and memory.buffer_as_str == "Human: question 1\nAI: answer 1"
+    save(memory, "2")
+    memory.wait(5)
+
+    assert memory.summary == "The user asked about Actors."
+    assert [type(m).__name__ for m in memory.buffer] == ["SystemMessage", "HumanMessage", "AIMessage"]
+    assert memory.buffer_as_str.startswith("System: Summary of the earlier conversation: The user asked")
+    memory.clear()
+    assert memory.summary == "" and memory.buffer == []
+
+
+def test_summary_is_capped_to_the_token_limit():
+    llm = FakeListChatModel(responses=["word " * 50])
+    memory = SummaryBufferMemory(words, llm, max_token_limit=8, max_summary_tokens=10)
+    save(memory, "1", "2")
+    memory.wait(5)
+    assert 0 < words(memory.summary) <= 10
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from langchain_core.runnables import RunnableLambda
+
+from docbot.metrics import Metrics, TurnMetrics, add_handler
+
+
+def turn() -> TurnMetrics:
+    """Turn with the rewrite and generation stages measured by the callbacks."""
+    turn_ = TurnMetrics()
+    chain = RunnableLambda(lambda x: x).with_config(run_name="rewrite") | RunnableLambda(lambda x: x).with_config(
+        run_name="generation"
+    )
+    chain.invoke("question", add_handler(None, turn_))
+    turn_.tokens["generation"] = {"prompt": 120, "completion": 30}
+    turn_.cache["retrieval"] = True
+    turn_.first_token()
+    turn_.finish()
+    return turn_
+
+
+def test_turn_spans_follow_the_stages():
+    turn_ = turn()
+    rewrite, generation = sorted(turn_.spans, key=lambda s: s.start)
+    assert (rewrite.name, generation.name) == ("rewrite", "generation")
+    assert generation.start >= rewrite.start + rewrite.duration
+    assert set(turn_.as_dict()["stages"]) == {"rewrite", "generation"}
+
+
+def test_record_renders_prometheus_text():
+    metrics = Metrics(buckets=(1, 10))
+    metrics.record(turn())
+    metrics.record(TurnMetrics())  # no spans, tokens or latencies
+    text = metrics.render()
+
+    assert "# TYPE docbot_turns_total counter\ndocbot_turns_total 2\n" in text
+    assert 'docbot_llm_tokens_total{stage="generation",type="prompt"} 120\n' in text
+    assert 'docbot_cache_requests_total{cache="retrieval",result="hit"} 1\n' in text
+    assert "# TYPE docbot_stage_seconds histogram\n" in text
+    assert 'docbot_stage_seconds_bucket{stage="rewrite",le="1"} 1\n' in text
+    assert 'docbot_stage_seconds_bucket{stage="rewrite",le="+Inf"} 1\n' in text
+    assert 'docbot_stage_seconds_count{stage="generation"} 1\n' in text
+    assert "docbot_turn_seconds_count 1\n" in text
+    assert "docbot_turn_errors_total" not in text
+
+
+def test_summary_quantiles():
+    metrics = Metrics()
+    for v in range(1, 101):
+        metrics.observe_summary("docbot_llm_ttft_seconds", v / 100, model="m")
+    assert metrics.quantile("docbot_llm_ttft_seconds", 0.95, model="m") == 0.95
+    assert 'docbot_llm_ttft_seconds{model="m",quantile="0.5"} 0.500000\n' in metrics.render()
+
+
+def test_metrics_file_is_written_in_the_background(tmp_path):
+    path = tmp_path / "metrics.prom"
+    metrics = Metrics(path, write_interval=0)
+    metrics.record(turn())
+    deadline = time.monotonic() + 5
+    while not path.exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert "docbot_turns_total 1" in path.read_text()
+
+
+def test_concurrent_writes_use_own_temp_files(tmp_path):
+    path = tmp_path / "metrics.prom"
+    metrics = Metrics()
+    metrics.inc("docbot_turns_total")
+    threads = [threading.Thread(target=metrics.write, args=(path,)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert path.read_text() == metrics.render()
+    assert [p.name for p in tmp_path.iterdir()] == ["metrics.prom"]
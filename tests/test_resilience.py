@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from typing import Any, AsyncIterator, Iterator
+
+import pytest
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.chat_models import generate_from_stream
+from langchain_core.messages import AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from docbot import resilience
+from docbot.metrics import Metrics
+from docbot.resilience import TTFT, CircuitBreaker, CircuitOpenError, ResilientChatModel
+
+MESSAGES = [HumanMessage(content="What is an Actor?")]
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Streams the words of the answer after the delay of the call (by the call number), None fails the call."""
+
+    model_name: str = "primary"
+    answer: str = "An Actor is a program."
+    delays: list[float | None] = [0.0]
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _delay(self) -> float:
+        delay = self.delays[min(self.calls, len(self.delays) - 1)]
+        self.calls += 1
+        if delay is None:
+            raise ConnectionError(f"{self.model_name} failed")
+        return delay
+
+    def _chunks(self) -> Iterator[ChatGenerationChunk]:
+        return (ChatGenerationChunk(message=AIMessageChunk(content=f"{w} ")) for w in self.answer.split())
+
+    def _generate(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop))
+
+    def _stream(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> Iterator:
+        time.sleep(self._delay())
+        yield from self._chunks()
+
+    async def _astream(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> AsyncIterator:
+        await asyncio.sleep(self._delay())
+        for chunk in self._chunks():
+            yield chunk
+
+
+class Tokens(BaseCallbackHandler):
+    def __init__(self):
+        self.tokens: list[str] = []
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.tokens.append(token)
+
+
+@pytest.fixture(autouse=True)
+def metrics(monkeypatch) -> Metrics:
+    metrics = Metrics(None)
+    monkeypatch.setattr(resilience, "get_metrics", lambda: metrics)
+    monkeypatch.setattr(resilience, "_breakers", {})
+    return metrics
+
+
+def ttft_count(metrics: Metrics, model: str) -> int:
+    return next((s["count"] for s in metrics.summary(TTFT) if s["model"] == model), 0)
+
+
+def test_circuit_breaker_opens_and_recovers():
+    breaker = CircuitBreaker(failures=2, reset_timeout=0.05)
+    breaker.failure()
+    assert breaker.state == "closed"
+    breaker.failure()
+    assert breaker.state == "open" and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.state == "half_open" and breaker.allow()
+    breaker.failure()  # a failure of the half-open breaker opens it again
+    assert breaker.state == "open"
+    time.sleep(0.06)
+    breaker.success()
+    assert breaker.state == "closed"
+
+
+def test_hedged_request_records_only_the_winner(metrics, monkeypatch):
+    monkeypatch.setattr(ResilientChatModel, "hedge_delay", lambda self: 0.05)
+    primary = ScriptedChatModel(delays=[0.3, 0.0])  # the first request is slow, the duplicate wins
+    model = ResilientChatModel(primary=primary)
+
+    start = time.perf_counter()
+    assert model.invoke(MESSAGES).content == "An Actor is a program. "
+    assert time.perf_counter() - start < 0.25
+    time.sleep(0.35)  # the cancelled request produces its first token meanwhile
+
+    assert primary.calls == 2
+    assert ttft_count(metrics, "primary") == 1
+    assert metrics.quantile(TTFT, 0.5, model="primary") < 0.25
+    assert metrics._counters["docbot_llm_hedges_total"] == {(("model", "primary"), ("winner", "hedge")): 1}
+
+
+def test_async_hedged_request_records_only_the_winner(metrics, monkeypatch):
+    monkeypatch.setattr(ResilientChatModel, "hedge_delay", lambda self: 0.05)
+    model = ResilientChatModel(primary=ScriptedChatModel(delays=[0.3, 0.0]))
+
+    async def main():
+        result = await model.ainvoke(MESSAGES)
+        await asyncio.sleep(0.35)
+        return result.content
+
+    assert asyncio.run(main()) == "An Actor is a program. "
+    assert ttft_count(metrics, "primary") == 1
+
+
+def test_fallback_tokens_reach_the_callbacks(metrics):
+    primary = ScriptedChatModel(delays=[None])
+    fallback = ScriptedChatModel(model_name="fallback", answer="Fallback answer.")
+    model = ResilientChatModel(primary=primary, fallback=fallback, hedge_percentile=0)
+
+    handler = Tokens()
+    assert "".join(c.content for c in model.stream(MESSAGES, config={"callbacks": [handler]})) == "Fallback answer. "
+    assert handler.tokens == ["Fallback ", "answer. "]
+
+    handler = Tokens()
+    assert asyncio.run(model.ainvoke(MESSAGES, config={"callbacks": [handler]})).content == "Fallback answer. "
+    assert handler.tokens == ["Fallback ", "answer. "]
+    assert ttft_count(metrics, "fallback") == 2 and ttft_count(metrics, "primary") == 0
+
+
+def test_open_breaker_rejects_the_primary_model():
+    primary = ScriptedChatModel(delays=[None])
+    model = ResilientChatModel(primary=primary, hedge_percentile=0)
+    model.breaker.failures = 2
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            model.invoke(MESSAGES)
+    with pytest.raises(CircuitOpenError):
+        model.invoke(MESSAGES)
+    assert primary.calls == 2
+
+    model.fallback = ScriptedChatModel(model_name="fallback", answer="Fallback answer.")
+    assert model.invoke(MESSAGES).content == "Fallback answer. "
+    assert primary.calls == 2
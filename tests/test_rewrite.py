@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from docbot.constants import PROMPT_WELCOME
+from docbot.rewrite import REWRITE_RULES, is_same_question
+
+WELCOME = [AIMessage(content=PROMPT_WELCOME)]
+HISTORY = [HumanMessage(content="What is an Actor?"), AIMessage(content="A serverless program.")]
+
+
+@pytest.mark.parametrize(
+    "rule, question, history, expected",
+    [
+        ("history", "How do I run an Actor?", WELCOME, False),
+        ("history", "How do I run an Actor?", HISTORY, True),
+        ("follow_up", "How do I run it?", HISTORY, True),
+        ("follow_up", "And the pricing?", HISTORY, True),
+        ("follow_up", "How do I export a dataset to CSV?", HISTORY, False),
+        ("follow_up", "How do I run it?", [], False),
+        ("always", "How do I run an Actor?", [], True),
+    ],
+)
+def test_rewrite_rules(rule, question, history, expected):
+    assert REWRITE_RULES[rule](question, history) is expected
+
+
+def test_is_same_question():
+    assert is_same_question("What is an Actor?", "what is an actor")
+    assert not is_same_question("What is an Actor?", "How do I export a dataset?")
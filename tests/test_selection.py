@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from typing import Any
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from docbot.localstore import LocalVectorStore
+from docbot.selection import (
+    BELOW_THRESHOLD,
+    DUPLICATE,
+    ELBOW,
+    KEPT,
+    OVER_K,
+    SELECTION,
+    AdaptiveRetriever,
+    select,
+    split_selection,
+)
+
+TEXTS = ["alpha", "beta", "gamma", "delta", "epsilon"]
+
+
+def scores(*values: float) -> np.ndarray:
+    return np.array(values, dtype=np.float32)
+
+
+def test_select_cuts_at_threshold_but_keeps_min_k():
+    kept, reasons = select(scores(0.9, 0.85, 0.8, 0.2, 0.1), np.eye(5), k=5, threshold=0.3, elbow_gap=1)
+    assert kept == [0, 1, 2] and reasons[3:] == [BELOW_THRESHOLD] * 2
+
+    kept, reasons = select(scores(0.2, 0.19, 0.1), np.eye(3), k=5, min_k=2, threshold=0.3, elbow_gap=1)
+    assert kept == [0, 1] and reasons == [KEPT, KEPT, BELOW_THRESHOLD]
+
+
+def test_select_cuts_at_the_largest_score_gap():
+    kept, reasons = select(scores(0.9, 0.88, 0.5, 0.48), np.eye(4), k=5, threshold=0.3, elbow_gap=0.1)
+    assert kept == [0, 1] and reasons == [KEPT, KEPT, ELBOW, ELBOW]
+
+
+def test_select_drops_duplicates_and_candidates_over_k():
+    vectors = np.eye(4)
+    vectors[1] = vectors[0]
+    kept, reasons = select(scores(0.9, 0.89, 0.88, 0.87), vectors, k=1, threshold=0, elbow_gap=1)
+    assert kept == [0] and reasons == [KEPT, DUPLICATE, OVER_K, OVER_K]
+
+
+class FakeIndex:
+    """Pinecone index answering the queries from a local store, checks the query as the Pinecone API does."""
+
+    def __init__(self, store: LocalVectorStore):
+        self.store = store
+
+    def query(self, vector: list[float], top_k: int, include_values: bool, include_metadata: bool, **kwargs) -> dict:
+        assert all(isinstance(x, float) for x in vector), "the vector must be a flat list of floats"
+        docs, scores_, vectors = self.store.similarity_search_with_vectors(vector, top_k, kwargs.get("filter"))
+        return {
+            "matches": [
+                {
+                    "id": str(i),
+                    "score": float(s),
+                    "values": v.tolist(),
+                    "metadata": {**d.metadata, "text": d.page_content},
+                }
+                for i, (d, s, v) in enumerate(zip(docs, scores_, vectors))
+            ]
+        }
+
+
+class FakePineconeStore(VectorStore):
+    """The attributes of `PineconeVectorStore` read by the adaptive retriever."""
+
+    def __init__(self, store: LocalVectorStore):
+        self._index, self._namespace, self._text_key = FakeIndex(store), "", "text"
+        self._embedding = store.embeddings
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def add_texts(self, texts, metadatas=None, **kwargs: Any) -> list[str]:
+        raise NotImplementedError
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        raise NotImplementedError
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs: Any) -> "FakePineconeStore":
+        raise NotImplementedError
+
+
+@pytest.fixture
+def local_store(embeddings, tmp_path) -> LocalVectorStore:
+    store = LocalVectorStore(tmp_path / "index", embeddings)
+    texts = [*TEXTS, "alpha"]  # the last one duplicates the first
+    store.add_texts(texts, [{"title": t, "type": "docs" if i % 2 else "issues"} for i, t in enumerate(texts)])
+    return store
+
+
+@pytest.mark.parametrize("pinecone", [False, True])
+def test_adaptive_retriever(local_store, pinecone):
+    store = FakePineconeStore(local_store) if pinecone else local_store
+    retriever = AdaptiveRetriever(store=store, k=3, fetch_k=6, threshold=-1, elbow_gap=2)
+    docs = retriever.invoke("alpha")
+    kept, dropped = split_selection(docs)
+
+    assert len(docs) == 6 and len(kept) == 3
+    assert kept[0].page_content == "alpha" and kept[0].metadata["score"] == pytest.approx(1, abs=1e-5)
+    assert [d.metadata[SELECTION] for d in dropped].count(DUPLICATE) == 1
+    assert [d.page_content for d in asyncio.run(retriever.ainvoke("alpha"))] == [d.page_content for d in docs]
+
+    retriever.filter = {"type": "docs"}
+    assert {d.metadata["type"] for d in retriever.invoke("alpha")} == {"docs"}
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+
+from langchain_core.messages import AIMessageChunk
+
+from docbot.memory import TokenBufferMemory
+from docbot.server import App, Sessions
+
+
+class FakeRag:
+    """Streams the words of the answer, records the questions."""
+
+    def __init__(self, answer: str = "An Actor is a program."):
+        self.answer = answer
+        self.questions: list[str] = []
+        self.cancelled = False
+
+    async def astream_with_debug(self, inputs: dict, ctx: list, memory: TokenBufferMemory):
+        self.questions.append(inputs["question"])
+        try:
+            for word in self.answer.split():
+                await asyncio.sleep(0)
+                yield AIMessageChunk(content=word + " ")
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+def create_app(rag: FakeRag) -> App:
+    return App(Sessions(lambda: TokenBufferMemory(lambda text: len(text.split()))), rag=lambda: rag)
+
+
+def call(app: App, method: str, path: str, body: bytes = b"", disconnect_after: int | None = None) -> list[dict]:
+    """Call the app, the client disconnects after `disconnect_after` messages were sent (as uvicorn, later
+    messages are dropped and `receive` returns `http.disconnect`)."""
+    sent, messages = [], [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def main():
+        disconnected = asyncio.Event()
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if not disconnected.is_set():
+                sent.append(message)
+            if len(sent) == disconnect_after:
+                disconnected.set()
+
+        await app({"type": "http", "method": method, "path": path}, receive, send)
+
+    asyncio.run(main())
+    return sent
+
+
+def events(sent: list[dict]) -> list[str]:
+    body = b"".join(m.get("body", b"") for m in sent[1:]).decode()
+    return [line.removeprefix("event: ") for line in body.splitlines() if line.startswith("event: ")]
+
+
+def test_chat_streams_tokens_and_saves_memory():
+    rag, body = FakeRag(), json.dumps({"session_id": "a", "question": "What is an Actor?"}).encode()
+    app = create_app(rag)
+    sent = call(app, "POST", "/chat", body)
+    assert sent[0]["status"] == 200
+    assert events(sent) == ["token"] * 5 + ["done"]
+    assert not sent[-1].get("more_body")
+    assert len(app.sessions.get("a").memory.buffer) == 2
+
+
+def test_chat_rejects_invalid_body():
+    app = create_app(FakeRag())
+    for body in (b"[1, 2]", b'"question"', b"{not json", b'{"session_id": "a"}', b'{"session_id": "a", "question": 1}'):
+        sent = call(app, "POST", "/chat", body)
+        assert sent[0]["status"] == 400, body
+        assert "Invalid request" in json.loads(sent[1]["body"])["error"]
+
+
+def test_chat_stops_when_client_disconnects():
+    app = create_app(rag := FakeRag(" ".join(["word"] * 100)))
+    body = json.dumps({"session_id": "a", "question": "What is an Actor?"}).encode()
+    sent = call(app, "POST", "/chat", body, disconnect_after=3)  # the response start and two tokens
+    assert len(sent) == 3 and events(sent) == ["token", "token"]
+    assert rag.questions == ["What is an Actor?"] and rag.cancelled
+    assert app.sessions.get("a").memory.buffer == []
+
+
+def test_sessions_and_health():
+    app = create_app(FakeRag())
+    call(app, "POST", "/chat", json.dumps({"session_id": "a", "question": "q"}).encode())
+    assert json.loads(call(app, "GET", "/health")[1]["body"]) == {"status": "ok", "sessions": 1}
+    assert call(app, "DELETE", "/sessions/a")[0]["status"] == 200
+    assert call(app, "DELETE", "/sessions/a")[0]["status"] == 404